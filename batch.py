@@ -0,0 +1,283 @@
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import colorManagement
+import config
+import handleEPS
+import instrumentation
+import metrics
+import morphology
+import presetRegistry
+import program
+import spotCache
+
+acceptedExtensions = (".tif", ".tiff", ".png")
+epsExtensions = (".eps",) # Only picked up when Ghostscript is installed
+
+class BatchResult():
+    def __init__(self, inputName: str, outputName: str):
+        self.inputName = inputName
+        self.outputName = outputName
+        self.seconds = 0.0
+        self.error = None
+        self.metrics = [] # Summary of every job of this file, when metrics are collected
+
+    def succeeded(self) -> bool:
+        return self.error is None
+
+def isSpotOutput(filePath: str) -> bool:
+    # Don't pick up files that this program already generated
+    return filePath.rsplit(".", 1)[0].endswith("_spot")
+
+def getAcceptedExtensions() -> tuple:
+    if handleEPS.ghostScriptInstalled():
+        return acceptedExtensions + epsExtensions
+    return acceptedExtensions
+
+def isAcceptedFile(filePath: str) -> bool:
+    return filePath.lower().endswith(getAcceptedExtensions()) and not isSpotOutput(filePath)
+
+def isEpsFile(filePath: str) -> bool:
+    return filePath.lower().endswith(epsExtensions)
+
+def collectInputs(paths: list, recursive: bool = False) -> list:
+    # Expand every path given into a sorted list of image files
+    inputs = []
+    for path in paths:
+        if os.path.isdir(path):
+            if recursive:
+                for root, dirs, files in os.walk(path):
+                    dirs.sort()
+                    for file in sorted(files):
+                        if isAcceptedFile(file):
+                            inputs.append(os.path.join(root, file))
+            else:
+                for file in sorted(os.listdir(path)):
+                    filePath = os.path.join(path, file)
+                    if os.path.isfile(filePath) and isAcceptedFile(file):
+                        inputs.append(filePath)
+        elif os.path.isfile(path):
+            if isAcceptedFile(path):
+                inputs.append(path)
+            else:
+                print(f"Skipping unsupported file: {path}")
+        else:
+            print(f"Skipping missing path: {path}")
+    return inputs
+
+def getBatchOutputName(inputName: str, outputDir: str = None, variantName: str = None) -> str:
+    outputName = program.getOutputName(inputName)
+    if variantName:
+        outputName = program.getOutputName(f"{inputName.rsplit('.', 1)[0]}_{variantName}.tif") # Still ends with _spot so it's never picked up as an input
+    if outputDir:
+        return os.path.join(outputDir, os.path.basename(outputName))
+    return outputName
+
+def getPresetSettings(presetName: str) -> dict:
+    settings = presetRegistry.registry.get(presetName)
+    if settings is None:
+        raise ValueError(f"Preset not found: {presetName}")
+    return settings
+
+def captureSettings(presetName: str = None, changes: dict = None) -> config.SettingsSnapshot:
+    # Read the settings once so the whole batch (and every worker) uses the same values
+    if presetName:
+        settings = config.SettingsSnapshot.fromDict(getPresetSettings(presetName))
+    else:
+        settings = config.getSnapshot()
+    if changes:
+        settings = settings.replace(**changes)
+    return settings
+
+def getVariantName(presetName: str) -> str:
+    return presetRegistry.registry.getFileName(presetName)[:-len(".json")]
+
+def captureVariants(presetNames: list, changes: dict = None) -> list:
+    # (name, settings) of every preset the files are converted with, in one run per file
+    return [(getVariantName(presetName), captureSettings(presetName, changes)) for presetName in presetNames]
+
+def getFileOutputs(inputName: str, outputDir: str, variants: list = None) -> tuple:
+    # The output name shown for the file and the (outputName, settings) of every variant, None without variants
+    if not variants:
+        return getBatchOutputName(inputName, outputDir), None
+    outputs = [(getBatchOutputName(inputName, outputDir, variantName), settings) for variantName, settings in variants]
+    return ", ".join(outputName for outputName, settings in outputs), outputs
+
+def prefetchEps(inputName: str, settings: config.SettingsSnapshot) -> None:
+    # Let Ghostscript render the next EPS in the background while the current file is converted
+    try:
+        handleEPS.rasterizeAsync(inputName, handleEPS.getTargetSize(inputName, settings.epsWidth, settings.epsHeight, settings.dpi))
+    except Exception:
+        pass # The error is reported when the file itself is converted
+
+def getWorkerCount(workers: int) -> int:
+    if workers <= 0:
+        return os.cpu_count() or 1
+    return workers
+
+def getWorkerTracePath(tracePath: str) -> str:
+    # Every worker writes its own trace, trace.json becomes trace.<pid>.json
+    name, ext = os.path.splitext(tracePath)
+    return f"{name}.{os.getpid()}{ext}"
+
+def initWorker(settings: config.SettingsSnapshot, tracePath: str = None, useSpotCache: bool = True, morphologyEngine: str = morphology.defaultEngine, useEpsCache: bool = True, collectMetrics: bool = False, traceMemory: bool = False) -> None:
+    import cv2
+    config.pinSettings(settings)
+    spotCache.enabled = useSpotCache
+    handleEPS.useRasterCache = useEpsCache
+    morphology.defaultEngine = morphologyEngine
+    instrumentation.traceMemory = traceMemory
+    if tracePath:
+        instrumentation.addChromeTrace(getWorkerTracePath(tracePath))
+    if collectMetrics:
+        metrics.enable()
+    cv2.setNumThreads(1) # One process per core, don't let OpenCV spawn threads on top of that
+    program.cacheFunctions()
+    colorManagement.getSettingsTable(settings) # Table of the selected profile for images without their own profile, before the first file
+
+def convertFile(inputName: str, outputName: str, settings: config.SettingsSnapshot = None, variantOutputs: list = None) -> BatchResult:
+    # With variantOutputs, a list of (outputName, settings), the file is read once and written once for every variant
+    result = BatchResult(inputName, outputName)
+    start = time.perf_counter()
+    try:
+        if variantOutputs:
+            program.generateSpotVariants(inputName, variantOutputs, createPreview=False)
+        else:
+            program.generateSpotImage(inputName, outputName, createPreview=False, settings=settings)
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    result.seconds = time.perf_counter() - start
+    if metrics.enabled:
+        result.metrics = metrics.takeSamples()
+    return result
+
+def runSequential(inputs: list, outputDir: str, settings: config.SettingsSnapshot, report: callable, variants: list = None) -> list:
+    results = []
+    config.pinSettings(settings)
+    try:
+        for index, inputName in enumerate(inputs):
+            if index + 1 < len(inputs) and isEpsFile(inputs[index + 1]):
+                prefetchEps(inputs[index + 1], variants[0][1] if variants else settings) # Variants read the file with the first one's settings
+            outputName, variantOutputs = getFileOutputs(inputName, outputDir, variants)
+            result = convertFile(inputName, outputName, settings, variantOutputs)
+            results.append(result)
+            if report:
+                report(result)
+    finally:
+        config.pinSettings(None)
+    return results
+
+def runParallel(inputs: list, outputDir: str, settings: config.SettingsSnapshot, report: callable, workers: int, tasksPerWorker: int, tracePath: str = None, variants: list = None) -> list:
+    # Every worker warms up numba once and then takes files from the pool's queue.
+    # Restarting workers after tasksPerWorker files keeps their memory use from growing.
+    results = dict()
+    with ProcessPoolExecutor(max_workers=workers, initializer=initWorker, initargs=(settings, tracePath, spotCache.enabled, morphology.defaultEngine, handleEPS.useRasterCache, metrics.enabled, instrumentation.traceMemory), max_tasks_per_child=tasksPerWorker) as pool:
+        futures = dict()
+        for index, inputName in enumerate(inputs):
+            outputName, variantOutputs = getFileOutputs(inputName, outputDir, variants)
+            future = pool.submit(convertFile, inputName, outputName, None, variantOutputs)
+            futures[future] = index
+        for future in as_completed(futures):
+            result = future.result()
+            results[futures[future]] = result
+            if report:
+                report(result)
+    return [results[index] for index in range(len(inputs))]
+
+def runBatch(inputs: list, outputDir: str = None, presetName: str = None, report: callable = None, workers: int = 1, tasksPerWorker: int = None, tracePath: str = None, settingChanges: dict = None, variantPresets: list = None) -> list:
+    # With variantPresets every file is converted once for each of those presets (see program.generateSpotVariants)
+    if outputDir and not os.path.exists(outputDir):
+        os.makedirs(outputDir)
+
+    settings = captureSettings(presetName, settingChanges)
+    variants = captureVariants(variantPresets, settingChanges) if variantPresets else None
+    workers = min(getWorkerCount(workers), len(inputs))
+    if workers > 1:
+        return runParallel(inputs, outputDir, settings, report, workers, tasksPerWorker, tracePath, variants)
+    trace = instrumentation.addChromeTrace(tracePath) if tracePath else None
+    try:
+        return runSequential(inputs, outputDir, settings, report, variants)
+    finally:
+        if trace is not None:
+            instrumentation.removeCallback(trace)
+
+def printResult(result: BatchResult) -> None:
+    if result.succeeded():
+        print(f"{result.seconds:8.2f}s  {result.inputName} -> {result.outputName}")
+    else:
+        print(f"{result.seconds:8.2f}s  {result.inputName} FAILED: {result.error}")
+
+def printSummary(results: list, totalSeconds: float) -> None:
+    done = [result for result in results if result.succeeded()]
+    failed = len(results) - len(done)
+    perMinute = 0.0
+    if totalSeconds > 0:
+        perMinute = len(done) / totalSeconds * 60
+    print(f"Converted {len(done)} of {len(results)} files in {totalSeconds:.2f}s ({perMinute:.1f} files/min), {failed} failed")
+
+def parseArgs(argv: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="batch", description="Add a spot layer to many images without opening the program window")
+    parser.add_argument("paths", nargs="+", help="Image files or folders with images (TIFF, PNG or EPS)")
+    parser.add_argument("-p", "--preset", default=None, help="Name of a preset in data/presets to use instead of the current settings")
+    parser.add_argument("-o", "--output", default=None, help="Folder to write the _spot.tif files to (default: next to each input)")
+    parser.add_argument("--variant", action="append", default=None, metavar="PRESET", help="Write <name>_<preset>_spot.tif with this preset instead of one output, repeat to write several from one read of the file")
+    parser.add_argument("-r", "--recursive", action="store_true", help="Also look for images in subfolders")
+    parser.add_argument("-j", "--workers", type=int, default=1, help="Number of files to convert at the same time, 0 uses one per CPU core (default: 1)")
+    parser.add_argument("--tasks-per-worker", type=int, default=None, help="Restart a worker after this many files to keep its memory use bounded")
+    parser.add_argument("--trace", default=None, help="Write the time spent in every stage to this file (Chrome trace format, one file per worker with -j)")
+    parser.add_argument("--trace-memory", action="store_true", help="Also record the peak memory of every stage in the trace (slower)")
+    parser.add_argument("--eps-width", type=int, default=None, help="Width in mm to render EPS files at (default: from the settings, 0 = size in the file)")
+    parser.add_argument("--eps-height", type=int, default=None, help="Height in mm to render EPS files at, leave out to keep the proportions")
+    parser.add_argument("--no-eps-cache", action="store_true", help="Always render EPS files with Ghostscript, don't reuse earlier renders")
+    parser.add_argument("--morphology", choices=morphology.engines, default=morphology.defaultEngine, help="How the margin is contracted: fast (same result as opencv), opencv or euclidean (a round disc)")
+    parser.add_argument("--no-spot-cache", action="store_true", help="Always compute the spot layer, don't reuse masks of shapes converted before")
+    parser.add_argument("--metrics", default=None, help="Write conversion metrics to this file in the Prometheus text format after every file")
+    return parser.parse_args(argv)
+
+def main(argv: list = None) -> int:
+    args = parseArgs(sys.argv[1:] if argv is None else argv)
+    config.setupProgram()
+
+    inputs = collectInputs(args.paths, args.recursive)
+    if len(inputs) == 0:
+        print("No images found")
+        return 1
+
+    instrumentation.traceMemory = args.trace_memory
+    spotCache.enabled = not args.no_spot_cache
+    handleEPS.useRasterCache = not args.no_eps_cache
+    morphology.defaultEngine = args.morphology
+    settingChanges = dict()
+    if args.eps_width is not None:
+        settingChanges["epsWidth"] = args.eps_width
+        settingChanges["epsHeight"] = 0 # Keep the proportions unless a height is given too
+    if args.eps_height is not None:
+        settingChanges["epsHeight"] = args.eps_height
+        settingChanges.setdefault("epsWidth", 0)
+
+    report = printResult
+    if args.metrics:
+        metrics.enable()
+        finished = []
+
+        def report(result: BatchResult) -> None:
+            printResult(result)
+            finished.append(result)
+            metrics.registry.addResult(result)
+            metrics.registry.setGauge("queue_depth", len(inputs) - len(finished), "Files waiting to be converted")
+            metrics.registry.write(args.metrics)
+
+    start = time.perf_counter()
+    results = runBatch(inputs, args.output, args.preset, report, args.workers, args.tasks_per_worker, args.trace, settingChanges, args.variant)
+    printSummary(results, time.perf_counter() - start)
+    if spotCache.enabled and args.workers == 1:
+        print(spotCache.describeStats()) # Workers keep their own counts, only shown when converting in this process
+
+    if all(result.succeeded() for result in results):
+        return 0
+    return 2
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,347 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import colorManagement
+import config
+import handleImage
+import morphology
+import program
+import spotCache
+
+# Print sizes in mm (width, height), the roll is 60 cm wide and one meter long
+testSizes = {
+    "A4": (210, 297),
+    "A3": (297, 420),
+    "roll60": (600, 1000)
+}
+defaultCases = ["A4@300", "A3@300"]
+allCases = [f"{name}@{dpi}" for name in testSizes.keys() for dpi in (300, 600)]
+
+def getCaseSize(case: str) -> tuple:
+    name, dpi = case.split("@")
+    widthMm, heightMm = testSizes[name]
+    return int(round(heightMm * int(dpi) / 25.4)), int(round(widthMm * int(dpi) / 25.4)), int(dpi)
+
+def generateTestImage(height: int, width: int, seed: int = 0) -> np.ndarray:
+    # RGBA image that looks like DTF artwork: a few solid and gradient shapes on a transparent canvas
+    rng = np.random.default_rng(seed)
+    image = np.zeros((height, width, 4), dtype=np.uint8)
+    rows, cols = np.ogrid[:height, :width]
+    for i in range(6):
+        centerY, centerX = rng.integers(0, height), rng.integers(0, width)
+        radius = int(rng.integers(min(height, width) // 12, min(height, width) // 4) + 1)
+        shape = (rows - centerY) ** 2 + (cols - centerX) ** 2 < radius ** 2
+        color = rng.integers(0, 256, 3, dtype=np.uint8)
+        image[shape, :3] = color
+        image[shape, 3] = 255
+    gradient = (cols * 255 // max(1, width - 1)).astype(np.uint8)
+    band = slice(height // 3, height // 3 + max(1, height // 10))
+    image[band, :, 0] = gradient
+    image[band, :, 3] = 255
+    return image
+
+def generateTestCmykImage(height: int, width: int, seed: int = 0) -> np.ndarray:
+    rgba = generateTestImage(height, width, seed)
+    c, m, y, k = handleImage.rgbToCmykArray(rgba[..., 0], rgba[..., 1], rgba[..., 2])
+    return np.stack([c, m, y, k, rgba[..., 3]], axis=-1)
+
+def getPeakRss() -> int:
+    # Peak memory of this process in bytes, None where it can't be read
+    try:
+        import resource # Not on Windows
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak
+    return peak * 1024
+
+def getBenchmarkIccTable() -> np.ndarray:
+    # Table of the first CMYK profile in data/icc, None when there is none (the ICC stage is skipped then)
+    if not os.path.isdir("data/icc"):
+        return None
+    for profile in sorted(config.getIccProfiles()):
+        table = colorManagement.getTable(os.path.join("data/icc", profile), config.getStandardValues()["iccIntent"])
+        if table is not None:
+            return table
+    return None
+
+def timeStage(function: callable, repeats: int) -> tuple:
+    # Fastest wall time of the runs and the largest python/numpy allocation seen while running
+    best = None
+    result = None
+    tracemalloc.start()
+    try:
+        for i in range(repeats):
+            tracemalloc.reset_peak()
+            start = time.perf_counter()
+            result = function()
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"seconds": best, "peakBytes": peak}, result
+
+def benchmarkCase(case: str, repeats: int, folder: str) -> dict:
+    import tifffile
+    height, width, dpi = getCaseSize(case)
+    settings = config.SettingsSnapshot.fromDict({"dpi": dpi, "margin": max(1, dpi // 150), "spotOffsetX": 3, "spotOffsetY": -2})
+    margin = settings.margin
+
+    rgbaName = os.path.join(folder, f"{case}_rgba.tif")
+    cmykName = os.path.join(folder, f"{case}_cmyk.tif")
+    outputName = os.path.join(folder, f"{case}_spot.tif")
+    rgba = generateTestImage(height, width)
+    tifffile.imwrite(rgbaName, rgba, photometric='rgb', extrasamples=[2])
+    tifffile.imwrite(cmykName, generateTestCmykImage(height, width), photometric='separated', extrasamples=[2])
+
+    stages = dict()
+    stages["splitImageToCmyk RGB"], layers = timeStage(lambda: handleImage.splitImageToCmyk(rgbaName, settings=settings), repeats)
+    stages["splitImageToCmyk CMYK"], _ = timeStage(lambda: handleImage.splitImageToCmyk(cmykName, settings=settings), repeats)
+    c, m, y, k, alphaChannel = layers
+    stages["rgbToCmykArray"], _ = timeStage(lambda: handleImage.rgbToCmykArray(rgba[..., 0], rgba[..., 1], rgba[..., 2]), repeats)
+    iccTable = getBenchmarkIccTable()
+    if iccTable is not None:
+        stages["rgbToCmykArray ICC"], _ = timeStage(lambda: colorManagement.rgbToCmykArray(rgba[..., 0], rgba[..., 1], rgba[..., 2], iccTable), repeats)
+    stages["contractAlphaSmooth mode 1"], _ = timeStage(lambda: program.contractAlphaSmooth(np.copy(alphaChannel), pixels=margin, mode=1), repeats)
+    # Margins used at 600 dpi, where the cost of OpenCV's ellipse grows with the square of the radius
+    mask = (alphaChannel > 2).astype(np.uint8)
+    for engine in ("opencv", "fast"):
+        stages[f"erodeEllipse margin 30 {engine}"], _ = timeStage(lambda: morphology.erodeEllipse(mask, 30, engine), repeats)
+    stages["contractAlphaSmooth mode 2"], spot = timeStage(lambda: program.contractAlphaSmooth(np.copy(alphaChannel), pixels=margin, mode=2), repeats)
+    stages["fixSpotSmart"], spot = timeStage(lambda: program.fixSpotSmart(c, m, y, k, alphaChannel, np.copy(spot), margin, (True, True)), repeats)
+    spot = spot.astype(np.uint8)
+    stages["computeSpotRegion"], _ = timeStage(lambda: program.computeSpotRegion(c, m, y, k, alphaChannel, settings), repeats)
+
+    def offsetLayers():
+        padded = program.resizeAllLayersToFitOffset([c, m, y, k, alphaChannel, spot], 0, settings.getOffset())
+        return padded[:5] + [program.offsetSpot(padded[5], settings.getOffset())]
+    stages["resizeAllLayersToFitOffset+offsetSpot"], padded = timeStage(offsetLayers, repeats)
+    pc, pm, py, pk, pAlpha, pSpot = padded
+
+    spotInverted = program.invertChannel(pSpot)
+    alphaPatch = np.maximum(pAlpha, pSpot)
+    stages["generateSpotPreview"], _ = timeStage(lambda: program.generateSpotPreview(pc, pm, py, pk, alphaPatch, spotInverted, settings.getPreviewColor(), settings.previewMaxEdge), repeats)
+
+    generator = program.CMYKTiffGenerator(False, settings)
+    stages["writeSpotFull"], _ = timeStage(lambda: generator.writeSpotFull(outputName, [c, m, y, k, alphaChannel], spot, 0, 0, createPreview=False), repeats)
+    stages["total generateSpotImage"], _ = timeStage(lambda: program.generateSpotImage(rgbaName, outputName, True, settings), repeats)
+
+    for name in (rgbaName, cmykName, outputName):
+        os.remove(name)
+    return {"case": case, "width": width, "height": height, "dpi": dpi, "margin": margin, "stages": stages, "peakRssBytes": getPeakRss()}
+
+def runBenchmarks(cases: list, repeats: int = 1, report: callable = None) -> dict:
+    results = []
+    spotCache.enabled = False # Every repeat has to run the spot stages, not reuse the mask from the run before
+    with tempfile.TemporaryDirectory() as folder:
+        for case in cases:
+            result = benchmarkCase(case, repeats, folder)
+            results.append(result)
+            if report:
+                report(result)
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "cpus": os.cpu_count(),
+        "repeats": repeats,
+        "cases": results
+    }
+
+def printCase(result: dict) -> None:
+    if "width" in result:
+        print(f"{result['case']} ({result['width']}x{result['height']})", file=sys.stderr)
+    else:
+        print(result["case"], file=sys.stderr)
+    for name, stage in result["stages"].items():
+        if stage.get("error"):
+            print(f"  {name:<40} failed: {stage['error']}", file=sys.stderr)
+        elif stage["peakBytes"] is None:
+            print(f"  {name:<40} {stage['seconds']:8.3f}s", file=sys.stderr)
+        else:
+            print(f"  {name:<40} {stage['seconds']:8.3f}s {stage['peakBytes'] / 2**20:10.1f} MB", file=sys.stderr)
+
+# Steps of starting the program, each one is timed in a new python process (setup runs before the timer starts)
+startupSteps = [
+    ("import window modules", "", "import home, settings, pageHandler, navbar"),
+    ("import program", "", "import program"),
+    ("cacheFunctions compile", "import program", "program.cacheFunctions()"),
+    ("cacheFunctions cached", "import program", "program.cacheFunctions()")
+]
+startupProbe = "import time\n{setup}\nstart = time.perf_counter()\n{code}\nprint(time.perf_counter() - start)"
+
+def runStartupStep(arguments: list, folder: str, cacheFolder: str) -> tuple:
+    # Started in an empty folder with its own numba cache, so neither earlier runs nor data/ change the result.
+    # Returns the wall time of the whole process and its output.
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.dirname(os.path.abspath(__file__))
+    env["NUMBA_CACHE_DIR"] = cacheFolder
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable] + arguments, cwd=folder, env=env, capture_output=True, text=True)
+    return time.perf_counter() - start, process
+
+def timeStartupStep(arguments: list, folder: str, cacheFolder: str, repeats: int, useOutput: bool) -> dict:
+    # Fastest of the runs, the time printed by the process when useOutput is set, otherwise the time until it exited
+    best = None
+    for i in range(repeats):
+        seconds, process = runStartupStep(arguments, folder, cacheFolder)
+        if process.returncode != 0:
+            lines = process.stderr.strip().splitlines()
+            return {"seconds": None, "peakBytes": None, "error": lines[-1] if lines else f"exit code {process.returncode}"}
+        if useOutput:
+            seconds = float(process.stdout.split()[-1])
+        if best is None or seconds < best["seconds"]:
+            best = {"seconds": seconds, "peakBytes": None}
+    return best
+
+def benchmarkStartup(repeats: int = 1) -> dict:
+    # Time until the window can be used and what the background warm up costs, with and without numba's cache
+    stages = dict()
+    with tempfile.TemporaryDirectory() as folder:
+        cacheFolder = os.path.join(folder, "numbacache")
+        stages["start python"] = timeStartupStep(["-c", "pass"], folder, cacheFolder, repeats, False)
+        for name, setup, code in startupSteps:
+            runs = 1 if name == "cacheFunctions compile" else repeats # Compiling fills the cache, so it can only be timed once
+            stages[name] = timeStartupStep(["-c", startupProbe.format(setup=setup, code=code)], folder, cacheFolder, runs, True)
+        # From starting main.py until the window is shown and handles events, including starting python
+        mainPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+        stages["time to interactive"] = timeStartupStep([mainPath, "--exit-when-ready"], folder, cacheFolder, repeats, False)
+    return {"case": "startup", "stages": stages}
+
+# Like the window: the warm up on a daemon thread while two jobs run parallel kernels on their own threads, then
+# the process exits with numba's threads still started from those threads
+threadsProbe = """import threading
+import numpy as np
+import program, handleImage
+def convert():
+    for i in range(20):
+        layers = [np.full((64, 64), i, dtype=np.uint8) for _ in range(5)]
+        handleImage.getWhiteArray(*layers)
+        handleImage.rgbToCmykArray(*layers[:3])
+threading.Thread(target=program.cacheFunctions, daemon=True).start()
+jobs = [threading.Thread(target=convert) for _ in range(2)]
+for job in jobs:
+    job.start()
+for job in jobs:
+    job.join()
+"""
+
+def checkThreadExit(timeout: float = 300) -> str:
+    # Runs parallel kernels from threads other than the main one in a new process and checks that it exits.
+    # Returns why it failed, None when it exited.
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.dirname(os.path.abspath(__file__))
+    try:
+        process = subprocess.run([sys.executable, "-c", threadsProbe], env=env, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return f"didn't exit within {timeout:.0f}s"
+    if process.returncode != 0:
+        lines = process.stderr.strip().splitlines()
+        return lines[-1] if lines else f"exit code {process.returncode}"
+    return None
+
+def findRegressions(current: dict, baseline: dict, tolerance: float) -> list:
+    # Stages that got slower than the baseline by more than the tolerance (0.2 = 20 %)
+    regressions = []
+    baselineCases = {case["case"]: case for case in baseline.get("cases", [])}
+    for case in current["cases"]:
+        old = baselineCases.get(case["case"])
+        if old is None:
+            continue
+        for name, stage in case["stages"].items():
+            oldStage = old["stages"].get(name)
+            if stage["seconds"] is None or not oldStage or not oldStage["seconds"]:
+                continue
+            if stage["seconds"] > oldStage["seconds"] * (1 + tolerance):
+                regressions.append(f"{case['case']} {name}: {oldStage['seconds']:.3f}s -> {stage['seconds']:.3f}s")
+    return regressions
+
+def benchmarkCompression(height: int, width: int, repeats: int = 1) -> list:
+    # Size and write time of the same generated spot TIFF for every compression mode
+    import tifffile
+    inputImage = generateTestImage(height, width)
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        inputName = os.path.join(folder, "input.tif")
+        tifffile.imwrite(inputName, inputImage, photometric='rgb', extrasamples=[2])
+        for compression in ["None"] + list(program.compressionCodecs.keys()):
+            settings = config.SettingsSnapshot.fromDict({"compression": compression})
+            outputName = os.path.join(folder, f"output_{compression}.tif")
+            timing, _ = timeStage(lambda: program.generateSpotImage(inputName, outputName, createPreview=False, settings=settings), repeats)
+            results.append({"compression": compression, "seconds": timing["seconds"], "bytes": os.path.getsize(outputName)})
+    return results
+
+def printCompressionResults(results: list) -> None:
+    uncompressed = results[0]["bytes"]
+    for result in results:
+        ratio = result["bytes"] / uncompressed
+        print(f"{result['compression']:<10} {result['seconds']:8.2f}s {result['bytes'] / 2**20:10.1f} MB {ratio:7.1%}")
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(prog="benchmark", description="Measure the speed and memory use of the spot pipeline stages")
+    parser.add_argument("cases", nargs="*", default=defaultCases, help=f"Sizes to test, any of: {', '.join(allCases)} or 'all' (default: {' '.join(defaultCases)}), 'startup' times starting the program")
+    parser.add_argument("--repeats", type=int, default=3, help="Run each stage this many times and keep the fastest")
+    parser.add_argument("-o", "--output", default=None, help="Write the JSON result to this file instead of stdout")
+    parser.add_argument("--baseline", default=None, help="JSON result of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="How much slower a stage may get before it counts as a regression (default: 0.2)")
+    parser.add_argument("--compression", action="store_true", help="Compare size and write time of every output compression instead")
+    parser.add_argument("--width", type=int, default=4961, help="Width of the test image for --compression (default: A3 at 300 dpi)")
+    parser.add_argument("--height", type=int, default=3508, help="Height of the test image for --compression")
+    parser.add_argument("--check-morphology", action="store_true", help="Only check that the fast morphology gives the same result as OpenCV")
+    parser.add_argument("--check-threads", action="store_true", help="Only check that the program exits after running parallel kernels from several threads")
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    if args.check_morphology:
+        failed = morphology.checkEngines()
+        for operation, radius in failed:
+            print(f"Different from OpenCV: {operation} with radius {radius}", file=sys.stderr)
+        print("Morphology matches OpenCV" if not failed else f"{len(failed)} morphology checks failed")
+        return 4 if failed else 0
+
+    if args.check_threads:
+        error = checkThreadExit()
+        print("Exits after parallel kernels on threads" if error is None else f"Thread check failed: {error}")
+        return 5 if error else 0
+
+    config.setupProgram()
+    program.cacheFunctions()
+    if args.compression:
+        printCompressionResults(benchmarkCompression(args.height, args.width, args.repeats))
+        return 0
+
+    cases = allCases if args.cases == ["all"] else args.cases
+    for case in cases:
+        if case not in allCases and case != "startup":
+            parser.error(f"Unknown case: {case}")
+
+    result = runBenchmarks([case for case in cases if case != "startup"], args.repeats, printCase)
+    if "startup" in cases:
+        startup = benchmarkStartup(args.repeats)
+        printCase(startup)
+        result["cases"].append(startup)
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = findRegressions(result, json.loads(f.read()), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            return 3
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
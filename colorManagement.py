@@ -0,0 +1,192 @@
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from numba import njit, prange
+from PIL import Image, ImageCms
+from diskCache import DiskCache
+from parallelKernels import parallelKernel
+
+intents = {
+    "Perceptual": ImageCms.Intent.PERCEPTUAL,
+    "Relative colorimetric": ImageCms.Intent.RELATIVE_COLORIMETRIC,
+    "Saturation": ImageCms.Intent.SATURATION,
+    "Absolute colorimetric": ImageCms.Intent.ABSOLUTE_COLORIMETRIC
+}
+maxTables = 2 # Lookup tables kept in memory (64 MB each), one per source profile, CMYK profile and intent
+tableWorkers = os.cpu_count() or 1 # littlecms releases the GIL, so the table is filled on every core
+useDisk = True
+cacheFolder = "data/icccache"
+diskBudget = 512 * 2**20 # Bytes of tables kept in cacheFolder, 64 MB each
+cacheVersion = 1 # Change when the way tables are built changes so old tables on disk are not used
+
+tables = OrderedDict()
+tableLock = threading.Lock()
+buildLocks = dict() # One lock per table so two jobs needing the same table build it once
+tablePool = None
+disk = DiskCache(cacheFolder, diskBudget, ".lut")
+
+# littlecms converts 8 bit RGB to CMYK through 16 bit interpolation, about 40 times slower than the plain
+# conversion. Every 8 bit RGB colour is converted once instead and stored in a table of 2^24 packed CMYK values,
+# after that a pixel costs one lookup and the result is exactly what littlecms gives.
+
+@parallelKernel
+@njit(parallel=True, cache=True)
+def tableToCmykPlanes(r: np.ndarray, g: np.ndarray, b: np.ndarray, table: np.ndarray, c: np.ndarray, m: np.ndarray, y: np.ndarray, k: np.ndarray) -> None:
+    for i in prange(r.shape[0]):
+        for j in range(r.shape[1]):
+            value = table[(np.int32(r[i, j]) << 16) | (np.int32(g[i, j]) << 8) | np.int32(b[i, j])]
+            c[i, j], m[i, j], y[i, j], k[i, j] = value & 255, (value >> 8) & 255, (value >> 16) & 255, value >> 24
+
+@parallelKernel
+@njit(parallel=True, cache=True)
+def tableToCmykWhitePlanes(r: np.ndarray, g: np.ndarray, b: np.ndarray, a: np.ndarray, table: np.ndarray, c: np.ndarray, m: np.ndarray, y: np.ndarray, k: np.ndarray, white: np.ndarray) -> None:
+    # Same as handleImage.rgbToCmykWhitePlanes, white pixels are the ones the profile gives no ink
+    for i in prange(r.shape[0]):
+        for j in range(r.shape[1]):
+            value = table[(np.int32(r[i, j]) << 16) | (np.int32(g[i, j]) << 8) | np.int32(b[i, j])]
+            c[i, j], m[i, j], y[i, j], k[i, j] = value & 255, (value >> 8) & 255, (value >> 16) & 255, value >> 24
+            if value == 0:
+                white[i, j] = a[i, j]
+            else:
+                white[i, j] = 0
+
+def getProfileKey(profileBytes: bytes) -> str:
+    if not profileBytes:
+        return "sRGB"
+    return hashlib.blake2b(profileBytes, digest_size=16).hexdigest()
+
+def openSourceProfile(profileBytes: bytes) -> ImageCms.ImageCmsProfile:
+    # The profile embedded in the input, sRGB when there is none or it isn't a usable RGB profile
+    if profileBytes:
+        try:
+            profile = ImageCms.ImageCmsProfile(io.BytesIO(profileBytes))
+            if profile.profile.xcolor_space.strip() == "RGB":
+                return profile
+        except (ImageCms.PyCMSError, OSError, TypeError, ValueError):
+            pass
+    return ImageCms.createProfile("sRGB")
+
+def buildTransform(iccPath: str, intent: str, sourceProfile: bytes) -> ImageCms.ImageCmsTransform:
+    # None when the selected profile is not a CMYK profile, the plain conversion is used then
+    cmykProfile = ImageCms.getOpenProfile(iccPath)
+    if cmykProfile.profile.xcolor_space.strip() != "CMYK":
+        return None
+    renderingIntent = intents.get(intent, ImageCms.Intent.RELATIVE_COLORIMETRIC)
+    flags = ImageCms.Flags.NOCACHE # Every colour is different when filling the table, the one pixel cache never hits
+    if renderingIntent != ImageCms.Intent.ABSOLUTE_COLORIMETRIC:
+        flags |= ImageCms.Flags.BLACKPOINTCOMPENSATION # Same as Photoshop's default, keeps the shadows from clipping
+    return ImageCms.buildTransform(openSourceProfile(sourceProfile), cmykProfile, "RGB", "CMYK", renderingIntent=renderingIntent, flags=flags)
+
+def getPool() -> ThreadPoolExecutor:
+    global tablePool
+    with tableLock:
+        if tablePool is None:
+            tablePool = ThreadPoolExecutor(max_workers=tableWorkers, thread_name_prefix="icc")
+        return tablePool
+
+def buildTable(transform: ImageCms.ImageCmsTransform) -> np.ndarray:
+    # Converts all 2^24 colours, one tile of 65536 colours (every green and blue for one red) per task
+    table = np.empty(1 << 24, dtype=np.uint32)
+    greenBlue = np.arange(1 << 16)
+    tile = np.empty((256, 256, 3), dtype=np.uint8)
+    tile[..., 1] = (greenBlue >> 8).reshape(256, 256)
+    tile[..., 2] = (greenBlue & 255).reshape(256, 256)
+
+    def convertTile(red: int) -> None:
+        rgb = tile.copy()
+        rgb[..., 0] = red
+        cmyk = np.ascontiguousarray(transform.apply(Image.fromarray(rgb)))
+        table[red << 16:(red + 1) << 16] = cmyk.view("<u4").reshape(-1) # Packed as c | m << 8 | y << 16 | k << 24
+
+    list(getPool().map(convertTile, range(256)))
+    return table
+
+def getDiskKey(iccPath: str, intent: str, sourceProfile: bytes) -> str:
+    # Made from the content of both profiles, so a table is found again by every process and after a restart
+    hasher = hashlib.blake2b(digest_size=20)
+    with open(iccPath, "rb") as f:
+        hasher.update(f.read())
+    hasher.update(repr((cacheVersion, intent, getProfileKey(sourceProfile))).encode())
+    return hasher.hexdigest()
+
+def readDisk(diskKey: str) -> np.ndarray:
+    if not useDisk:
+        return None
+    data = disk.read(diskKey)
+    if data is None or len(data) != 4 << 24:
+        return None
+    return np.frombuffer(data, dtype="<u4").copy() # Writable like a built table, so the kernels aren't compiled again
+
+def writeDisk(diskKey: str, table: np.ndarray) -> None:
+    if useDisk and table is not None:
+        disk.write(diskKey, table.astype("<u4", copy=False).tobytes())
+
+def getTable(iccPath: str, intent: str, sourceProfile: bytes = None) -> np.ndarray:
+    # The table is built once per profile pair and intent and shared by every job, a profile replaced on disk
+    # has another time and size and gets a new table. Built tables are also kept in data/icccache, so other
+    # processes (batch and server workers) and later runs only read them. None when the profile can't be used.
+    try:
+        info = os.stat(iccPath)
+    except OSError:
+        return None
+    key = (os.path.abspath(iccPath), info.st_mtime_ns, info.st_size, intent, getProfileKey(sourceProfile))
+    with tableLock:
+        buildLock = buildLocks.setdefault(key, threading.Lock())
+    with buildLock:
+        with tableLock:
+            if key in tables:
+                tables.move_to_end(key)
+                return tables[key]
+        try:
+            diskKey = getDiskKey(iccPath, intent, sourceProfile)
+            table = readDisk(diskKey)
+            if table is None:
+                transform = buildTransform(iccPath, intent, sourceProfile)
+                table = buildTable(transform) if transform is not None else None
+                writeDisk(diskKey, table)
+        except (ImageCms.PyCMSError, OSError) as e:
+            print(f"Could not use the ICC profile {iccPath}: {e}")
+            table = None
+        with tableLock:
+            tables[key] = table
+            while len(tables) > maxTables:
+                oldKey, _ = tables.popitem(last=False)
+                buildLocks.pop(oldKey, None)
+        return table
+
+def getSettingsTable(settings, sourceProfile: bytes = None) -> np.ndarray:
+    # Only CMYK output is converted with the profile, RGB output keeps the image's own colours
+    iccPath = settings.getIccPath()
+    if settings.colorMode != "CMYK" or iccPath is None:
+        return None
+    return getTable(iccPath, settings.iccIntent, sourceProfile)
+
+def rgbToCmykArray(r: np.ndarray, g: np.ndarray, b: np.ndarray, table: np.ndarray) -> tuple:
+    r, g, b = np.asarray(r), np.asarray(g), np.asarray(b)
+    c, m, y, k = [np.empty(r.shape, dtype=np.uint8) for _ in range(4)]
+    tableToCmykPlanes(r, g, b, table, c, m, y, k)
+    return c, m, y, k
+
+def rgbToCmykWhiteArray(r: np.ndarray, g: np.ndarray, b: np.ndarray, a: np.ndarray, table: np.ndarray) -> tuple:
+    r, g, b, a = np.asarray(r), np.asarray(g), np.asarray(b), np.asarray(a)
+    c, m, y, k, white = [np.empty(r.shape, dtype=np.uint8) for _ in range(5)]
+    tableToCmykWhitePlanes(r, g, b, a, table, c, m, y, k, white)
+    return c, m, y, k, white
+
+def cacheFunctions() -> None:
+    # Black pixels only use the first entry, so a one entry table is enough to compile every kind of channel
+    dummyTable = np.zeros(1, dtype=np.uint32)
+    dummyArr = np.zeros((20, 20), dtype=np.uint8)
+    dummyPixels = np.zeros((20, 20, 4), dtype=np.uint8)
+    dummyReadOnly = np.zeros((20, 20, 4), dtype=np.uint8)
+    dummyReadOnly.flags.writeable = False
+    for pixels in (dummyPixels, dummyReadOnly):
+        r, g, b = pixels[..., 0], pixels[..., 1], pixels[..., 2]
+        rgbToCmykArray(r, g, b, dummyTable)
+        rgbToCmykWhiteArray(r, g, b, dummyArr, dummyTable)
+    rgbToCmykArray(dummyArr, dummyArr, dummyArr, dummyTable)
+    rgbToCmykWhiteArray(dummyArr, dummyArr, dummyArr, dummyArr, dummyTable)
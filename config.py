@@ -1,6 +1,75 @@
 import contextlib
 import sqlite3
 import os
+from dataclasses import dataclass, fields, asdict
+
+iccFolder = "data/icc"
+pinnedSettings = None # When set, settings are read from this snapshot instead of the database
+cachedSettings = None # Snapshot of the database, cleared whenever the settings are updated
+
+@dataclass(frozen=True)
+class SettingsSnapshot():
+    # All settings needed for one job, read once so the job never touches the database again.
+    # Immutable and picklable so it can be handed to other threads and worker processes.
+    colorMode: str
+    margin: int
+    marginMode: int
+    alphaspot: bool
+    copywhite: bool
+    fillgaps: bool
+    previewColor: str
+    dpi: int
+    spotLayerName: str
+    spotOffsetX: int
+    spotOffsetY: int
+    iccProfile: str
+    iccIntent: str
+    previewMaxEdge: int
+    compression: str
+    compressionLevel: int
+    epsWidth: int
+    epsHeight: int
+
+    @staticmethod
+    def fromDict(settings: dict) -> "SettingsSnapshot":
+        # Missing settings fall back to the standard values and unknown keys are ignored
+        values = getStandardValues()
+        for key in settings.keys():
+            if key not in values.keys():
+                continue
+            value = settings[key]
+            valueType = str(type(values[key]).__name__)
+            if isinstance(value, str) and valueType != "str":
+                value = convertValue(value, valueType)
+            values[key] = value
+        return SettingsSnapshot(**{field.name: values[field.name] for field in fields(SettingsSnapshot)})
+
+    def asDict(self) -> dict:
+        return asdict(self)
+
+    def replace(self, **changes) -> "SettingsSnapshot":
+        values = self.asDict()
+        values.update(changes)
+        return SettingsSnapshot.fromDict(values)
+
+    def getOffset(self) -> tuple:
+        return (self.spotOffsetX, self.spotOffsetY)
+
+    def getSmartOptions(self) -> tuple:
+        return (self.copywhite, self.fillgaps)
+
+    def getPreviewColor(self) -> list:
+        allPrevColors = getPreviwColors()
+        return allPrevColors.get(self.previewColor, allPrevColors.get(getDefaultPreviewColorKey()))
+
+    def getIccPath(self) -> str:
+        # None without a profile or when the name points outside data/icc (the file is embedded in the output)
+        if self.iccProfile == getStandardValues()["iccProfile"]:
+            return None
+        folder = os.path.realpath(iccFolder)
+        if os.path.dirname(os.path.realpath(os.path.join(folder, self.iccProfile))) != folder:
+            return None
+        return f"{iccFolder}/{self.iccProfile}"
 
 def createDatabase(defaultDict: dict) -> None:
     conn = sqlite3.connect('data/program.db')
@@ -28,6 +97,7 @@ def createDatabase(defaultDict: dict) -> None:
         
     conn.commit()
     conn.close()
+    clearSettingsCache()
     
 def settingExist(name: str) -> bool:
     with contextlib.closing(sqlite3.connect('data/program.db')) as conn:    
@@ -49,10 +119,11 @@ def updateSettings(updateDict: dict) -> None:
             if (settingExist(key)):
                 c.execute("UPDATE settings SET value = ? WHERE setting = ?", (str(updateDict[key]), key))
             else:
-                if key not in getSettingsDict().keys():
-                    continue # Trying to load some old setting or something
+                if not checkIfValidSetting(key):
+                    continue # Trying to load some old setting or something, settings added later get their row here
                 c.execute("INSERT INTO settings (setting, value, type) VALUES (?, ?, ?)", (key, str(updateDict[key]), str(type(getStandardValues()[key]).__name__)))
         conn.commit()
+    clearSettingsCache()
 
 def getPreviwColors() -> dict:
     colors = {
@@ -86,19 +157,32 @@ def getStandardSettingType(setting: str) -> str:
     else:
         raise ValueError("Setting not found")
 
+def clearSettingsCache() -> None:
+    global cachedSettings
+    cachedSettings = None
+
+def pinSettings(settings: "dict|SettingsSnapshot|None") -> None:
+    # Use a fixed set of settings (for example in batch worker processes) until unpinned with None
+    global pinnedSettings
+    if settings is None or isinstance(settings, SettingsSnapshot):
+        pinnedSettings = settings
+    else:
+        pinnedSettings = SettingsSnapshot.fromDict(settings)
+
+def getSnapshot() -> SettingsSnapshot:
+    global cachedSettings
+    if pinnedSettings is not None:
+        return pinnedSettings
+    snapshot = cachedSettings
+    if snapshot is None:
+        snapshot = SettingsSnapshot.fromDict(getSettingsDict())
+        cachedSettings = snapshot
+    return snapshot
+
 def getSetting(setting: str) -> bool|int|str:
     if not (checkIfValidSetting(setting)):
         raise ValueError("Setting not found")
-    
-    with contextlib.closing(sqlite3.connect('data/program.db')) as conn:
-        c = conn.cursor()
-        c.execute("SELECT value, type FROM settings WHERE setting = ?", (setting,))
-        try:
-            row = c.fetchone()
-            return convertValue(row[0], row[1])
-        except:
-            pass
-        return getStandardValues()[setting]
+    return getattr(getSnapshot(), setting)
 
 def getSettingsDict() -> dict:
     result = dict()
@@ -131,21 +215,24 @@ def getStandardValues() -> dict:
         "spotLayerName": "Spot_1",
         "spotOffsetX": 0,
         "spotOffsetY": 0,
-        "iccProfile": "None"
+        "iccProfile": "None",
+        "iccIntent": "Relative colorimetric",
+        "previewMaxEdge": 2048,
+        "compression": "None",
+        "compressionLevel": 0,
+        "epsWidth": 0,
+        "epsHeight": 0
     }    
     
 def getIccProfiles() -> list:
     iccs = list()
-    for file in os.listdir("data/icc"):
+    for file in os.listdir(iccFolder):
         if (file.endswith(".icc")):
             iccs.append(file)
     return iccs
 
 def getSelectedIcc() -> str:
-    currentIcc = getSetting("iccProfile")
-    if currentIcc == getStandardValues()["iccProfile"]:
-        return None
-    return "data/icc/" + currentIcc
+    return getSnapshot().getIccPath()
 
 def setSelectedPreset(name: str):
     with contextlib.closing(sqlite3.connect('data/program.db')) as conn:    
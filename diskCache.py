@@ -0,0 +1,109 @@
+import hashlib
+import os
+import threading
+
+checksumSize = 32
+
+class DiskCache():
+    # Files in a folder limited to budget bytes, the least recently used ones are removed first.
+    # Every file starts with a checksum of its content so damaged files are found (and removed) when read.
+    # Files are written through a temp file, so other processes sharing the folder never see half a file.
+    def __init__(self, folder: str, budget: int, extension: str):
+        self.folder = folder
+        self.budget = budget
+        self.extension = extension
+        self.lock = threading.Lock()
+        self.usedBytes = None # Counted the first time something is written
+        self.stats = {"hits": 0, "misses": 0, "damaged": 0, "evictions": 0}
+
+    def getPath(self, key: str) -> str:
+        return os.path.join(self.folder, key + self.extension)
+
+    def read(self, key: str) -> bytes:
+        path = self.getPath(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path) # Mark as recently used
+        except OSError:
+            self.count("misses")
+            return None
+        checksum, content = data[:checksumSize], data[checksumSize:]
+        if hashlib.blake2b(content, digest_size=checksumSize).digest() != checksum:
+            self.count("damaged")
+            self.count("misses")
+            self.remove(path)
+            return None
+        self.count("hits")
+        return content
+
+    def write(self, key: str, content: bytes) -> None:
+        if len(content) + checksumSize > self.budget:
+            return
+        path = self.getPath(key)
+        tempPath = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            with open(tempPath, "wb") as f:
+                f.write(hashlib.blake2b(content, digest_size=checksumSize).digest())
+                f.write(content)
+            os.replace(tempPath, path)
+        except OSError:
+            self.remove(tempPath)
+            return
+        with self.lock:
+            if self.usedBytes is None:
+                self.usedBytes = self.countBytes()
+            else:
+                self.usedBytes += len(content) + checksumSize
+            if self.usedBytes > self.budget:
+                self.evict()
+
+    def getEntries(self) -> list:
+        entries = []
+        if not os.path.isdir(self.folder):
+            return entries
+        with os.scandir(self.folder) as found:
+            for entry in found:
+                if entry.name.endswith(self.extension):
+                    try:
+                        info = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((info.st_mtime, info.st_size, entry.path))
+        return entries
+
+    def countBytes(self) -> int:
+        return sum(entry[1] for entry in self.getEntries())
+
+    def evict(self) -> None:
+        # Remove the least recently used files until the cache is at 3/4 of its budget
+        entries = sorted(self.getEntries())
+        self.usedBytes = sum(entry[1] for entry in entries)
+        for mtime, size, path in entries:
+            if self.usedBytes <= self.budget * 3 // 4:
+                break
+            if self.remove(path):
+                self.usedBytes -= size
+                self.stats["evictions"] += 1
+
+    def remove(self, path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def clear(self) -> None:
+        with self.lock:
+            for mtime, size, path in self.getEntries():
+                self.remove(path)
+            self.usedBytes = 0
+
+    def count(self, stat: str) -> None:
+        with self.lock:
+            self.stats[stat] += 1
+
+    def getStats(self) -> dict:
+        with self.lock:
+            return dict(self.stats)
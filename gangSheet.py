@@ -0,0 +1,234 @@
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import batch
+import config
+import handleImage
+import handleTiles
+import instrumentation
+import program
+
+defaultRollWidth = 600 # mm, the most common DTF film width
+defaultSpacing = 5 # mm between two designs
+designWorkers = 4 # Designs converted at the same time, numba and OpenCV already use every core inside one
+
+class SheetDesign():
+    # One design on the sheet, cut to the part that isn't transparent. Its spot is computed on its own, exactly as
+    # when it's converted alone. x and y are the top left corner on the sheet in pixels, None until it's packed.
+    def __init__(self, inputName: str, x: int = None, y: int = None):
+        self.inputName = inputName
+        self.x = x
+        self.y = y
+        self.layers = None # c, m, y, k and alpha
+        self.spot = None
+        self.spotTop = 0
+        self.spotLeft = 0
+        self.height = 0 # Size on the sheet, with room for the spot offset like a single output
+        self.width = 0
+
+    def isPlaced(self) -> bool:
+        return self.x is not None and self.y is not None
+
+    def load(self, settings: config.SettingsSnapshot) -> None:
+        white = None
+        if settings.copywhite:
+            c, m, y, k, alphaChannel, white = handleImage.splitImageToCmyk(self.inputName, withWhite=True, settings=settings)
+        else:
+            c, m, y, k, alphaChannel = handleImage.splitImageToCmyk(self.inputName, settings=settings)
+        c, m, y, k, alphaChannel = [np.asarray(layer) for layer in (c, m, y, k, alphaChannel)]
+        bounds = program.getAlphaBounds(alphaChannel)
+        if bounds is None:
+            raise ValueError(f"{self.inputName} is completely transparent")
+        top, bottom, left, right = bounds
+        spot, spotTop, spotLeft = program.computeSpotRegion(c, m, y, k, alphaChannel, settings, white)
+        spotBounds = program.getAlphaBounds(spot)
+        if spotBounds is not None:
+            # The blur can take the spot a pixel or two past the design, it's kept whole
+            spot = spot[spotBounds[0]:spotBounds[1], spotBounds[2]:spotBounds[3]]
+            spotTop, spotLeft = spotTop + spotBounds[0], spotLeft + spotBounds[2]
+            top, bottom = min(top, spotTop), max(bottom, spotTop + spot.shape[0])
+            left, right = min(left, spotLeft), max(right, spotLeft + spot.shape[1])
+        else:
+            spot, spotTop, spotLeft = np.zeros((0, 0), dtype=np.uint8), top, left
+        self.layers = [np.ascontiguousarray(layer[top:bottom, left:right]) for layer in (c, m, y, k, alphaChannel)] # Copied so the rest of the image is freed
+        self.spot, self.spotTop, self.spotLeft = spot, spotTop - top, spotLeft - left
+        offsetX, offsetY = settings.getOffset()
+        self.height, self.width = bottom - top + 2 * abs(offsetY), right - left + 2 * abs(offsetX)
+
+def mmToPixels(mm: float, dpi: int) -> int:
+    return int(round(mm * dpi / 25.4))
+
+def findPosition(skyline: list, width: int, rollWidth: int) -> tuple:
+    # Lowest (then leftmost) place along the skyline where width fits, None if it's wider than the roll
+    best = None
+    for index, (x, _, _) in enumerate(skyline):
+        if x + width > rollWidth:
+            break
+        top = 0
+        for segmentX, segmentWidth, segmentY in skyline[index:]:
+            if segmentX >= x + width:
+                break
+            top = max(top, segmentY)
+        if best is None or (top, x) < best:
+            best = (top, x)
+    if best is None:
+        return None
+    return best[1], best[0]
+
+def raiseSkyline(skyline: list, x: int, width: int, y: int) -> list:
+    # The skyline after a design covering x..x + width up to y was placed
+    end = x + width
+    raised = []
+    for segmentX, segmentWidth, segmentY in skyline:
+        segmentEnd = segmentX + segmentWidth
+        if segmentEnd <= x or segmentX >= end:
+            raised.append((segmentX, segmentWidth, segmentY))
+            continue
+        if segmentX < x:
+            raised.append((segmentX, x - segmentX, segmentY))
+        overlapStart, overlapEnd = max(segmentX, x), min(segmentEnd, end)
+        raised.append((overlapStart, overlapEnd - overlapStart, max(segmentY, y)))
+        if segmentEnd > end:
+            raised.append((end, segmentEnd - end, segmentY))
+    merged = []
+    for segment in raised:
+        if merged and merged[-1][2] == segment[2]:
+            merged[-1] = (merged[-1][0], merged[-1][1] + segment[1], segment[2])
+        else:
+            merged.append(segment)
+    return merged
+
+def packDesigns(designs: list, rollWidth: int, spacing: int = 0) -> None:
+    # Skyline packing: the skyline is the lower edge of everything placed so far, split in parts of the same height.
+    # The tallest designs go first, each one where it ends up highest on the sheet (leftmost when equal).
+    # Designs placed by hand stay where they are and the others are packed around and below them.
+    # Every design takes spacing extra to the right and below, the roll is as much wider so the last one doesn't need it.
+    skyline = [(0, rollWidth + spacing, 0)] # (x, width, y)
+    for design in designs:
+        if design.isPlaced():
+            skyline = raiseSkyline(skyline, design.x, design.width + spacing, design.y + design.height + spacing)
+    for design in sorted([design for design in designs if not design.isPlaced()], key=lambda design: (-design.height, -design.width)):
+        position = findPosition(skyline, design.width + spacing, rollWidth + spacing)
+        if position is None:
+            raise ValueError(f"{design.inputName} is {design.width} px wide and doesn't fit on a {rollWidth} px roll")
+        design.x, design.y = position
+        skyline = raiseSkyline(skyline, design.x, design.width + spacing, design.y + design.height + spacing)
+
+def assembleSheetStrip(designs: list, generator: program.TiffGenerator, stripTop: int, rows: int, sheetWidth: int, preview: handleTiles.PreviewCollector = None) -> np.ndarray:
+    # One strip of the sheet, every design crossing it is placed straight into it. Only the pixels of a design
+    # (alpha or spot) are drawn, so designs placed by hand may overlap each other's empty corners.
+    offsetX, offsetY = generator.settings.getOffset()
+    padX, padY = abs(offsetX), abs(offsetY)
+    c, m, y, k, alphaChannel, spot = [np.zeros((rows, sheetWidth), dtype=np.uint8) for _ in range(6)]
+    for design in designs:
+        if design.y >= stripTop + rows or design.y + design.height <= stripTop:
+            continue
+        layerStart = stripTop - design.y - padY
+        parts = [handleTiles.placeRows(layer, 0, layerStart, rows, padX, design.width) for layer in design.layers]
+        parts.append(handleTiles.placeRows(design.spot, design.spotTop, layerStart - offsetY, rows, padX + offsetX + design.spotLeft, design.width))
+        drawn = (parts[4] > 0) | (parts[5] > 0)
+        for layer, part in zip((c, m, y, k, alphaChannel, spot), parts):
+            np.copyto(layer[:, design.x:design.x + design.width], part, where=drawn)
+
+    if preview is not None:
+        preview.add(stripTop, c, m, y, k, np.maximum(alphaChannel, spot), spot)
+
+    return np.stack(generator.generateLayerList(c, m, y, k, alphaChannel, program.invertChannel(spot)), axis=-1)
+
+def generateGangSheet(designs: list, outputName: str, rollWidth: int, spacing: int = 0, settings: config.SettingsSnapshot = None, workers: int = designWorkers, createPreview: bool = False) -> tuple:
+    # Puts every design on one sheet rollWidth pixels wide and writes it as one spot TIFF. The sheet is written
+    # strip by strip, only the designs themselves are kept in memory. Returns the height and width of the sheet.
+    if settings is None:
+        settings = config.getSnapshot() # Read the settings once for the whole sheet
+    if len(designs) == 0:
+        raise ValueError("No designs to put on the sheet")
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(designs)))) as pool:
+        list(pool.map(lambda design: design.load(settings), designs))
+    for design in designs:
+        if design.isPlaced() and (design.x < 0 or design.y < 0 or design.x + design.width > rollWidth):
+            raise ValueError(f"{design.inputName} at {design.x}, {design.y} doesn't fit on a {rollWidth} px roll")
+    packDesigns(designs, rollWidth, spacing)
+
+    height = max(design.y + design.height for design in designs)
+    generator = program.getTiffGenerator(settings)
+    compression = program.getCompressionOptions(settings, rollWidth * generator.getLayerCount())
+    stripRows = compression.get("rowsperstrip", handleTiles.stripRows)
+    preview = handleTiles.PreviewCollector(program.getPreviewStep(height, rollWidth, settings.previewMaxEdge)) if createPreview else None
+    orderedDesigns = sorted(designs, key=lambda design: design.y)
+
+    def generateStrips():
+        for stripTop in range(0, height, stripRows):
+            instrumentation.progress(stripTop / height)
+            rows = min(stripRows, height - stripTop)
+            crossing = [design for design in orderedDesigns if design.y < stripTop + rows and design.y + design.height > stripTop]
+            with instrumentation.stage("assembleStrip", (rows, rollWidth)):
+                strip = assembleSheetStrip(crossing, generator, stripTop, rows, rollWidth, preview)
+            yield strip
+
+    with instrumentation.stage("write", (height, rollWidth)):
+        generator.writeStrips(outputName, generateStrips(), height, rollWidth, stripRows, compression)
+
+    if preview is not None:
+        c, m, y, k, alphaPatch, spotOffset = preview.getLayers()
+        with instrumentation.stage("generateSpotPreview", spotOffset.shape):
+            program.generateSpotPreview(c, m, y, k, alphaPatch, program.invertChannel(spotOffset), settings.getPreviewColor())
+    return height, rollWidth
+
+def parseDesign(argument: str, dpi: int) -> SheetDesign:
+    # "design.png@x,y" places the design by hand (mm from the top left corner of the sheet)
+    path, separator, position = argument.rpartition("@")
+    if separator and not os.path.exists(argument):
+        try:
+            x, y = [float(value) for value in position.split(",")]
+            return SheetDesign(path, mmToPixels(x, dpi), mmToPixels(y, dpi))
+        except ValueError:
+            pass
+    return SheetDesign(argument)
+
+def collectDesigns(arguments: list, dpi: int, recursive: bool = False) -> list:
+    designs = []
+    for argument in arguments:
+        design = parseDesign(argument, dpi)
+        if design.isPlaced():
+            designs.append(design)
+        else:
+            designs.extend(SheetDesign(inputName) for inputName in batch.collectInputs([argument], recursive))
+    return designs
+
+def parseArgs(argv: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="gangSheet", description="Put many designs on one gang sheet with a spot layer")
+    parser.add_argument("paths", nargs="+", help="Image files or folders with images (TIFF, PNG or EPS), add @x,y (mm) to a file to place it by hand")
+    parser.add_argument("-o", "--output", required=True, help="File to write the sheet to")
+    parser.add_argument("-w", "--width", type=float, default=defaultRollWidth, help=f"Width of the roll in mm (default: {defaultRollWidth})")
+    parser.add_argument("-s", "--spacing", type=float, default=defaultSpacing, help=f"Space between the designs in mm (default: {defaultSpacing})")
+    parser.add_argument("-p", "--preset", default=None, help="Name of a preset in data/presets to use instead of the current settings")
+    parser.add_argument("-r", "--recursive", action="store_true", help="Also look for images in subfolders")
+    parser.add_argument("-j", "--workers", type=int, default=designWorkers, help=f"Number of designs to convert at the same time, 0 uses one per CPU core (default: {designWorkers})")
+    return parser.parse_args(argv)
+
+def main(argv: list = None) -> int:
+    args = parseArgs(sys.argv[1:] if argv is None else argv)
+    config.setupProgram()
+    settings = batch.captureSettings(args.preset)
+
+    designs = collectDesigns(args.paths, settings.dpi, args.recursive)
+    if len(designs) == 0:
+        print("No images found")
+        return 1
+
+    start = time.perf_counter()
+    try:
+        height, width = generateGangSheet(designs, args.output, mmToPixels(args.width, settings.dpi), mmToPixels(args.spacing, settings.dpi), settings, batch.getWorkerCount(args.workers))
+    except Exception as e:
+        print(f"FAILED: {type(e).__name__}: {e}")
+        return 2
+    for design in designs:
+        print(f"{design.inputName} at {design.x * 25.4 / settings.dpi:.1f}, {design.y * 25.4 / settings.dpi:.1f} mm")
+    print(f"{len(designs)} designs on a {width * 25.4 / settings.dpi:.0f} x {height * 25.4 / settings.dpi:.0f} mm sheet in {time.perf_counter() - start:.2f}s -> {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,26 @@
 from popupFrame import PopupFrame
+import hashlib
+import io
+import subprocess
+import sys
 import threading
+from concurrent.futures import ThreadPoolExecutor, Future
 import config
 import customtkinter
 import os
 from PIL import Image, EpsImagePlugin
+from diskCache import DiskCache
+import instrumentation
 
 baseApp = None
+appClosed = threading.Event() # Set when the window closes, jobs waiting for a popup stop waiting
+popupPollMs = 100 # How often a job waiting for the popup checks whether it was cancelled
+rasterizeWorkers = os.cpu_count() or 1 # Ghostscript runs in its own process, so this many EPS files can render at the same time
+rasterizePool = None
+pendingRasters = dict() # Rasterizations started ahead of time, (path, size) -> Future
+pendingLock = threading.Lock()
+useRasterCache = True # Keep rendered EPS files in data/epscache, so changing spot settings doesn't run Ghostscript again
+rasterCache = DiskCache("data/epscache", 2**30, ".png")
 
 def ghostScriptInstalled():
     if os.path.exists("data/gswin64c.exe") and os.path.exists("data/gsdll64.lib") and os.path.exists("data/gsdll64.dll"):
@@ -20,11 +35,130 @@ def mm2px(mm, dpi) -> float:
     inch = 25.4
     return float(mm) * float(dpi) / inch
 
+def getGhostScriptBinary() -> str:
+    if os.path.exists("data/gswin64c.exe"):
+        return os.path.abspath("data/gswin64c.exe")
+    if not EpsImagePlugin.has_ghostscript():
+        raise OSError("Unable to locate Ghostscript on paths")
+    return EpsImagePlugin.gs_binary
+
+def getBoundingBox(filepath: str) -> tuple:
+    # Bounding box of the EPS in points, only the header is read
+    with Image.open(filepath) as img:
+        length, bbox = img.tile[0][-1]
+        return tuple(bbox)
+
+def getTargetSize(filepath: str, widthMm: float = 0, heightMm: float = 0, dpi: int = 300) -> tuple:
+    # Size in pixels to render the EPS at. With only one side given the other one keeps the proportions,
+    # with none the size stored in the EPS is used.
+    bbox = getBoundingBox(filepath)
+    widthPt, heightPt = bbox[2] - bbox[0], bbox[3] - bbox[1]
+    if widthMm > 0 and heightMm > 0:
+        width, height = mm2px(widthMm, dpi), mm2px(heightMm, dpi)
+    elif widthMm > 0:
+        width = int(mm2px(widthMm, dpi))
+        height = heightPt * width / widthPt
+    elif heightMm > 0:
+        height = int(mm2px(heightMm, dpi))
+        width = widthPt * height / heightPt
+    else:
+        width, height = widthPt * dpi / 72, heightPt * dpi / 72
+    return max(1, int(width)), max(1, int(height))
+
+def getRasterKey(filepath: str, size: tuple) -> str:
+    # The render only depends on the content of the EPS and the size in pixels (the dpi is part of the size)
+    hasher = hashlib.blake2b(digest_size=20)
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(block)
+    hasher.update(repr(("pngalpha", size)).encode())
+    return hasher.hexdigest()
+
+def rasterizeEps(filepath: str, size: tuple) -> Image.Image:
+    key = None
+    if useRasterCache:
+        key = getRasterKey(filepath, size)
+        data = rasterCache.read(key)
+        if data is not None:
+            img = Image.open(io.BytesIO(data))
+            img.load()
+            return img
+    data = runGhostScript(filepath, size)
+    if key is not None:
+        rasterCache.write(key, data)
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    return img
+
+def runGhostScript(filepath: str, size: tuple) -> bytes:
+    # Let Ghostscript render the EPS straight at the final size (no resampling afterwards) and return
+    # the PNG from its output, so no temp files are needed and several renders can run at once
+    bbox = getBoundingBox(filepath)
+    width, height = size
+    resX = 72.0 * width / (bbox[2] - bbox[0])
+    resY = 72.0 * height / (bbox[3] - bbox[1])
+    command = [
+        getGhostScriptBinary(),
+        "-q",
+        f"-g{width:d}x{height:d}",
+        f"-r{resX:f}x{resY:f}",
+        "-dBATCH",
+        "-dNOPAUSE",
+        "-dSAFER",
+        "-sDEVICE=pngalpha",
+        "-sOutputFile=%stdout",
+        "-sstdout=%stderr", # Messages from the EPS must not end up in the image data
+        "-c", f"{-bbox[0]} {-bbox[1]} translate",
+        "-f", os.path.abspath(filepath),
+        "-c", "showpage"
+    ]
+    startupinfo = None
+    if sys.platform.startswith("win"):
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW # Don't flash a console window
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, startupinfo=startupinfo)
+    if result.returncode != 0 or len(result.stdout) == 0:
+        raise ValueError(f"EPS convertion failed: {result.stderr.decode(errors='replace').strip()}")
+    return result.stdout
+
+def rasterizeAsync(filepath: str, size: tuple) -> Future:
+    # Start rendering in the background, getRaster picks up the result
+    global rasterizePool
+    key = (os.path.abspath(filepath), size)
+    with pendingLock:
+        future = pendingRasters.get(key)
+        if future is None:
+            if rasterizePool is None:
+                rasterizePool = ThreadPoolExecutor(max_workers=rasterizeWorkers)
+            future = rasterizePool.submit(rasterizeEps, filepath, size)
+            pendingRasters[key] = future
+    return future
+
+def getRaster(filepath: str, size: tuple) -> Image.Image:
+    # Waits for the render started by rasterizeAsync, or starts it now
+    future = rasterizeAsync(filepath, size)
+    try:
+        return future.result()
+    finally:
+        with pendingLock:
+            pendingRasters.pop((os.path.abspath(filepath), size), None)
+
+def getEpsImage(filepath: str, settings: config.SettingsSnapshot = None) -> Image.Image:
+    # In the program window the size is asked for with the import popup, otherwise (batch) it is taken
+    # from the epsWidth/epsHeight settings
+    if settings is None:
+        settings = config.getSnapshot()
+    if baseApp is not None:
+        size = HandleEPS(filepath, settings).open()
+        if size is None:
+            raise ValueError("EPS import was cancelled")
+    else:
+        size = getTargetSize(filepath, settings.epsWidth, settings.epsHeight, settings.dpi)
+    return getRaster(filepath, size)
+
 class HandleEPS(object):
-    __tempFilename = "data/temp_eps.png"
     __filepath = ""
-    __dpi = None
-    __failed = False
+    __size = None
     
     def __loadGhostScript(self) -> None:
         if not ghostScriptInstalled():
@@ -34,63 +168,83 @@ class HandleEPS(object):
             EpsImagePlugin.gs_windows_binary =  os.path.abspath("data/gswin64c")
 
     
-    def __init__(self, filepath):
+    def __init__(self, filepath, settings: config.SettingsSnapshot = None):
         self.__loadGhostScript()
-        self.__dpi = config.getSetting("dpi")
+        self.__settings = settings if settings is not None else config.getSnapshot()
         self.__filepath = filepath
+        self.__closed = threading.Event()
+        self.__cancelled = threading.Event()
+        self.__error = None
         
-    def __convertToPng(self) -> None:
-        dpi = self.__dpi
-        
+    def __importSize(self) -> None:
+        dpi = self.__settings.dpi
         size = self.popup.getSize()
-        img = self.popup.getImage()
-        
-        target_width = int(mm2px(size['w'].get(), dpi))
+        widthMm = float(size['w'].get().replace(",", ".") or 0)
+        heightMm = float(size['h'].get().replace(",", ".") or 0)
         if (self.popup.imageProportional()):
-            scale_factor = target_width / img.size[0]
-            target_height = int(img.size[1] * scale_factor)
-        else:
-            target_height = int(mm2px(size['h'].get(), dpi))
+            heightMm = 0
+        self.__size = getTargetSize(self.__filepath, widthMm, heightMm, dpi)
+        rasterizeAsync(self.__filepath, self.__size) # Start rendering while the popup closes
+        self.__close()
 
-        # Ensure image is in RGBA mode to preserve alpha channel
-        if img.mode != "RGBA":
-            img_for_resize = img.convert("RGBA") if "A" in img.getbands() or img.mode in ("LA", "PA") else img
-        else:
-            img_for_resize = img
-        
-        im = img_for_resize.resize((target_width, target_height))
+    def __close(self) -> None:
+        self.popup.close()
+        self.__closed.set()
+
+    def __createPopup(self) -> None:
+        self.popup = EpsPopup(baseApp, self.__filepath, self.__importSize, self.__settings)
+        self.popup.protocol("WM_DELETE_WINDOW", self.__close)
 
-        # Try save
+    def __createPopupForThread(self) -> None:
+        # Runs on the main thread for a job on another thread, which waits for __closed. When the popup can't be
+        # made (a bad bounding box) the error is handed to that thread instead of leaving it waiting forever.
+        if self.__cancelled.is_set():
+            return
         try:
-            im.save(self.__tempFilename, format="PNG", dpi=(dpi, dpi))
-            self.__failed = False
-        except:
-            self.__failed = True
-        self.popup.close()
-        
-    def convertNotFailed(self) -> bool:
-        return not self.__failed
+            self.__createPopup()
+        except Exception as e:
+            self.__error = e
+            self.__closed.set()
+            return
+        self.popup.after(popupPollMs, self.__closeWhenCancelled)
 
-    def isClosed(self) -> bool:
-        return self.popup.isClosed()
+    def __closeWhenCancelled(self) -> None:
+        # The popup is closed on the main thread when the job waiting for it was cancelled
+        if self.__closed.is_set():
+            return
+        if self.__cancelled.is_set():
+            self.__close()
+        else:
+            self.popup.after(popupPollMs, self.__closeWhenCancelled)
 
-    def getOutputFilename(self) -> str:
-        return self.__tempFilename
-    
-    def open(self) -> None:
-        # Create the GUI
-        self.popup = EpsPopup(baseApp, self.__filepath, self.__convertToPng)
-        self.popup.waitUntilClosed()
+    def __waitForThread(self) -> None:
+        # Stops waiting when the window is closed or the job is cancelled (instrumentation's listener raises
+        # JobCancelled), the popup may never be made once the main loop has stopped
+        while not self.__closed.wait(popupPollMs / 1000):
+            if appClosed.is_set():
+                self.__cancelled.set()
+                return
+            try:
+                instrumentation.checkStop()
+            except Exception:
+                self.__cancelled.set()
+                raise
+
+    def open(self) -> tuple:
+        # Show the popup and wait for it. Returns the size to render at or None if it was closed without importing.
+        if threading.current_thread() is threading.main_thread():
+            self.__createPopup()
+            self.popup.waitUntilClosed()
+        else:
+            # Windows can only be made on the main thread
+            baseApp.after(0, self.__createPopupForThread)
+            self.__waitForThread()
+            if self.__error is not None:
+                raise self.__error
+        return self.__size
 
 class EpsPopup(PopupFrame):
-    __sizeCallbacks = {"h": None, "w": None}
     __dpi = 300
-    __rememberedAppChildren = dict()
-    __size = {"h" : 0, "w" : 0}
-    __imgSetting = {
-        "keepProportional": True,
-        "lastChanged": "h" # Refering to the lates dimension that was changed om image ( height (h) or width (w) )
-    }
         
     def __validate_int(self, text) -> bool:
         return text.replace(",",".").replace(".", "").isdigit() or text == ""
@@ -104,9 +258,6 @@ class EpsPopup(PopupFrame):
     def getSize(self) -> int:
         return self.__size
     
-    def getImage(self) -> Image:
-        return self.__img
-    
     def imageProportional(self) -> bool:
         return self.__imgSetting["keepProportional"]
     
@@ -137,8 +288,8 @@ class EpsPopup(PopupFrame):
             dim_target = int(mm2px(self.__size[dim].get(), self.__dpi))
         if (self.__imgSetting['keepProportional']):
             
-            scale_factor = dim_target / self.__img.size[dimIndex]
-            dim_inv_target = int(self.__img.size[dimIndexInv] * scale_factor)
+            scale_factor = dim_target / self.__pixelSize[dimIndex]
+            dim_inv_target = int(self.__pixelSize[dimIndexInv] * scale_factor)
             
             # Remove trace, update size and re-enable trace 
             self.__size[dimInv].trace_remove("write", self.__sizeCallbacks[dimInv])
@@ -152,10 +303,18 @@ class EpsPopup(PopupFrame):
     def __updateWidth(self, *args) -> None:
         self.__updateDimension("w", 0, self.__updateHeight)
     
-    def __init__(self, parent, filepath, convertFunction):
+    def __init__(self, parent, filepath, convertFunction, settings: config.SettingsSnapshot = None):
+        # Per popup, the job queue can show two at once
+        self.__sizeCallbacks = {"h": None, "w": None}
+        self.__rememberedAppChildren = dict()
+        self.__imgSetting = {
+            "keepProportional": True,
+            "lastChanged": "h" # Refering to the lates dimension that was changed om image ( height (h) or width (w) )
+        }
         super().__init__(parent=parent, title="Import EPS", size="350x200")
         vcmd = self.register(self.__validate_int)
-        self.__dpi = config.getSetting("dpi")
+        settings = settings if settings is not None else config.getSnapshot()
+        self.__dpi = settings.dpi
         self.__size = {"h" : customtkinter.StringVar(), "w" : customtkinter.StringVar()}
 
         # Labels
@@ -177,12 +336,13 @@ class EpsPopup(PopupFrame):
         propBtn.grid(row=7, column=1, padx=10, pady=0)
         self.rememberElement("proportional", propBtn)
         
-        self.__img = Image.open(filepath)
-        self.__img.load(scale=(self.__dpi)/72, transparency=True)
+        # Only the size is needed here, the EPS is rendered once at the chosen size after importing
+        self.__pixelSize = getTargetSize(filepath, 0, 0, self.__dpi)
+        startSize = getTargetSize(filepath, settings.epsWidth, settings.epsHeight, self.__dpi)
         
         # Set values
-        self.__size['h'].set(round(px2mm(self.__img.size[1], self.__dpi), 2))
-        self.__size['w'].set(round(px2mm(self.__img.size[0], self.__dpi),2))
+        self.__size['h'].set(round(px2mm(startSize[1], self.__dpi), 2))
+        self.__size['w'].set(round(px2mm(startSize[0], self.__dpi),2))
         
         # Add tracking of fields
         self.__sizeCallbacks['h'] = self.__size['h'].trace_add("write", self.__updateHeight)
@@ -1,13 +1,13 @@
-import os
-import time
 import PIL
 import numpy as np
 import tifffile
-from handleEPS import HandleEPS
+from numba import njit, prange
+import colorManagement
+import handleEPS
+import instrumentation
+from parallelKernels import parallelKernel
 
-# EPS "flag" and the temp filename
-usedEPS = False
-epsOutputName = None
+memoryMapTiffs = True # Map uncompressed TIFFs into memory instead of reading (and writing) them in full
 
 def getScales() -> tuple:
     # Constants for scaling, these can be adjusted based on the desired output range
@@ -15,38 +15,73 @@ def getScales() -> tuple:
     cmykScale = 255.0
     return rgbScale, cmykScale
 
+@njit(inline='always', cache=True)
+def pixelToCmyk(r, g, b) -> tuple:
+    # Same float32 steps as the numpy version used before so the result is bit-identical
+    one = np.float32(1.0)
+    scale = np.float32(255.0)
+    c = one - np.float32(r) / scale
+    m = one - np.float32(g) / scale
+    y = one - np.float32(b) / scale
+    k = min(c, m, y)
+    if k < one:
+        c = (c - k) / (one - k)
+        m = (m - k) / (one - k)
+        y = (y - k) / (one - k)
+    else:
+        c = m = y = np.float32(0.0)
+    return np.uint8(c * scale), np.uint8(m * scale), np.uint8(y * scale), np.uint8(k * scale)
+
+@parallelKernel
+@njit(parallel=True, cache=True)
+def rgbToCmykPlanes(r: np.ndarray, g: np.ndarray, b: np.ndarray, c: np.ndarray, m: np.ndarray, y: np.ndarray, k: np.ndarray) -> None:
+    for i in prange(r.shape[0]):
+        for j in range(r.shape[1]):
+            c[i, j], m[i, j], y[i, j], k[i, j] = pixelToCmyk(r[i, j], g[i, j], b[i, j])
+
+@parallelKernel
+@njit(parallel=True, cache=True)
+def rgbToCmykWhitePlanes(r: np.ndarray, g: np.ndarray, b: np.ndarray, a: np.ndarray, c: np.ndarray, m: np.ndarray, y: np.ndarray, k: np.ndarray, white: np.ndarray) -> None:
+    # Converts to CMYK and marks white pixels (no ink at all) with their alpha value in the same pass
+    for i in prange(r.shape[0]):
+        for j in range(r.shape[1]):
+            cv, mv, yv, kv = pixelToCmyk(r[i, j], g[i, j], b[i, j])
+            c[i, j], m[i, j], y[i, j], k[i, j] = cv, mv, yv, kv
+            if cv == 0 and mv == 0 and yv == 0 and kv == 0:
+                white[i, j] = a[i, j]
+            else:
+                white[i, j] = 0
+
+@parallelKernel
+@njit(parallel=True, cache=True)
+def cmykWhitePlane(c: np.ndarray, m: np.ndarray, y: np.ndarray, k: np.ndarray, a: np.ndarray, white: np.ndarray) -> None:
+    for i in prange(c.shape[0]):
+        for j in range(c.shape[1]):
+            if c[i, j] == 0 and m[i, j] == 0 and y[i, j] == 0 and k[i, j] == 0:
+                white[i, j] = a[i, j]
+            else:
+                white[i, j] = 0
+
+def emptyPlanes(shape: tuple, count: int) -> list:
+    return [np.empty(shape, dtype=np.uint8) for i in range(count)]
+
 def rgbToCmykArray(r: np.ndarray, g: np.ndarray, b: np.ndarray) -> tuple:
-    rgbScale, cmykScale = getScales()
+    r, g, b = np.asarray(r), np.asarray(g), np.asarray(b)
+    c, m, y, k = emptyPlanes(r.shape, 4)
+    rgbToCmykPlanes(r, g, b, c, m, y, k)
+    return c, m, y, k
 
-    # Normalize RGB
-    r = np.array(r).astype(np.float32) / rgbScale
-    g = np.array(g).astype(np.float32) / rgbScale
-    b = np.array(b).astype(np.float32) / rgbScale
-
-    # CMY intialization
-    c = 1.0 - r
-    m = 1.0 - g
-    y = 1.0 - b
-
-    k = np.minimum.reduce([c, m, y])
-    # Avoid division by zero
-    mask = k < 1.0
-    # Normalize CMY values
-    # Only apply normalization where k < 1 to avoid division by zero
-    c[mask] = (c[mask] - k[mask]) / (1 - k[mask])
-    m[mask] = (m[mask] - k[mask]) / (1 - k[mask])
-    y[mask] = (y[mask] - k[mask]) / (1 - k[mask])
-
-    c[~mask] = 0
-    m[~mask] = 0
-    y[~mask] = 0
+def rgbToCmykWhiteArray(r: np.ndarray, g: np.ndarray, b: np.ndarray, a: np.ndarray) -> tuple:
+    r, g, b, a = np.asarray(r), np.asarray(g), np.asarray(b), np.asarray(a)
+    c, m, y, k, white = emptyPlanes(r.shape, 5)
+    rgbToCmykWhitePlanes(r, g, b, a, c, m, y, k, white)
+    return c, m, y, k, white
 
-    return (
-        (c * cmykScale).astype(np.uint8),
-        (m * cmykScale).astype(np.uint8),
-        (y * cmykScale).astype(np.uint8),
-        (k * cmykScale).astype(np.uint8)
-    )
+def getWhiteArray(c: np.ndarray, m: np.ndarray, y: np.ndarray, k: np.ndarray, a: np.ndarray) -> np.ndarray:
+    c, m, y, k, a = np.asarray(c), np.asarray(m), np.asarray(y), np.asarray(k), np.asarray(a)
+    white = np.empty(a.shape, dtype=np.uint8)
+    cmykWhitePlane(c, m, y, k, a, white)
+    return white
 
 def cmykToRgbArray(c: np.ndarray, m: np.ndarray, y: np.ndarray, k: np.ndarray) -> tuple:
     # Convert CMYK (0-255) to RGB (0-255)
@@ -66,10 +101,16 @@ def cmykToRgbArray(c: np.ndarray, m: np.ndarray, y: np.ndarray, k: np.ndarray) -
         (b * rgbScale).astype(np.uint8)
     )
 
+def readTiff(src: str) -> np.ndarray:
+    # Uncompressed contiguous TIFFs are memory mapped so the channels become views into the file, not copies
+    if memoryMapTiffs:
+        try:
+            return tifffile.memmap(src, mode='r')
+        except ValueError:
+            pass # Compressed or split in strips that are not next to each other
+    return tifffile.imread(src)
+
 def getType(src: str) -> list:
-    global usedEPS
-    global epsOutputName
-    
     # Determine the type of image based on its file extension and properties
     # Is it a tiff or png? And is it RGB or CMYK?
     ext = src.split(".")[-1].lower()
@@ -107,47 +148,52 @@ def getType(src: str) -> list:
         return imgInfo
     
     elif ext == "eps":
-        eps = HandleEPS(src)
-        eps.open()
-        while (not eps.isClosed()):
-            time.sleep(1)
-        if (eps.convertNotFailed()):
-            # Set usedEPS "flag"
-            usedEPS = True
-            # remeber temp path for eps convertion
-            epsOutputName = eps.getOutputFilename()
-            imgInfo = getType(os.path.abspath(eps.getOutputFilename()))
-            return imgInfo
-        else:
-            raise ValueError("EPS convertion failed")
-
-def splitImageToCmyk(src: str) -> tuple:
-    global usedEPS
-    global epsOutputName
-    # Make sure to reset usedEPS "flag"
-    usedEPS = False
-    epsOutputName = None
-    # Create a CMYK image from an RGB or CMYK source image, using information from the function getType
-    imgInfo = getType(src) # Get image type and color space (RGB or CMYK)
-    c, m, y, k, alphaChannel = 0,0,0,0,0 # Initialize variables
+        # Ghostscript renders EPS files as RGBA
+        return ["RGB", "eps", True]
+
+def getTiffProfile(src: str) -> bytes:
+    # ICC profile embedded in the first page, None when there is none
+    with tifffile.TiffFile(src) as tif:
+        tag = tif.pages[0].tags.get(34675)
+        return bytes(tag.value) if tag is not None else None
+
+def getIccTable(settings, readProfile: callable) -> np.ndarray:
+    # Table from the image's profile (sRGB when it has none) to the selected CMYK profile, None for the plain conversion.
+    # The profile is only read from the file when a table is needed.
+    if settings is None or settings.colorMode != "CMYK" or settings.getIccPath() is None:
+        return None
+    return colorManagement.getSettingsTable(settings, readProfile())
+
+class DecodedImage():
+    # An input image before the CMYK conversion, so it can be read once and converted for several outputs
+    def __init__(self, colorSpace: str, channels: tuple, alphaChannel: np.ndarray, readProfile: callable = None):
+        self.colorSpace = colorSpace # "RGB" or "CMYK"
+        self.channels = channels # r, g, b or c, m, y, k
+        self.alphaChannel = alphaChannel
+        self.readProfile = readProfile # Returns the embedded ICC profile, only read when a conversion needs it
+
+def decodeImage(src: str, settings = None) -> DecodedImage:
+    # Read an RGB or CMYK source image, using information from the function getType.
+    # settings are only used for the size EPS files are rendered at.
+    with instrumentation.stage("getType"):
+        imgInfo = getType(src) # Get image type and color space (RGB or CMYK)
+    if imgInfo is None or imgInfo[0] not in ("RGB", "CMYK"):
+        raise ValueError("Unknown image type")
     if imgInfo[1]== "tiff":
         # Read the TIFF image using tifffile
-        imgSrc = tifffile.imread(src)  # shape (H,W,4)
+        with instrumentation.stage("decode") as stage:
+            imgSrc = readTiff(src)  # shape (H,W,4)
+            stage.setShape(imgSrc.shape)
         if imgInfo[0] == "RGB":
-            c,m,y,k = rgbToCmykArray(imgSrc[..., 0], imgSrc[..., 1], imgSrc[..., 2])
-            alphaChannel = imgSrc[..., 3].astype(np.uint8)
-        elif imgInfo[0] == "CMYK":
-            c, m, y, k = imgSrc[..., 0], imgSrc[..., 1], imgSrc[..., 2], imgSrc[..., 3]
-            alphaChannel = imgSrc[..., 4].astype(np.uint8)
+            return DecodedImage("RGB", (imgSrc[..., 0], imgSrc[..., 1], imgSrc[..., 2]), imgSrc[..., 3].astype(np.uint8), lambda: getTiffProfile(src))
+        return DecodedImage("CMYK", (imgSrc[..., 0], imgSrc[..., 1], imgSrc[..., 2], imgSrc[..., 3]), imgSrc[..., 4].astype(np.uint8))
+
+    with instrumentation.stage("decode") as stage:
+        # Read the PNG image using PIL, EPS files are rendered by Ghostscript straight into memory
+        if imgInfo[1] == "eps":
+            imgSrc = handleEPS.getEpsImage(src, settings)
         else:
-            raise ValueError("Unknown image type")
-        
-    elif imgInfo[1] == "png":
-        # If it has a temp path for .png
-        if (usedEPS):
-            src = epsOutputName
-        # Read the PNG image using PIL
-        imgSrc = PIL.Image.open(src)
+            imgSrc = PIL.Image.open(src)
         
         # Check if has transparency flag (3rd element in imgInfo)
         hasTransparency = len(imgInfo) > 2 and imgInfo[2]
@@ -156,24 +202,52 @@ def splitImageToCmyk(src: str) -> tuple:
             imgSrc = imgSrc.convert("RGBA")
         else:
             imgSrc = imgSrc.convert("RGB")
-        # Check if the image is RGB or CMYK and convert if needed
-        if imgInfo[0] == "RGB":
-            c, m, y, k = rgbToCmykArray(imgSrc.getchannel("R"), imgSrc.getchannel("G"), imgSrc.getchannel("B"))
-            # Get alpha channel—guaranteed to exist if has transparency is True
-            if hasTransparency:
-                alphaChannel = np.array(imgSrc.getchannel("A"))
-            else:
-                alphaChannel = np.full(imgSrc.size[::-1], 255, dtype=np.uint8)
-        
-        elif imgInfo[0] == "CMYK":
-            c, m, y, k = imgSrc.split()
-            # Get alpha channel if it exists
-            if hasTransparency:
-                alphaChannel = np.array(imgSrc.getchannel("A"))
-            else:
-                # Create opaque (255) alpha channel
-                alphaChannel = np.full(imgSrc.size[::-1], 255, dtype=np.uint8)
+        stage.setShape(imgSrc.size[::-1])
+    if imgInfo[0] == "RGB":
+        pixels = np.asarray(imgSrc)
+        # Get alpha channel—guaranteed to exist if has transparency is True
+        if hasTransparency:
+            alphaChannel = np.array(pixels[..., 3])
         else:
-            raise ValueError("Unknown image type")
+            alphaChannel = np.full(imgSrc.size[::-1], 255, dtype=np.uint8)
+        return DecodedImage("RGB", (pixels[..., 0], pixels[..., 1], pixels[..., 2]), alphaChannel, lambda: imgSrc.info.get("icc_profile"))
+
+    # Get alpha channel if it exists
+    if hasTransparency:
+        alphaChannel = np.array(imgSrc.getchannel("A"))
+    else:
+        # Create opaque (255) alpha channel
+        alphaChannel = np.full(imgSrc.size[::-1], 255, dtype=np.uint8)
+    return DecodedImage("CMYK", tuple(imgSrc.split()), alphaChannel)
+
+def convertImage(decoded: DecodedImage, withWhite: bool = False, settings = None) -> tuple:
+    # The CMYK channels and alpha of a decoded image (and white with withWhite), see splitImageToCmyk
+    alphaChannel = decoded.alphaChannel
+    white = None
+    if decoded.colorSpace == "RGB":
+        r, g, b = decoded.channels
+        with instrumentation.stage("rgbToCmykArray", alphaChannel.shape):
+            iccTable = getIccTable(settings, decoded.readProfile)
+            if iccTable is not None and withWhite:
+                c, m, y, k, white = colorManagement.rgbToCmykWhiteArray(r, g, b, alphaChannel, iccTable)
+            elif iccTable is not None:
+                c, m, y, k = colorManagement.rgbToCmykArray(r, g, b, iccTable)
+            elif withWhite:
+                c, m, y, k, white = rgbToCmykWhiteArray(r, g, b, alphaChannel)
+            else:
+                c, m, y, k = rgbToCmykArray(r, g, b)
+    else:
+        c, m, y, k = decoded.channels
+    if withWhite:
+        if white is None:
+            with instrumentation.stage("getWhiteArray", alphaChannel.shape):
+                white = getWhiteArray(c, m, y, k, alphaChannel)
+        return c, m, y, k, alphaChannel, white
     return c, m, y, k, alphaChannel
-    
+
+def splitImageToCmyk(src: str, withWhite: bool = False, settings = None) -> tuple:
+    # Returns c, m, y, k and alpha. With withWhite a sixth layer is added holding the alpha value of
+    # every white pixel (no ink in any channel), made in the same pass as the CMYK conversion for RGB images.
+    # settings give the size EPS files are rendered at and the ICC profile RGB images are converted with
+    # (without settings, as in the live preview, the plain conversion is used).
+    return convertImage(decodeImage(src, settings), withWhite, settings)
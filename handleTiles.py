@@ -0,0 +1,179 @@
+import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import tifffile
+from tifffile import TIFF
+import colorManagement
+import handleImage
+
+stripRows = 256 # Rows written per strip when processing in strips
+tiledPixelThreshold = 64_000_000 # Images with more pixels than this are processed in strips
+
+def needsBigTiff(byteCount: int) -> bool:
+    return byteCount > 2**32 - 2**25
+
+def getTiffPage(tif: tifffile.TiffFile):
+    # The first page, but only if it can be read in strips/tiles with the same result as splitImageToCmyk
+    page = tif.pages[0]
+    if page.dtype != np.uint8 or page.planarconfig != 1:
+        return None
+    if page.photometric == 2 and page.samplesperpixel >= 4:
+        return page
+    if page.photometric == 5 and page.samplesperpixel >= 5:
+        return page
+    return None
+
+def shouldUseTiles(src: str) -> bool:
+    ext = src.split(".")[-1].lower()
+    if ext != "tif" and ext != "tiff":
+        return False
+    try:
+        with tifffile.TiffFile(src) as tif:
+            page = getTiffPage(tif)
+            return page is not None and page.imagelength * page.imagewidth > tiledPixelThreshold
+    except Exception:
+        return False
+
+def placeRows(layer: np.ndarray, layerTop: int, sourceTop: int, rows: int, colOffset: int, outWidth: int) -> np.ndarray:
+    # Build a strip of the output canvas. Row i of the strip shows source row sourceTop + i, which is found
+    # in layer (holding source rows from layerTop) if it exists, otherwise it stays empty (0).
+    strip = np.zeros((rows, outWidth), dtype=np.uint8)
+    first = max(sourceTop, layerTop)
+    last = min(sourceTop + rows, layerTop + layer.shape[0])
+    if first < last:
+        strip[first - sourceTop:last - sourceTop, colOffset:colOffset + layer.shape[1]] = layer[first - layerTop:last - layerTop]
+    return strip
+
+class TiffStripReader():
+    # Reads rows of a TIFF by decoding only the strips or tiles that hold them
+    def __init__(self, src: str, settings = None):
+        self.tif = tifffile.TiffFile(src)
+        self.page = getTiffPage(self.tif)
+        if self.page is None:
+            self.tif.close()
+            raise ValueError("TIFF can not be read in strips")
+        self.height = self.page.imagelength
+        self.width = self.page.imagewidth
+        self.samples = self.page.samplesperpixel
+        self.isRGB = self.page.photometric == 2
+        self.iccTable = handleImage.getIccTable(settings, self.getProfile) if self.isRGB else None # Looked up once, not for every strip
+        if self.page.is_tiled:
+            self.bandRows = self.page.tilelength
+            self.segmentsPerBand = math.ceil(self.width / self.page.tilewidth)
+        else:
+            self.bandRows = min(self.page.rowsperstrip, self.height)
+            self.segmentsPerBand = 1
+        self.bands = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.bands.clear()
+        self.tif.close()
+
+    def getProfile(self) -> bytes:
+        tag = self.page.tags.get(34675)
+        return bytes(tag.value) if tag is not None else None
+
+    def readBand(self, band: int) -> np.ndarray:
+        if band in self.bands:
+            return self.bands[band]
+        page = self.page
+        fh = self.tif.filehandle
+        decode = page.decode
+        bandTop = band * self.bandRows
+        rows = min(self.bandRows, self.height - bandTop)
+        data = np.zeros((rows, self.width, self.samples), dtype=np.uint8)
+        for index in range(band * self.segmentsPerBand, (band + 1) * self.segmentsPerBand):
+            offset, byteCount = page.dataoffsets[index], page.databytecounts[index]
+            if byteCount == 0:
+                continue
+            fh.seek(offset)
+            segment, indices, shape = decode(fh.read(byteCount), index, jpegtables=page.jpegtables)
+            if segment is None:
+                continue
+            top, left = indices[-3] - bandTop, indices[-2]
+            segment = segment[0, :rows - top, :self.width - left]
+            data[top:top + segment.shape[0], left:left + segment.shape[1]] = segment
+        self.bands[band] = data
+        return data
+
+    def readRows(self, start: int, end: int, withWhite: bool = False) -> tuple:
+        # Returns the c, m, y, k and alpha channels (and white with withWhite) of rows start..end, same as splitImageToCmyk
+        firstBand, lastBand = start // self.bandRows, (end - 1) // self.bandRows
+        for band in list(self.bands.keys()):
+            if band < firstBand:
+                del self.bands[band] # Rows are read top to bottom, the older strips are not needed again
+        bandData = [self.readBand(band) for band in range(firstBand, lastBand + 1)]
+        rows = np.concatenate(bandData, axis=0) if len(bandData) > 1 else bandData[0]
+        rows = rows[start - firstBand * self.bandRows:end - firstBand * self.bandRows]
+
+        white = None
+        if self.isRGB:
+            alphaChannel = rows[..., 3].astype(np.uint8)
+            if self.iccTable is not None and withWhite:
+                c, m, y, k, white = colorManagement.rgbToCmykWhiteArray(rows[..., 0], rows[..., 1], rows[..., 2], alphaChannel, self.iccTable)
+            elif self.iccTable is not None:
+                c, m, y, k = colorManagement.rgbToCmykArray(rows[..., 0], rows[..., 1], rows[..., 2], self.iccTable)
+            elif withWhite:
+                c, m, y, k, white = handleImage.rgbToCmykWhiteArray(rows[..., 0], rows[..., 1], rows[..., 2], alphaChannel)
+            else:
+                c, m, y, k = handleImage.rgbToCmykArray(rows[..., 0], rows[..., 1], rows[..., 2])
+        else:
+            c, m, y, k = rows[..., 0], rows[..., 1], rows[..., 2], rows[..., 3]
+            alphaChannel = rows[..., 4].astype(np.uint8)
+        if withWhite:
+            if white is None:
+                white = handleImage.getWhiteArray(c, m, y, k, alphaChannel)
+            return c, m, y, k, alphaChannel, white
+        return c, m, y, k, alphaChannel
+
+def getStripEncoder(compression: dict) -> callable:
+    # Encode one strip the same way tifffile does it (predictor first, then the compressor)
+    codec = compression["compression"]
+    tag = {"lzw": 5, "zlib": 8, "zstd": 50000, "packbits": 32773}[codec]
+    compressor = TIFF.COMPRESSORS[tag]
+    level = compression.get("compressionargs", {}).get("level")
+    predictor = compression.get("predictor", False)
+
+    def encode(strip: np.ndarray) -> bytes:
+        if predictor:
+            strip = TIFF.PREDICTORS[2](strip, axis=-2)
+        if codec == "packbits":
+            return compressor(strip, axis=-2)
+        if level is not None:
+            return compressor(strip, level=level)
+        return compressor(strip)
+    return encode
+
+def compressStrips(strips, compression: dict):
+    # Compress strips on a thread pool but hand them on in order. Only a few strips are
+    # in flight at a time so memory stays bounded.
+    encode = getStripEncoder(compression)
+    workers = compression.get("maxworkers", 1)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for strip in strips:
+            pending.append(pool.submit(encode, strip))
+            if len(pending) > workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+class PreviewCollector():
+    # Keeps every n:th row and column of the strips so a small preview can be made afterwards
+    def __init__(self, step: int):
+        self.step = step
+        self.parts = []
+
+    def add(self, stripTop: int, *layers) -> None:
+        first = (-stripTop) % self.step
+        self.parts.append([np.ascontiguousarray(layer[first::self.step, ::self.step]) for layer in layers])
+
+    def getLayers(self) -> list:
+        return [np.concatenate(layer, axis=0) for layer in zip(*self.parts)]
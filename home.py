@@ -1,12 +1,15 @@
 import customtkinter
 import tkinter.filedialog 
 import os
-import program
-import threading
 from CTkMessagebox import CTkMessagebox
 import handleEPS
 import settingsHandler
 from presets import PresetFrame
+from jobQueue import JobQueue
+from jobList import JobListFrame
+
+jobs = JobQueue() # Files added with "Add Spot To File!" wait here and are converted in the background
+targetFiles = []
 
 class Home(customtkinter.CTkFrame):
     def selectFile(self):
@@ -22,53 +25,67 @@ class Home(customtkinter.CTkFrame):
             acceptedfileTypes.append(("EPS files", "*.eps"))
         # acceptedfileTypes.i
             
-        filePath = tkinter.filedialog.askopenfilename(filetypes=acceptedfileTypes, title="Select a file")
-        global targetFile
+        filePaths = tkinter.filedialog.askopenfilenames(filetypes=acceptedfileTypes, title="Select files")
+        global targetFile, targetFiles
 
-        if filePath:
-            name, ext = os.path.splitext(os.path.basename(filePath))
-            if not ext.lower() in ['.tif', '.tiff', '.png', '.eps']:
-                # Show an error message if the file is not TIFF or PNG
-                CTkMessagebox(title="Invalid file type", message="Please select a valid TIFF, PNG or EPS file.", icon="cancel")
-                targetFile = None # Remove saved file path
-                self.chosenFile.configure(text="No file selected") # Update display text
-                return
-            self.chosenFile.configure(text=os.path.basename(filePath))
-            targetFile = filePath
+        self.clearSelection()
+        if filePaths:
+            for filePath in filePaths:
+                name, ext = os.path.splitext(os.path.basename(filePath))
+                if not ext.lower() in ['.tif', '.tiff', '.png', '.eps']:
+                    # Show an error message if the file is not TIFF or PNG
+                    CTkMessagebox(title="Invalid file type", message=f"{os.path.basename(filePath)} is not a valid TIFF, PNG or EPS file.", icon="cancel")
+                    return
+            targetFiles = list(filePaths)
+            targetFile = targetFiles[0]
+            if len(targetFiles) == 1:
+                self.chosenFile.configure(text=os.path.basename(targetFile))
+            else:
+                self.chosenFile.configure(text=f"{len(targetFiles)} files selected")
             self.convertBtn.configure(command=self.startProcess)
             self.convertBtn.configure(fg_color="green")
-        else:
-            self.chosenFile.configure(text="No file selected")
-            targetFile = None
+            if len(targetFiles) == 1 and not targetFile.lower().endswith('.eps'): # EPS needs the import popup first
+                self.livePreviewBtn.configure(command=self.showLivePreview)
+                self.livePreviewBtn.configure(fg_color="green")
 
-    def processImage(self):
-        global targetFile
-        if targetFile is None:
-            return
-        self.after(0, lambda: self.info.grid())
-        self.after(0, lambda: self.info.configure(text="Processing..."))
+    def clearSelection(self):
+        global targetFile, targetFiles
+        targetFile = None
+        targetFiles = []
+        self.chosenFile.configure(text="No file selected")
         self.convertBtn.configure(command=None)
         self.convertBtn.configure(fg_color="black")
-   
-        program.generateSpotImage(targetFile, program.getOutputName(targetFile))  # Start the conversion process
-      
-        self.chosenFile.configure(text="No file selected")
-        targetFile = None
+        self.livePreviewBtn.configure(command=None)
+        self.livePreviewBtn.configure(fg_color="black")
+
+    # Add the selected files to the queue, they are converted in the background with the current settings
+    def startProcess(self):
+        import program # Loaded in the background at startup
+        for filePath in targetFiles:
+            jobs.add(filePath, program.getOutputName(filePath))
+        self.clearSelection()
+
+    def onJobDone(self, job):
         self.previewBtn.configure(command=self.showPreview)
         self.previewBtn.configure(fg_color="green")
-        self.after(0, lambda: self.info.configure(text="Done!")) # Show "Done!" message
-        self.after(5000, lambda: self.info.grid_remove())  # Hide after 5 seconds
-        
-    # Start the conversion process in a separate thread
-    def startProcess(self):
-        threading.Thread(target=self.processImage, daemon=True).start()
+
+    def clearFinishedJobs(self):
+        self.jobList.clearFinished()
 
     def validateInt(self, text): # Make sure you can only enter integers in the margin input field
         return text.isdigit() or text == ""
 
     def showPreview(self):
+        import program
         program.showPreview()
 
+    def showLivePreview(self):
+        global targetFile
+        if targetFile is None:
+            return
+        from livePreview import LivePreviewFrame # Needs numba and OpenCV, imported when first used
+        LivePreviewFrame(self, targetFile)
+
     def onSettingsUpdate(self, *args):
         self.previewBtn.configure(command=None)
         self.previewBtn.configure(fg_color="black")
@@ -87,9 +104,7 @@ class Home(customtkinter.CTkFrame):
         self.convertBtn = customtkinter.CTkButton(self, text="Add Spot To File!", fg_color="Black")
         self.convertBtn.grid(row=0, column=1, padx=20, pady=0)
 
-        self.info = customtkinter.CTkLabel(self, text="Done", text_color='red', font=("Helvetica", 14, "bold"))
-        self.info.grid(row=1, column=1, padx=10, pady=0)
-        self.info.grid_remove()
+        customtkinter.CTkButton(self, text="Clear finished", fg_color="Black", command=self.clearFinishedJobs).grid(row=1, column=1, padx=20, pady=5)
 
         customtkinter.CTkLabel(self, text="Margin").grid(row=3, column=0, padx=10, pady=(10, 0))
         self.margin = customtkinter.StringVar()
@@ -103,8 +118,14 @@ class Home(customtkinter.CTkFrame):
 
         self.previewBtn = customtkinter.CTkButton(self, text="Show latest preview", fg_color="Black")
         self.previewBtn.grid(row=7, column=0, padx=20, pady=(30,5))
+
+        self.livePreviewBtn = customtkinter.CTkButton(self, text="Live preview", fg_color="Black")
+        self.livePreviewBtn.grid(row=7, column=1, padx=20, pady=(30,5))
         
         self.presetFrame = PresetFrame(self)
         self.presetFrame.grid(row=8, column=0, columnspan=2, rowspan=2)
+
+        self.jobList = JobListFrame(self, jobs, self.onJobDone, height=130)
+        self.jobList.grid(row=10, column=0, columnspan=2, padx=20, pady=(10, 0), sticky="ew")
         
         settingsHandler.addFunctionToCallOnUpdate(self.onSettingsUpdate)
\ No newline at end of file
@@ -0,0 +1,215 @@
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+callbacks = [] # Functions called with a JobRecord when a job is done
+traceMemory = False # Also record peak allocation per stage with tracemalloc (makes python code slower)
+current = threading.local() # The job being recorded on this thread
+traceLock = threading.Lock()
+
+class StageRecord():
+    __slots__ = ("name", "start", "wallSeconds", "cpuSeconds", "peakBytes", "width", "height", "threadId")
+
+    def toDict(self) -> dict:
+        return {
+            "name": self.name,
+            "start": self.start,
+            "wallSeconds": self.wallSeconds,
+            "cpuSeconds": self.cpuSeconds,
+            "peakBytes": self.peakBytes,
+            "width": self.width,
+            "height": self.height
+        }
+
+class JobRecord():
+    def __init__(self, inputName: str, outputName: str):
+        self.inputName = inputName
+        self.outputName = outputName
+        self.stages = []
+        self.start = time.time()
+        self.wallSeconds = 0.0
+        self.cpuSeconds = 0.0
+        self.error = None
+        self.processId = os.getpid()
+        self.threadId = threading.get_ident()
+
+    def toDict(self) -> dict:
+        return {
+            "input": self.inputName,
+            "output": self.outputName,
+            "start": self.start,
+            "wallSeconds": self.wallSeconds,
+            "cpuSeconds": self.cpuSeconds,
+            "error": self.error,
+            "stages": [stage.toDict() for stage in self.stages]
+        }
+
+class NoStage():
+    # Returned when nothing is being recorded so a stage costs one function call and nothing more
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+    def setShape(self, shape: tuple) -> None:
+        pass
+
+noStage = NoStage()
+
+def getOpenStages() -> list:
+    # Stages recording memory on this thread, the innermost last
+    stages = getattr(current, "memoryStages", None)
+    if stages is None:
+        stages = current.memoryStages = []
+    return stages
+
+class Stage():
+    def __init__(self, job: JobRecord, name: str, shape: tuple):
+        self.job = job
+        self.record = StageRecord()
+        self.record.name = name
+        self.record.peakBytes = None
+        self.record.threadId = threading.get_ident()
+        self.setShape(shape)
+
+    def setShape(self, shape: tuple) -> None:
+        # Shape can also be set inside the stage, when it isn't known before the image is read
+        self.record.height, self.record.width = (shape[0], shape[1]) if shape is not None else (None, None)
+
+    def __enter__(self):
+        if traceMemory and tracemalloc.is_tracing():
+            # Resetting the peak would lose the outer stage's peak so far, it's kept in that stage first
+            size, peak = tracemalloc.get_traced_memory()
+            stages = getOpenStages()
+            if stages:
+                stages[-1].peakSeen = max(stages[-1].peakSeen, peak)
+            tracemalloc.reset_peak()
+            self.baseline = self.peakSeen = size
+            stages.append(self)
+        self.record.start = time.time()
+        self.wallStart = time.perf_counter()
+        self.cpuStart = time.process_time()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.record.wallSeconds = time.perf_counter() - self.wallStart
+        self.record.cpuSeconds = time.process_time() - self.cpuStart
+        stages = getOpenStages()
+        if stages and stages[-1] is self:
+            stages.pop()
+            self.peakSeen = max(self.peakSeen, tracemalloc.get_traced_memory()[1])
+            self.record.peakBytes = self.peakSeen - self.baseline # Allocated by the stage, not what was there before
+            if stages:
+                stages[-1].peakSeen = max(stages[-1].peakSeen, self.peakSeen)
+        self.job.stages.append(self.record)
+
+class Job():
+    def __init__(self, inputName: str, outputName: str):
+        self.record = JobRecord(inputName, outputName)
+
+    def __enter__(self):
+        self.previous = getattr(current, "job", None)
+        current.job = self.record
+        if traceMemory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.wallStart = time.perf_counter()
+        self.cpuStart = time.process_time()
+        return self.record
+
+    def __exit__(self, errorType, error, traceback) -> None:
+        self.record.wallSeconds = time.perf_counter() - self.wallStart
+        self.record.cpuSeconds = time.process_time() - self.cpuStart
+        if error is not None:
+            self.record.error = f"{errorType.__name__}: {error}"
+        current.job = self.previous
+        for callback in list(callbacks):
+            callback(self.record)
+
+def isEnabled() -> bool:
+    return len(callbacks) > 0
+
+def job(inputName: str, outputName: str = None):
+    # Wraps a whole conversion, stages inside it are collected into one JobRecord
+    if len(callbacks) == 0:
+        return noStage
+    return Job(inputName, outputName)
+
+def stage(name: str, shape: tuple = None):
+    listener = getattr(current, "listener", None)
+    if listener is not None:
+        listener(name, None) # May raise to stop the job before the stage starts
+    job = getattr(current, "job", None)
+    if job is None:
+        return noStage
+    return Stage(job, name, shape)
+
+def progress(fraction: float) -> None:
+    # How much of the current job is done (0 to 1), only passed on when something listens
+    listener = getattr(current, "listener", None)
+    if listener is not None:
+        listener(None, fraction)
+
+def checkStop() -> None:
+    # For code that waits on something else during a job (the EPS popup), lets the listener stop the job
+    listener = getattr(current, "listener", None)
+    if listener is not None:
+        listener(None, None)
+
+class Listen():
+    def __init__(self, listener: callable):
+        self.listener = listener
+
+    def __enter__(self):
+        self.previous = getattr(current, "listener", None)
+        current.listener = self.listener
+        return self
+
+    def __exit__(self, *args) -> None:
+        current.listener = self.previous
+
+def listen(listener: callable) -> Listen:
+    # listener(stageName, fraction) is called on this thread when a stage starts (fraction is None) and when
+    # the job reports its progress (stageName is None). Raising from it stops the job between two stages.
+    return Listen(listener)
+
+def addCallback(callback: callable) -> None:
+    callbacks.append(callback)
+
+def removeCallback(callback: callable) -> None:
+    if callback in callbacks:
+        callbacks.remove(callback)
+
+class ChromeTrace():
+    # Callback that writes every job as a Chrome trace (open it in chrome://tracing or ui.perfetto.dev)
+    def __init__(self, path: str):
+        self.path = path
+        self.events = []
+
+    def __call__(self, record: JobRecord) -> None:
+        self.events.append({
+            "name": os.path.basename(record.inputName), "cat": "job", "ph": "X",
+            "ts": record.start * 1e6, "dur": record.wallSeconds * 1e6,
+            "pid": record.processId, "tid": record.threadId,
+            "args": {"output": record.outputName, "cpuSeconds": record.cpuSeconds, "error": record.error}
+        })
+        for stageRecord in record.stages:
+            self.events.append({
+                "name": stageRecord.name, "cat": "stage", "ph": "X",
+                "ts": stageRecord.start * 1e6, "dur": stageRecord.wallSeconds * 1e6,
+                "pid": record.processId, "tid": stageRecord.threadId,
+                "args": {"cpuSeconds": stageRecord.cpuSeconds, "peakBytes": stageRecord.peakBytes, "width": stageRecord.width, "height": stageRecord.height}
+            })
+        self.write()
+
+    def write(self) -> None:
+        with traceLock:
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+def addChromeTrace(path: str) -> ChromeTrace:
+    trace = ChromeTrace(path)
+    addCallback(trace)
+    return trace
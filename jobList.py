@@ -0,0 +1,65 @@
+import os
+import customtkinter as ctk
+from jobQueue import JobQueue, QueuedJob
+
+class JobRow(ctk.CTkFrame):
+    def __init__(self, master, job: QueuedJob, cancelFunction: callable):
+        super().__init__(master, fg_color="transparent")
+        self.grid_columnconfigure(0, weight=1)
+
+        self.name = ctk.CTkLabel(self, text=os.path.basename(job.inputName), anchor="w", font=("Helvetica", 12, "bold"))
+        self.name.grid(row=0, column=0, sticky="w", padx=(5, 0))
+
+        self.cancelBtn = ctk.CTkButton(self, text="Cancel", width=60, height=20, fg_color="black", command=lambda: cancelFunction(job.id))
+        self.cancelBtn.grid(row=0, column=1, rowspan=2, padx=5)
+
+        self.status = ctk.CTkLabel(self, text="", anchor="w", justify="left", height=16, wraplength=230, font=("Helvetica", 11))
+        self.status.grid(row=1, column=0, sticky="w", padx=(5, 0))
+
+        self.progress = ctk.CTkProgressBar(self, height=6)
+        self.progress.grid(row=2, column=0, columnspan=2, sticky="ew", padx=5, pady=(0, 5))
+        self.finished = False
+        self.showJob(job)
+
+    def showJob(self, job: QueuedJob) -> bool:
+        # Returns True the first time the job is shown as finished
+        self.status.configure(text=job.getStatus(), text_color="red" if job.state == "failed" else ("gray60", "gray60"))
+        self.progress.set(job.progress)
+        if job.isFinished() and not self.finished:
+            self.finished = True
+            self.cancelBtn.grid_remove()
+            return True
+        return False
+
+class JobListFrame(ctk.CTkScrollableFrame):
+    # Shows every job in the queue. Jobs run on other threads, their changes are read here every pollMs on the Tk thread.
+    pollMs = 100
+
+    def __init__(self, master, jobs: JobQueue, onJobDone: callable = None, **kwargs):
+        super().__init__(master, **kwargs)
+        self.jobs = jobs
+        self.onJobDone = onJobDone
+        self.rows = dict()
+        self.grid_columnconfigure(0, weight=1)
+
+        self.emptyLabel = ctk.CTkLabel(self, text="No files in the queue")
+        self.emptyLabel.grid(row=0, column=0)
+        self.after(self.pollMs, self.poll)
+
+    def poll(self) -> None:
+        for job in self.jobs.getChangedJobs():
+            if job.id not in self.rows:
+                self.rows[job.id] = JobRow(self, job, self.jobs.cancel)
+                self.rows[job.id].grid(row=job.id, column=0, sticky="ew")
+                self.emptyLabel.grid_remove()
+            if self.rows[job.id].showJob(job) and job.state == "done" and self.onJobDone is not None:
+                self.onJobDone(job)
+        self.after(self.pollMs, self.poll)
+
+    def clearFinished(self) -> None:
+        for job in self.jobs.removeFinished():
+            row = self.rows.pop(job.id, None)
+            if row is not None:
+                row.destroy()
+        if len(self.rows) == 0:
+            self.emptyLabel.grid()
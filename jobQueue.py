@@ -0,0 +1,157 @@
+import itertools
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import config
+import instrumentation
+
+workerCount = 2 # Jobs converted at the same time, numba and OpenCV already use every core inside a job
+stageNames = {
+    "getType": "Reading",
+    "decode": "Reading",
+    "readRows": "Reading",
+    "rgbToCmykArray": "Converting colours",
+    "getWhiteArray": "Converting colours",
+    "spotCache": "Spot layer",
+    "contractAlphaSmooth": "Spot layer",
+    "fixSpotSmart": "Spot layer",
+    "write": "Writing",
+    "assembleStrip": "Writing",
+    "generateSpotPreview": "Preview"
+}
+outputStages = ("write", "readRows") # The output is open while these run (large files are read while writing)
+
+class JobCancelled(Exception):
+    pass
+
+class QueuedJob():
+    def __init__(self, jobId: int, inputName: str, outputName: str, settings: config.SettingsSnapshot):
+        self.id = jobId
+        self.inputName = inputName
+        self.outputName = outputName
+        self.settings = settings
+        self.state = "queued" # queued, running, done, failed or cancelled
+        self.stage = None
+        self.progress = 0.0
+        self.error = None
+        self.writing = False # Set once the output file is opened
+        self.cancelEvent = threading.Event()
+
+    def isFinished(self) -> bool:
+        return self.state in ("done", "failed", "cancelled")
+
+    def getStatus(self) -> str:
+        if self.state == "running":
+            return stageNames.get(self.stage, "Processing") + "..."
+        if self.state == "failed":
+            return "Failed: " + self.error
+        return {"queued": "Waiting", "done": "Done!", "cancelled": "Cancelled"}[self.state]
+
+class JobQueue():
+    # Runs conversions on a few threads so more files can be added while one is converted. Every change of a job
+    # is put in events, which the window reads on the Tk thread (Tk may only be used from that thread).
+    # A job is cancelled between two stages of the pipeline.
+    def __init__(self, workers: int = workerCount):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self.events = queue.Queue()
+        self.jobs = dict()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def add(self, inputName: str, outputName: str = None, settings: config.SettingsSnapshot = None, createPreview: bool = True) -> QueuedJob:
+        # The settings are read when the job is added, so they can be changed for the next file while it waits
+        import program # Not imported with the module so the window can be shown before numba and OpenCV are loaded
+        if settings is None:
+            settings = config.getSnapshot()
+        job = QueuedJob(next(self.ids), inputName, outputName or program.getOutputName(inputName), settings)
+        with self.lock:
+            self.jobs[job.id] = job
+        self.notify(job)
+        self.pool.submit(self.run, job, createPreview)
+        return job
+
+    def cancel(self, jobId: int) -> None:
+        with self.lock:
+            job = self.jobs.get(jobId)
+        if job is None or job.isFinished():
+            return
+        job.cancelEvent.set()
+        if job.state == "queued":
+            job.state = "cancelled"
+            self.notify(job)
+
+    def cancelAll(self) -> None:
+        for job in self.getJobs():
+            self.cancel(job.id)
+
+    def getJobs(self) -> list:
+        with self.lock:
+            return list(self.jobs.values())
+
+    def removeFinished(self) -> list:
+        with self.lock:
+            finished = [job for job in self.jobs.values() if job.isFinished()]
+            for job in finished:
+                del self.jobs[job.id]
+        return finished
+
+    def notify(self, job: QueuedJob) -> None:
+        self.events.put(job)
+
+    def getChangedJobs(self) -> list:
+        # Jobs that changed since the last call, each one once
+        changed = dict()
+        while True:
+            try:
+                job = self.events.get_nowait()
+            except queue.Empty:
+                return list(changed.values())
+            changed[job.id] = job
+
+    def run(self, job: QueuedJob, createPreview: bool) -> None:
+        if job.cancelEvent.is_set():
+            return
+        job.state = "running"
+        self.notify(job)
+
+        def listener(stageName: str, fraction: float) -> None:
+            if job.cancelEvent.is_set():
+                raise JobCancelled()
+            if stageName is None and fraction is None:
+                return # Only asked whether the job was cancelled
+            if stageName is not None:
+                job.stage = stageName
+                job.writing = job.writing or stageName in outputStages
+            if fraction is not None:
+                job.progress = max(job.progress, fraction)
+            self.notify(job)
+
+        try:
+            import program
+            with instrumentation.listen(listener):
+                program.generateSpotImage(job.inputName, job.outputName, createPreview, job.settings)
+            job.progress = 1.0
+            job.state = "done"
+        except JobCancelled:
+            job.state = "cancelled"
+            self.removeOutput(job)
+        except Exception as e:
+            job.error = f"{type(e).__name__}: {e}"
+            job.state = "failed"
+            self.removeOutput(job)
+        self.notify(job)
+
+    def removeOutput(self, job: QueuedJob) -> None:
+        # Don't leave a half written file behind (an older result is kept when the job stopped before writing)
+        if not job.writing:
+            return
+        try:
+            if os.path.exists(job.outputName):
+                os.remove(job.outputName)
+        except OSError:
+            pass
+
+    def shutdown(self) -> None:
+        self.cancelAll()
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,180 @@
+import os
+import queue
+import threading
+import time
+import cv2
+import numpy as np
+import customtkinter as ctk
+from PIL import Image
+import config
+import handleImage
+import program
+import settingsHandler
+from popupFrame import PopupFrame
+
+proxyMaxEdge = 800 # Longest side of the downscaled copy the live preview works on
+displayMaxEdge = 480 # Longest side of the preview in the window
+
+class PreviewPipeline():
+    # The preview split into stages: decode -> CMYK -> contracted spot -> smart fixes -> offset -> preview RGBA.
+    # Every stage remembers the settings it was made with, so a change only recomputes the stages after it.
+    # Each key starts with the key of the stage before it, so a source file changed on disk recomputes them all.
+    def __init__(self, src: str, maxEdge: int = proxyMaxEdge):
+        self.src = src
+        self.maxEdge = maxEdge
+        self.stages = dict()
+        self.lastSeconds = 0.0
+
+    def runStage(self, name: str, key: tuple, function: callable):
+        saved = self.stages.get(name)
+        if saved is not None and saved[0] == key:
+            return saved[1]
+        result = function()
+        self.stages[name] = (key, result)
+        return result
+
+    def getScale(self) -> float:
+        return self.decode()[0]
+
+    def scalePixels(self, pixels: int) -> int:
+        # Margins and offsets are given in pixels of the full image, move them to the downscaled copy
+        scaled = int(round(pixels * self.getScale()))
+        if scaled == 0 and pixels != 0:
+            scaled = 1 if pixels > 0 else -1
+        return scaled
+
+    def decode(self) -> tuple:
+        def run():
+            c, m, y, k, alphaChannel, white = handleImage.splitImageToCmyk(self.src, withWhite=True)
+            height, width = alphaChannel.shape
+            scale = min(1.0, self.maxEdge / max(height, width))
+            layers = [np.asarray(layer) for layer in (c, m, y, k, alphaChannel, white)]
+            if scale < 1.0:
+                size = (max(1, int(width * scale)), max(1, int(height * scale)))
+                layers = [cv2.resize(layer, size, interpolation=cv2.INTER_AREA) for layer in layers]
+            else:
+                layers = [np.ascontiguousarray(layer) for layer in layers]
+            return scale, layers
+        return self.runStage("decode", (self.src, os.path.getmtime(self.src)), run)
+
+    def cmykToRgb(self) -> tuple:
+        scale, (c, m, y, k, alphaChannel, white) = self.decode()
+        return self.runStage("rgb", self.stages["decode"][0], lambda: handleImage.cmykToRgbArray(c, m, y, k))
+
+    def contract(self, settings: config.SettingsSnapshot) -> np.ndarray:
+        scale, (c, m, y, k, alphaChannel, white) = self.decode()
+        margin = self.scalePixels(settings.margin)
+        key = (self.stages["decode"][0], margin, settings.marginMode)
+        return self.runStage("contract", key, lambda: program.contractAlphaSmooth(np.copy(alphaChannel), pixels=margin, mode=settings.marginMode))
+
+    def smartFix(self, settings: config.SettingsSnapshot) -> np.ndarray:
+        scale, (c, m, y, k, alphaChannel, white) = self.decode()
+        contracted = self.contract(settings)
+        margin = self.scalePixels(settings.margin)
+        smartSpot = settings.getSmartOptions()
+        def run():
+            spot = np.copy(contracted)
+            if True in smartSpot:
+                spot = program.fixSpotSmart(c, m, y, k, alphaChannel, spot, margin, smartSpot, white)
+            return spot.astype(np.uint8)
+        return self.runStage("smart", (self.stages["contract"][0],) + smartSpot, run)
+
+    def offset(self, settings: config.SettingsSnapshot) -> tuple:
+        scale, (c, m, y, k, alphaChannel, white) = self.decode()
+        r, g, b = self.cmykToRgb()
+        spot = self.smartFix(settings)
+        offset = (self.scalePixels(settings.spotOffsetX), self.scalePixels(settings.spotOffsetY))
+        def run():
+            # Empty CMYK is white in RGB, so the colour layers are padded with 255 instead of being converted again
+            r2, g2, b2 = program.resizeAllLayersToFitOffset([r, g, b], 255, offset)
+            alphaPadded, spotPadded = program.resizeAllLayersToFitOffset([alphaChannel, spot], 0, offset)
+            return r2, g2, b2, alphaPadded, program.offsetSpot(spotPadded, offset)
+        key = (self.stages["smart"][0], offset)
+        return self.runStage("offset", key, run)
+
+    def render(self, settings: config.SettingsSnapshot) -> np.ndarray:
+        start = time.perf_counter()
+        r, g, b, alphaChannel, spotOffset = self.offset(settings)
+        color = tuple(settings.getPreviewColor())
+        def run():
+            alphaPatch = np.maximum(alphaChannel, spotOffset)
+            return program.generateRGBAimage(alphaPatch, program.invertChannel(spotOffset), np.copy(r), np.copy(g), np.copy(b), color)
+        rgba = self.runStage("rgba", (self.stages["offset"][0], color), run)
+        self.lastSeconds = time.perf_counter() - start
+        return rgba
+
+class LivePreviewFrame(PopupFrame):
+    # Window showing the preview, updated whenever a setting changes. Renders run on another thread and put their
+    # result in results, which is read here every pollMs on the Tk thread (Tk may only be used from that thread).
+    pollMs = 50
+
+    def __init__(self, parent, src: str):
+        super().__init__(parent=parent, title="Live preview", size=f"{displayMaxEdge + 20}x{displayMaxEdge + 50}")
+        self.pipeline = PreviewPipeline(src)
+        self.lock = threading.Lock()
+        self.busy = False
+        self.pending = False
+        self.results = queue.Queue()
+
+        self.imageLabel = ctk.CTkLabel(self, text="Loading preview...")
+        self.imageLabel.grid(row=0, column=0, padx=10, pady=(10, 0))
+        self.timeLabel = ctk.CTkLabel(self, text="")
+        self.timeLabel.grid(row=1, column=0, padx=10, pady=(0, 10))
+
+        settingsHandler.addFunctionToCallOnUpdate(self.requestRefresh)
+        self.protocol("WM_DELETE_WINDOW", self.close)
+        self.pollId = self.after(self.pollMs, self.poll)
+        self.requestRefresh()
+
+    def close(self) -> None:
+        settingsHandler.removeFunctionToCallOnUpdate(self.requestRefresh)
+        self.after_cancel(self.pollId)
+        super().close()
+
+    def poll(self) -> None:
+        # Only the latest result is shown, older ones were already replaced
+        result = None
+        while True:
+            try:
+                result = self.results.get_nowait()
+            except queue.Empty:
+                break
+        if result is not None:
+            rgba, seconds, error = result
+            if error is not None:
+                self.imageLabel.configure(text=f"Preview failed: {error}", image=None)
+            else:
+                self.showImage(rgba, seconds)
+        self.pollId = self.after(self.pollMs, self.poll)
+
+    def requestRefresh(self) -> None:
+        # Only one render runs at a time, changes made meanwhile are merged into one more render
+        with self.lock:
+            if self.busy:
+                self.pending = True
+                return
+            self.busy = True
+        threading.Thread(target=self.refreshLoop, daemon=True).start()
+
+    def refreshLoop(self) -> None:
+        while True:
+            try:
+                rgba = self.pipeline.render(config.getSnapshot())
+                self.results.put((rgba, self.pipeline.lastSeconds, None))
+            except Exception as e:
+                self.results.put((None, 0.0, str(e)))
+            with self.lock:
+                if not self.pending:
+                    self.busy = False
+                    return
+                self.pending = False
+
+    def showImage(self, rgba: np.ndarray, seconds: float) -> None:
+        if self.isClosed():
+            return
+        image = Image.fromarray(rgba, 'RGBA')
+        scale = min(1.0, displayMaxEdge / max(image.size))
+        size = (max(1, int(image.size[0] * scale)), max(1, int(image.size[1] * scale)))
+        self.ctkImage = ctk.CTkImage(light_image=image, dark_image=image, size=size)
+        self.imageLabel.configure(image=self.ctkImage, text="")
+        self.timeLabel.configure(text=f"Updated in {seconds * 1000:.0f} ms")
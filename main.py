@@ -1,35 +1,42 @@
 import customtkinter
-import program
 import config
 import handleEPS
+import home
+import sys
 import threading
 from pageHandler import PageHandler
 from navbar import Navbar
 import settingsHandler
-from loadingScreen import LoadingScreen
 from setCtkIcon import setIcon
 
 app = customtkinter.CTk()
-app.withdraw()
 
 customtkinter.set_default_color_theme("dark-blue")
 
-loader = LoadingScreen(app)
+programLoaded = threading.Event()
+initializePollMs = 50
 
-def initialize():
-    program.cacheFunctions()  # Cache the functions with dummy values
-    settingsHandler.loadSettings()
+def loadProgram():
+    # numba, OpenCV and tifffile are loaded while the window is already shown
+    import program
+    programLoaded.set()
 
-    loader.close()
-    app.deiconify()
-    
-    settingsHandler.allowUpdate = True
+def initialize():
+    # numba's threads are started from the main thread with one tiny parallel kernel, the rest is compiled in the
+    # background. With cache=True the compiled functions are read from __pycache__, only the first start after an
+    # update compiles them.
+    if not programLoaded.is_set():
+        app.after(initializePollMs, initialize)
+        return
+    import program # Already loaded by loadProgram
+    program.startKernelThreads()
+    threading.Thread(target=program.cacheFunctions, daemon=True).start() # Cache the functions with dummy values
 
 targetFile = None
 programStarted = False
 
 app.title("Speedyspot")
-app.geometry("400x400")
+app.geometry("400x700")
 setIcon(app)
 app.resizable(False, False)
 
@@ -37,8 +44,22 @@ config.setupProgram()
 navbar = Navbar(app, width=400, height=340, fg_color="transparent", bg_color="transparent")
 PageHandler(navbar.getContentArea())
 
-threading.Thread(target=initialize, daemon=True).start()
+settingsHandler.loadSettings()
+settingsHandler.allowUpdate = True
+
+threading.Thread(target=loadProgram, daemon=True).start()
+app.after_idle(initialize)
 
 handleEPS.baseApp = app
 
-app.mainloop()
\ No newline at end of file
+def onClose():
+    home.jobs.shutdown() # Jobs stop at their next stage instead of keeping the program open
+    handleEPS.appClosed.set() # Jobs waiting for an EPS popup too
+    app.destroy()
+
+app.protocol("WM_DELETE_WINDOW", onClose)
+
+if "--exit-when-ready" in sys.argv:
+    app.after(0, lambda: app.after_idle(app.destroy)) # Used by benchmark.py --startup to time how long it takes until the window can be used
+
+app.mainloop()
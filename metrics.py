@@ -0,0 +1,204 @@
+import os
+import threading
+import instrumentation
+
+# Counters and histograms of the conversions in the Prometheus text format, for batch runs, the hot folder and the
+# render service. Workers only summarize their jobs (see takeSamples), the summaries travel back with the
+# BatchResult and are added up in the main process, which serves or writes them.
+enabled = False
+prefix = "speedyspot"
+conversionBuckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+stageBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+rssBuckets = tuple(2**power << 20 for power in range(7, 15)) # 128 MB to 16 GB
+
+# The part of the conversion every stage belongs to
+stagePhases = {
+    "getType": "decode",
+    "decode": "decode",
+    "readRows": "decode",
+    "rgbToCmykArray": "colour",
+    "getWhiteArray": "colour",
+    "spotCache": "spot",
+    "contractAlphaSmooth": "spot",
+    "fixSpotSmart": "spot",
+    "generateSpotPreview": "preview",
+    "assembleStrip": "write",
+    "write": "write"
+}
+
+sampleLock = threading.Lock()
+pendingSamples = [] # Jobs done in this process that weren't taken yet
+
+class Histogram():
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def getLines(self, name: str, labels: dict) -> list:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{formatLabels(labels, le=formatNumber(bound))} {cumulative}")
+        lines.append(f'{name}_bucket{formatLabels(labels, le="+Inf")} {self.count}')
+        lines.append(f"{name}_sum{formatLabels(labels)} {formatNumber(self.sum)}")
+        lines.append(f"{name}_count{formatLabels(labels)} {self.count}")
+        return lines
+
+def formatNumber(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def formatLabels(labels: dict, **extra) -> str:
+    labels = dict(labels, **extra)
+    if not labels:
+        return ""
+    escaped = [(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in labels.items()]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+def getInputType(inputName: str) -> str:
+    ext = inputName.rsplit(".", 1)[-1].lower()
+    if ext in ("tif", "tiff"):
+        return "tiff"
+    if ext in ("png", "eps"):
+        return ext
+    return "other"
+
+def getPeakRss() -> int:
+    # Highest memory use of this process since the last call, in bytes. On Linux the peak is reset after reading,
+    # so every job gets its own. Elsewhere it's the peak of the whole process, None when it can't be read.
+    try:
+        with open("/proc/self/status", "rb") as f:
+            for line in f:
+                if line.startswith(b"VmHWM:"):
+                    peak = int(line.split()[1]) * 1024
+                    break
+            else:
+                return None
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        except OSError:
+            pass
+        return peak
+    except OSError:
+        pass
+    try:
+        import resource # Not on Windows
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except (ImportError, OSError):
+        return None
+
+def recordJob(record: instrumentation.JobRecord) -> None:
+    # Callback for instrumentation, keeps what the metrics need from the job: seconds per stage (a tiled job has
+    # many strips, they are added up), the size of the output it wrote and the peak memory
+    stageSeconds = dict()
+    for stageRecord in record.stages:
+        stageSeconds[stageRecord.name] = stageSeconds.get(stageRecord.name, 0.0) + stageRecord.wallSeconds
+    bytesWritten = 0
+    if record.outputName and record.error is None:
+        try:
+            bytesWritten = os.path.getsize(record.outputName)
+        except (OSError, TypeError):
+            pass
+    sample = {"stages": stageSeconds, "bytesWritten": bytesWritten, "peakRss": getPeakRss()}
+    with sampleLock:
+        pendingSamples.append(sample)
+
+def enable() -> None:
+    # Also in every worker, the jobs are only recorded when something uses them
+    global enabled
+    if not enabled:
+        enabled = True
+        instrumentation.addCallback(recordJob)
+
+def takeSamples() -> list:
+    with sampleLock:
+        samples = list(pendingSamples)
+        pendingSamples.clear()
+    return samples
+
+class MetricsRegistry():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.conversions = dict() # (input type, result) -> count
+        self.conversionSeconds = dict() # input type -> Histogram
+        self.stageSeconds = dict() # stage -> Histogram
+        self.peakRss = Histogram(rssBuckets)
+        self.bytesWritten = 0
+        self.gauges = dict() # name -> (help text, value)
+        self.counters = dict() # name -> (help text, value), set from counts kept elsewhere
+
+    def addResult(self, result) -> None:
+        # One converted file (a batch.BatchResult), its jobs were summarized where it was converted
+        inputType = getInputType(result.inputName)
+        outcome = "ok" if result.succeeded() else "failed"
+        with self.lock:
+            self.conversions[(inputType, outcome)] = self.conversions.get((inputType, outcome), 0) + 1
+            if result.succeeded():
+                self.conversionSeconds.setdefault(inputType, Histogram(conversionBuckets)).observe(result.seconds)
+            peaks = []
+            for sample in result.metrics:
+                for name, seconds in sample["stages"].items():
+                    self.stageSeconds.setdefault(name, Histogram(stageBuckets)).observe(seconds)
+                self.bytesWritten += sample["bytesWritten"]
+                if sample["peakRss"] is not None:
+                    peaks.append(sample["peakRss"])
+            if peaks:
+                self.peakRss.observe(max(peaks))
+
+    def setGauge(self, name: str, value: float, helpText: str) -> None:
+        with self.lock:
+            self.gauges[name] = (helpText, value)
+
+    def setCounter(self, name: str, value: float, helpText: str) -> None:
+        with self.lock:
+            self.counters[name] = (helpText, value)
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            name = f"{prefix}_conversions_total"
+            lines += [f"# HELP {name} Files converted, by input type and result (ok or failed)", f"# TYPE {name} counter"]
+            for (inputType, outcome), count in sorted(self.conversions.items()):
+                lines.append(f"{name}{formatLabels({'input_type': inputType, 'result': outcome})} {count}")
+
+            name = f"{prefix}_conversion_seconds"
+            lines += [f"# HELP {name} Time to convert one file, by input type", f"# TYPE {name} histogram"]
+            for inputType, histogram in sorted(self.conversionSeconds.items()):
+                lines += histogram.getLines(name, {"input_type": inputType})
+
+            name = f"{prefix}_stage_seconds"
+            lines += [f"# HELP {name} Time spent in each stage of one conversion", f"# TYPE {name} histogram"]
+            for stageName, histogram in sorted(self.stageSeconds.items()):
+                lines += histogram.getLines(name, {"phase": stagePhases.get(stageName, "other"), "stage": stageName})
+
+            name = f"{prefix}_written_bytes_total"
+            lines += [f"# HELP {name} Bytes of TIFF files written", f"# TYPE {name} counter", f"{name} {self.bytesWritten}"]
+
+            name = f"{prefix}_job_peak_rss_bytes"
+            lines += [f"# HELP {name} Peak memory of the process converting a file", f"# TYPE {name} histogram"]
+            lines += self.peakRss.getLines(name, dict())
+
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                for name, (helpText, value) in sorted(values.items()):
+                    lines += [f"# HELP {prefix}_{name} {helpText}", f"# TYPE {prefix}_{name} {kind}", f"{prefix}_{name} {formatNumber(value)}"]
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        # Replaced in one step, so a collector reading the file (node_exporter's textfile collector) never sees half
+        tempPath = f"{path}.{os.getpid()}.tmp"
+        with open(tempPath, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tempPath, path)
+
+registry = MetricsRegistry()
@@ -0,0 +1,199 @@
+import cv2
+import numpy as np
+from numba import njit, prange
+from parallelKernels import parallelKernel
+
+# Erode and close with a cost per pixel that doesn't grow with the margin.
+#   "opencv"    cv2.erode/cv2.morphologyEx with the kernels used before (cost grows with the kernel size)
+#   "fast"      same result as "opencv", the ellipse is found with a distance transform and the square with running min/max
+#   "euclidean" like "fast" but contracts by a true round disc instead of OpenCV's rasterized ellipse
+engines = ("opencv", "fast", "euclidean")
+defaultEngine = "fast"
+opencvMaxEllipseRadius = 16 # Smaller ellipses are faster with OpenCV, "fast" uses it for them (the result is the same)
+opencvMaxSquareRadius = 96 # Same for the square used to fill gaps, OpenCV already filters it by rows and columns
+
+@parallelKernel
+@njit(parallel=True, cache=True)
+def horizontalDistance(mask: np.ndarray, out: np.ndarray) -> None:
+    # Distance along the row to the closest 0 pixel, everything outside the image counts as 0
+    height, width = mask.shape
+    for i in prange(height):
+        last = -1
+        for j in range(width):
+            if mask[i, j] == 0:
+                last = j
+            out[i, j] = j - last
+        last = width
+        for j in range(width - 1, -1, -1):
+            if mask[i, j] == 0:
+                last = j
+            if last - j < out[i, j]:
+                out[i, j] = last - j
+
+def getReachTable(radius: int, euclidean: bool) -> np.ndarray:
+    # reach[dx] is how many rows up and down a 0 pixel at horizontal distance dx erodes, -1 when it doesn't reach.
+    # OpenCV's ellipse row dy spans round(sqrt(r^2 - dy^2)) pixels each side, so it covers (dx, dy) when
+    # dx^2 - dx + dy^2 < r^2 (any |dy| <= r for dx == 0). The disc covers it when dx^2 + dy^2 <= r^2.
+    reach = np.full(radius + 2, -1, dtype=np.int64)
+    for dx in range(radius + 2):
+        for dy in range(radius, -1, -1):
+            if euclidean:
+                covered = dx * dx + dy * dy <= radius * radius
+            else:
+                covered = dx == 0 or dx * dx - dx + dy * dy < radius * radius
+            if covered:
+                reach[dx] = dy
+                break
+    return reach
+
+@parallelKernel
+@njit(parallel=True, cache=True)
+def verticalReach(distance: np.ndarray, reach: np.ndarray, out: np.ndarray) -> None:
+    # A pixel is eroded when a 0 pixel above or below it reaches it. Going down the image the furthest row reached
+    # by the zeros seen so far is kept per column (and the same going up), so the cost doesn't depend on the radius.
+    # Blocks of columns run in parallel and every row is read in order.
+    height, width = distance.shape
+    chunk = 256
+    edge = reach[0] # Rows outside the image are all 0
+    for block in prange((width + chunk - 1) // chunk):
+        first = block * chunk
+        last = min(width, first + chunk)
+        furthest = np.full(last - first, edge - 1, dtype=np.int64)
+        for i in range(height):
+            for j in range(first, last):
+                dx = distance[i, j]
+                if dx < reach.shape[0] and i + reach[dx] > furthest[j - first]:
+                    furthest[j - first] = i + reach[dx]
+                out[i, j] = 0 if furthest[j - first] >= i else 1
+        furthest[:] = height - edge
+        for i in range(height - 1, -1, -1):
+            for j in range(first, last):
+                dx = distance[i, j]
+                if dx < reach.shape[0] and i - reach[dx] < furthest[j - first]:
+                    furthest[j - first] = i - reach[dx]
+                if furthest[j - first] <= i:
+                    out[i, j] = 0
+
+def erodeEllipse(mask: np.ndarray, radius: int, engine: str = None) -> np.ndarray:
+    # Erode a 0/1 mask with a (2 * radius + 1) ellipse, the outside of the image counts as 0
+    engine = engine or defaultEngine
+    if radius <= 0:
+        return mask
+    if engine == "opencv" or (engine == "fast" and radius < opencvMaxEllipseRadius):
+        padded = np.pad(mask, ((1, 1), (1, 1)), mode='constant', constant_values=0)
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * radius + 1, 2 * radius + 1))
+        return cv2.erode(padded, kernel, borderType=cv2.BORDER_CONSTANT, borderValue=0)[1:-1, 1:-1]
+    distance = np.empty(mask.shape, dtype=np.int32)
+    horizontalDistance(mask, distance)
+    out = np.empty(mask.shape, dtype=np.uint8)
+    verticalReach(distance, getReachTable(radius, engine == "euclidean"), out)
+    return out
+
+@parallelKernel
+@njit(parallel=True, cache=True)
+def runningExtremeRows(src: np.ndarray, size: int, isMax: bool, out: np.ndarray) -> None:
+    # Min or max over a window of size pixels centered on every pixel of a row (van Herk/Gil-Werman: a running
+    # min/max forward and backward inside blocks of size pixels, so 3 comparisons per pixel whatever the size).
+    # Pixels outside the image are left out, like OpenCV's default border for erode and dilate.
+    height, width = src.shape
+    half = size // 2
+    length = (width + 2 * half + size - 1) // size * size
+    for i in prange(height):
+        padded = np.full(length, 0 if isMax else 255, dtype=np.uint8)
+        padded[half:half + width] = src[i]
+        forward = np.empty(length, dtype=np.uint8)
+        backward = np.empty(length, dtype=np.uint8)
+        for start in range(0, length, size):
+            forwardValue = padded[start]
+            backwardValue = padded[start + size - 1]
+            for x in range(size):
+                if isMax:
+                    forwardValue = max(forwardValue, padded[start + x])
+                    backwardValue = max(backwardValue, padded[start + size - 1 - x])
+                else:
+                    forwardValue = min(forwardValue, padded[start + x])
+                    backwardValue = min(backwardValue, padded[start + size - 1 - x])
+                forward[start + x] = forwardValue
+                backward[start + size - 1 - x] = backwardValue
+        for j in range(width):
+            out[i, j] = max(backward[j], forward[j + size - 1]) if isMax else min(backward[j], forward[j + size - 1])
+
+@parallelKernel
+@njit(parallel=True, cache=True)
+def runningExtremeColumns(padded: np.ndarray, size: int, isMax: bool, out: np.ndarray) -> None:
+    # Same as runningExtremeRows down the columns of padded (the image with size // 2 neutral rows on top and enough
+    # below to fill the last block). The blocks of rows are independent so they run in parallel.
+    length, width = padded.shape
+    forward = np.empty_like(padded)
+    backward = np.empty_like(padded)
+    for block in prange(length // size):
+        start = block * size
+        end = start + size - 1
+        forward[start] = padded[start]
+        backward[end] = padded[end]
+        for x in range(1, size):
+            if isMax:
+                for j in range(width):
+                    forward[start + x, j] = max(forward[start + x - 1, j], padded[start + x, j])
+                    backward[end - x, j] = max(backward[end - x + 1, j], padded[end - x, j])
+            else:
+                for j in range(width):
+                    forward[start + x, j] = min(forward[start + x - 1, j], padded[start + x, j])
+                    backward[end - x, j] = min(backward[end - x + 1, j], padded[end - x, j])
+    for i in prange(out.shape[0]):
+        if isMax:
+            for j in range(width):
+                out[i, j] = max(backward[i, j], forward[i + size - 1, j])
+        else:
+            for j in range(width):
+                out[i, j] = min(backward[i, j], forward[i + size - 1, j])
+
+def squareExtreme(src: np.ndarray, size: int, isMax: bool) -> np.ndarray:
+    # A square window is a row window followed by a column window
+    half = size // 2
+    length = (src.shape[0] + 2 * half + size - 1) // size * size
+    padded = np.full((length, src.shape[1]), 0 if isMax else 255, dtype=np.uint8)
+    runningExtremeRows(src, size, isMax, padded[half:half + src.shape[0]])
+    out = np.empty(src.shape, dtype=np.uint8)
+    runningExtremeColumns(padded, size, isMax, out)
+    return out
+
+def closeSquare(layer: np.ndarray, radius: int, engine: str = None) -> np.ndarray:
+    # Dilate then erode with a (2 * radius + 1) square, same as cv2.morphologyEx(MORPH_CLOSE)
+    engine = engine or defaultEngine
+    if engine == "opencv" or radius < opencvMaxSquareRadius:
+        kernel = np.ones((radius * 2 + 1, radius * 2 + 1), np.uint8)
+        return cv2.morphologyEx(layer, cv2.MORPH_CLOSE, kernel)
+    layer = np.ascontiguousarray(layer, dtype=np.uint8)
+    return squareExtreme(squareExtreme(layer, 2 * radius + 1, True), 2 * radius + 1, False)
+
+def cacheFunctions() -> None:
+    dummyArr = np.full((20, 20), 1, dtype=np.uint8)
+    erodeEllipse(dummyArr, opencvMaxEllipseRadius, "fast")
+    erodeEllipse(dummyArr, opencvMaxEllipseRadius, "euclidean")
+    closeSquare(dummyArr, opencvMaxSquareRadius, "fast")
+
+def checkEngines(radii: list = None, size: tuple = (97, 131), seed: int = 0) -> list:
+    # Compare the "fast" engine with OpenCV on random masks, returns the radii that give a different result
+    global opencvMaxEllipseRadius, opencvMaxSquareRadius
+    savedRadii = opencvMaxEllipseRadius, opencvMaxSquareRadius
+    opencvMaxEllipseRadius, opencvMaxSquareRadius = 0, 0 # Check the new code for every radius
+    try:
+        return compareEngines(radii, size, seed)
+    finally:
+        opencvMaxEllipseRadius, opencvMaxSquareRadius = savedRadii
+
+def compareEngines(radii: list, size: tuple, seed: int) -> list:
+    rng = np.random.default_rng(seed)
+    radii = radii if radii is not None else list(range(1, 41))
+    failed = []
+    for radius in radii:
+        mask = (rng.random(size) > 0.02).astype(np.uint8)
+        mask[rng.random(size) > 0.995] = 0
+        layer = rng.integers(0, 256, size, dtype=np.uint8)
+        layer[rng.random(size) > 0.7] = 0
+        if not np.array_equal(erodeEllipse(mask, radius, "fast"), erodeEllipse(mask, radius, "opencv")):
+            failed.append(("erode", radius))
+        if not np.array_equal(closeSquare(layer, radius, "fast"), closeSquare(layer, radius, "opencv")):
+            failed.append(("close", radius))
+    return failed
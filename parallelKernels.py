@@ -0,0 +1,19 @@
+import threading
+import numba
+
+# numba's parallel kernels run on the workqueue threading layer, the only one that works everywhere without
+# hanging: with TBB the program hangs at exit when a thread other than the main one started the first kernel
+# (the window warms up and converts on threads), OpenMP isn't there on every Mac. The workqueue can't run two
+# kernels at once, so every parallel kernel is wrapped with parallelKernel and one runs at a time in a process.
+# A kernel already uses every core, jobs converted at the same time only wait for each other's kernels.
+numba.config.THREADING_LAYER = "workqueue" # Before the first parallel kernel runs
+
+lock = threading.Lock()
+
+def parallelKernel(kernel: callable) -> callable:
+    # For @njit(parallel=True) functions, the wrapper can only be called from python, not from other njit functions
+    def runLocked(*args):
+        with lock:
+            return kernel(*args)
+    runLocked.__name__ = kernel.__name__
+    return runLocked
@@ -0,0 +1,192 @@
+import json
+import os
+import threading
+import time
+import config
+
+presetPath = "data/presets"
+checkSeconds = 2.0 # The folder's time is checked at most this often
+fullCheckSeconds = 30.0 # Every file's time is checked this often, finds presets changed in place (the folder's time doesn't change)
+
+class PresetRegistry():
+    # Index of the presets in folder, name -> file. A file is only read again when its time or size changed and the
+    # folder is only listed again when its time changed (a file was added, removed or replaced), so looking up a
+    # preset doesn't read the folder, which can be slow with many presets on a network share.
+    def __init__(self, folder: str = presetPath):
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.refreshLock = threading.Lock()
+        self.files = dict() # file name -> (time/size, preset name, settings)
+        self.names = dict() # preset name -> file name
+        self.nameFiles = dict() # preset name -> every file with that name, so saving or deleting never scans all files
+        self.folderSignature = None
+        self.lastCheck = 0.0
+        self.lastFullCheck = 0.0
+        self.version = 0 # Increased every time a preset is added, changed or removed
+        self.watcher = None
+
+    def getSignature(self, info: os.stat_result) -> tuple:
+        return (info.st_mtime_ns, info.st_size)
+
+    def refresh(self, force: bool = False) -> bool:
+        # Returns True when any preset changed. The folder is read without holding the lock, so looking up a
+        # preset never waits for a slow share.
+        with self.refreshLock:
+            now = time.monotonic()
+            if not force and now - self.lastCheck < checkSeconds:
+                return False
+            self.lastCheck = now
+            try:
+                folderSignature = self.getSignature(os.stat(self.folder))
+            except OSError:
+                folderSignature = None
+            if not force and folderSignature == self.folderSignature and now - self.lastFullCheck < fullCheckSeconds:
+                return False
+            with self.lock:
+                known = dict(self.files)
+                version = self.version
+            files = self.scan(known)
+            with self.lock:
+                if self.version != version:
+                    return False # Saved or deleted meanwhile, read again at the next check
+                self.folderSignature = folderSignature
+                self.lastFullCheck = now
+                if files == known:
+                    return False
+                self.files = files
+                self.rebuildNames()
+                return True
+
+    def scan(self, known: dict) -> dict:
+        # Only files that are new or changed since known was read are opened
+        files = dict()
+        try:
+            with os.scandir(self.folder) as entries:
+                for entry in entries:
+                    if not entry.name.endswith(".json") or not entry.is_file():
+                        continue
+                    try:
+                        signature = self.getSignature(entry.stat())
+                    except OSError:
+                        continue
+                    if entry.name in known and known[entry.name][0] == signature:
+                        files[entry.name] = known[entry.name]
+                        continue
+                    files[entry.name] = (signature,) + self.readFile(entry.name)
+        except OSError:
+            pass
+        return files
+
+    def update(self) -> None:
+        # With a watcher the index is kept up to date in the background, otherwise it's checked when used
+        if self.watcher is None or self.folderSignature is None:
+            self.refresh()
+
+    def readFile(self, fileName: str) -> tuple:
+        # (name, settings), (None, None) for files that aren't presets so they aren't read again until they change
+        try:
+            with open(os.path.join(self.folder, fileName), "r", encoding="utf-8") as f:
+                data = json.loads(f.read())
+            return data['name'], data['settings']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None, None
+
+    def rebuildNames(self) -> None:
+        self.nameFiles = dict()
+        for fileName, (signature, presetName, settings) in self.files.items():
+            if presetName is not None:
+                self.nameFiles.setdefault(presetName, set()).add(fileName)
+        self.names = dict()
+        for presetName in self.nameFiles.keys():
+            self.updateName(presetName)
+        self.version += 1
+
+    def updateName(self, presetName: str) -> None:
+        # Files are taken in name order so the same file wins every time when two presets have the same name
+        fileNames = self.nameFiles.get(presetName)
+        if fileNames:
+            self.names[presetName] = min(fileNames)
+        else:
+            self.nameFiles.pop(presetName, None)
+            self.names.pop(presetName, None)
+
+    def setFile(self, fileName: str, entry: tuple) -> None:
+        # Changes one file and the names it had and has now, entry is None when the file is gone
+        old = self.files.pop(fileName, None)
+        if old is not None and old[1] is not None:
+            self.nameFiles.get(old[1], set()).discard(fileName)
+            self.updateName(old[1])
+        if entry is not None:
+            self.files[fileName] = entry
+            if entry[1] is not None:
+                self.nameFiles.setdefault(entry[1], set()).add(fileName)
+                self.updateName(entry[1])
+        self.version += 1
+
+    def getNames(self) -> list:
+        self.update()
+        with self.lock:
+            return ['Default'] + [name for name in sorted(self.names.keys(), key=self.names.get) if name != 'Default']
+
+    def get(self, presetName: str) -> dict:
+        # Settings of the preset or None when there is no preset with that name
+        self.update()
+        with self.lock:
+            fileName = self.names.get(presetName)
+            if fileName is not None:
+                return dict(self.files[fileName][2])
+        if presetName == 'Default':
+            return config.getStandardValues()
+        return None
+
+    def getAll(self) -> dict:
+        self.update()
+        with self.lock:
+            presets = {'Default': config.getStandardValues()}
+            for name, fileName in self.names.items():
+                presets[name] = dict(self.files[fileName][2])
+            return presets
+
+    def getFileName(self, presetName: str) -> str:
+        return presetName.encode('ascii', errors='ignore').decode("utf-8").replace(" ", "") + ".json"
+
+    def save(self, presetName: str, settings: dict) -> None:
+        # Written to a temp file and moved into place, so other programs sharing the folder never read half a preset
+        # and see the change from the folder's time
+        presetStr = json.dumps({'name': presetName, 'settings': settings}, indent=2)
+        fileName = self.getFileName(presetName)
+        filePath = os.path.join(self.folder, fileName)
+        tempPath = f"{filePath}.{os.getpid()}.tmp"
+        with open(tempPath, "w", encoding="utf-8") as f:
+            f.write(presetStr)
+        os.replace(tempPath, filePath)
+        with self.lock:
+            try:
+                self.setFile(fileName, (self.getSignature(os.stat(filePath)), presetName, dict(settings)))
+            except OSError:
+                self.setFile(fileName, None)
+
+    def delete(self, presetName: str) -> None:
+        # Every file with this name is removed, presets are never read from disk to find them
+        with self.lock:
+            for fileName in list(self.nameFiles.get(presetName, ())):
+                try:
+                    os.remove(os.path.join(self.folder, fileName))
+                except OSError as e:
+                    print(e)
+                self.setFile(fileName, None)
+
+    def watch(self, seconds: float = checkSeconds) -> None:
+        # Check for changed presets on a background thread, so the window never waits for the folder
+        if self.watcher is not None:
+            return
+
+        def checkForever():
+            while True:
+                time.sleep(seconds)
+                self.refresh()
+
+        self.watcher = threading.Thread(target=checkForever, daemon=True)
+        self.watcher.start()
+
+registry = PresetRegistry()
@@ -1,68 +1,39 @@
-import os
-import json
 import config
+import presetRegistry
 import settingsHandler
 import customtkinter as ctk
 from popupFrame import PopupFrame
-import time
 
-presetPath = "data/presets"
-        
+presetPath = presetRegistry.presetPath
+registry = presetRegistry.registry
+
 def getPresets() -> dict:
-    presets = dict()
-    presets['Default'] = config.getStandardValues()
-    for presetFile in os.listdir(presetPath):
-        if (presetFile.endswith(".json")):
-            try:
-                with open(os.path.join(presetPath, presetFile), "r") as f:
-                    data = json.loads(f.read())
-                    presets[data['name']] = data['settings']
-            except:
-                continue
-    return presets
+    return registry.getAll()
 
 def getPresetNames():
-    return getPresets().keys()
+    return registry.getNames()
 
 def loadPreset(presetName: str) -> None:
-    foundPresets = getPresets()
-    if presetName in foundPresets.keys():
-        config.updateSettings(foundPresets[presetName])
+    settings = registry.get(presetName)
+    if settings is not None:
+        config.updateSettings(settings)
 
 def savePreset(presetName: str) -> None:
-    presetJSON = dict()
-    presetJSON['name'] = presetName
-    presetJSON['settings'] = config.getSettingsDict()
-    presetStr = json.dumps(presetJSON, indent=2)
-    
-    fileName = f"{presetName.encode('ascii', errors='ignore').decode("utf-8").replace(" ", "")}.json"
-    filePath = f"{presetPath}/{fileName}"
-    with open(filePath, "w", encoding="utf-8") as f:
-        f.write(presetStr)
+    registry.save(presetName, config.getSettingsDict())
     
 def deletePreset(presetName: str) -> None:
-    if presetName in getPresetNames():
-        for presetFile in os.listdir(presetPath):
-            if (presetFile.endswith(".json")):
-                try:
-                    targetFile = os.path.join(presetPath, presetFile)
-                    with open(targetFile, "r") as f:
-                        data = json.loads(f.read())
-                    if (data.get('name', "") == presetName):
-                        os.remove(targetFile)
-                except Exception as e:
-                    print(e)
+    registry.delete(presetName)
     
 class PresetFrame(ctk.CTkFrame):
     def presetStartup(self) -> None:
         currentLoaded = config.getSelectedPreset()
-        foundPresets = getPresets()
+        loadedSettings = registry.get(currentLoaded)
         
-        if currentLoaded in foundPresets.keys():
+        if loadedSettings is not None:
             self.selectedPresetName.set(currentLoaded)
             for (setting, value) in config.getSettingsDict().items():
-                if setting in foundPresets[currentLoaded].keys():
-                    if  foundPresets[currentLoaded][setting] != value:
+                if setting in loadedSettings.keys():
+                    if  loadedSettings[setting] != value:
                         return
                 
             self.unsavedLabel.grid_remove()
@@ -74,7 +45,14 @@ class PresetFrame(ctk.CTkFrame):
         self.unsavedLabel.grid()
         
     def reloadPresetsList(self) -> None:
+        self.shownVersion = registry.version
         self.selectPresetMenu.configure(values=list(getPresetNames()))
+
+    def checkForNewPresets(self) -> None:
+        # Presets added, changed or removed in data/presets (also by other computers sharing it) show up without a restart
+        if registry.version != self.shownVersion:
+            self.reloadPresetsList()
+        self.after(1000, self.checkForNewPresets)
     
     def changePreset(self, presetName) -> None:
         loadPreset(presetName)
@@ -136,6 +114,8 @@ class PresetFrame(ctk.CTkFrame):
         
         self.presetStartup()
         self.reloadPresetsList()
+        registry.watch()
+        self.after(1000, self.checkForNewPresets)
         
         settingsHandler.addFunctionToCallOnUpdate(self.markAsUnsaved)
     
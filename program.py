@@ -4,15 +4,28 @@ import tifffile
 import numpy as np
 import numpy as np
 import cv2
+import colorManagement
 import config
 import handleImage
+import handleTiles
+import instrumentation
+import spotCache
+import morphology
+from parallelKernels import parallelKernel
 import math
-from numba import jit, njit
+from numba import jit, njit, prange
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+import os
 
-previewImage = None  # Global variable to hold the preview image
+previewImage = None  # Global variable to hold the preview image (RGBA array of the latest job)
+previewPath = "data/spot_preview.png"
 
-def contractAlphaSmooth(alphaChannel: np.ndarray, pixels: int, blurSigma: float = 1.0, mode: int = 1) -> np.ndarray:
+# Output compression settings mapped to tifffile codec names and TIFF compression tags
+compressionCodecs = {"LZW": ("lzw", 5), "Deflate": ("zlib", 8), "ZSTD": ("zstd", 50000), "PackBits": ("packbits", 32773)}
+compressionStripBytes = 1 << 18 # Size of each compressed strip, small enough to spread over all cores
+
+def contractAlphaSmooth(alphaChannel: np.ndarray, pixels: int, blurSigma: float = 1.0, mode: int = 1, engine: str = None) -> np.ndarray:
     # Create a mask from the alpha channel and apply Gaussian blur
     if pixels <= 0:
         return alphaChannel
@@ -24,17 +37,8 @@ def contractAlphaSmooth(alphaChannel: np.ndarray, pixels: int, blurSigma: float
         # Binary mask
         mask = (alphaNorm > 0.01).astype(np.uint8)
 
-        # Pad with background so borders shrink correctly
-        mask = np.pad(mask, ((1, 1), (1, 1)), mode='constant', constant_values=0)
-
-        # Elliptical kernel gives smoother contraction
-        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE,(2 * pixels + 1, 2 * pixels + 1))
-
-        # Erode once with the appropriately sized kernel
-        mask = cv2.erode(mask, kernel, borderType=cv2.BORDER_CONSTANT, borderValue=0)
-
-        # Remove padding
-        mask = mask[pixels:-pixels, pixels:-pixels]
+        # Erode with an elliptical kernel (gives smoother contraction), the borders count as background so they shrink too
+        mask = morphology.erodeEllipse(mask, pixels, engine)
 
         # Apply contracted mask to original alpha
         contracted = (alphaNorm * mask * 255).astype(np.uint8)
@@ -75,12 +79,97 @@ def contractAlphaSmooth(alphaChannel: np.ndarray, pixels: int, blurSigma: float
          
     return alphaChannel
 
+def getCompressionOptions(settings: config.SettingsSnapshot, rowBytes: int) -> dict:
+    # tifffile options for the compression chosen in the settings, empty when writing uncompressed
+    codec = compressionCodecs.get(settings.compression)
+    if codec is None:
+        return {}
+    options = {
+        "compression": codec[0],
+        "rowsperstrip": max(1, compressionStripBytes // rowBytes),
+        "maxworkers": os.cpu_count() or 1
+    }
+    if settings.compressionLevel > 0 and codec[0] in ("zlib", "zstd"):
+        options["compressionargs"] = {"level": settings.compressionLevel}
+    if codec[0] != "packbits":
+        options["predictor"] = True # Horizontal differencing, makes flat areas compress much better
+    return options
+
+def getSpotHalo(settings: config.SettingsSnapshot) -> int:
+    # How many pixels around a region can change the spot inside it. Used when the image is
+    # processed in strips so every strip gets enough context to match a full-image run exactly.
+    margin = settings.margin
+    halo = 0
+    if margin > 0:
+        if settings.marginMode == 1:
+            halo += margin + 2 # Erode kernel radius, border padding and bilateral filter
+        else:
+            halo += math.ceil(margin / 0.95) + 2 + 4 # Chamfer distance and gaussian blur radius
+    if settings.fillgaps:
+        halo += 2 * math.floor(margin / 2) + 1 # Dilate + erode of the closing
+    return halo
+
+def computeSpot(c: np.ndarray, m: np.ndarray, y: np.ndarray, k: np.ndarray, alphaChannel: np.ndarray, settings: config.SettingsSnapshot, white: np.ndarray = None) -> np.ndarray:
+    smartSpot = settings.getSmartOptions()
+
+    with instrumentation.stage("contractAlphaSmooth", alphaChannel.shape):
+        spotChannel = np.copy(alphaChannel)  # Copy alpha channel to spot channel
+        spotSized = contractAlphaSmooth(spotChannel, pixels=settings.margin, mode=settings.marginMode) # Contract the alpha channel
+    
+    if True in smartSpot:
+        with instrumentation.stage("fixSpotSmart", alphaChannel.shape):
+            spotSized = fixSpotSmart(c, m, y, k, alphaChannel, spotSized, settings.margin, smartSpot, white) # Function to fix the spot channel "smartly"
+
+    return spotSized.astype(np.uint8) # Make sure it is uint8
+
+def getAlphaBounds(alphaChannel: np.ndarray, halo: int = 0) -> tuple:
+    # Bounding box (top, bottom, left, right) of the pixels that are not transparent, grown by halo. None if everything is transparent
+    left, top, width, height = cv2.boundingRect(np.ascontiguousarray(alphaChannel))
+    if width == 0 or height == 0:
+        return None
+    return max(0, top - halo), min(alphaChannel.shape[0], top + height + halo), max(0, left - halo), min(alphaChannel.shape[1], left + width + halo)
+
+def computeSpotRegion(c: np.ndarray, m: np.ndarray, y: np.ndarray, k: np.ndarray, alphaChannel: np.ndarray, settings: config.SettingsSnapshot, white: np.ndarray = None, useCache: bool = True) -> tuple:
+    # Same as computeSpot but only for the part of the image that isn't transparent (and the pixels around it the
+    # spot stages can reach), the spot is empty everywhere else. Returns the spot and the row and column it starts at.
+    # Strips of a tiled job pass useCache=False, they almost never come back and would push whole images out of the cache.
+    bounds = getAlphaBounds(alphaChannel, getSpotHalo(settings))
+    if bounds is None:
+        return np.zeros((0, 0), dtype=np.uint8), 0, 0
+    top, bottom, left, right = bounds
+    c, m, y, k, alphaChannel = [layer[top:bottom, left:right] for layer in (c, m, y, k, alphaChannel)]
+    if white is not None:
+        white = white[top:bottom, left:right]
+    elif settings.copywhite:
+        white = handleImage.getWhiteArray(c, m, y, k, alphaChannel)
+
+    if not useCache:
+        return computeSpot(c, m, y, k, alphaChannel, settings, white), top, left
+
+    # The same shape with the same settings gives the same spot, the colours only matter for copy white
+    with instrumentation.stage("spotCache", alphaChannel.shape):
+        key = spotCache.getKey(alphaChannel, white if settings.copywhite else None, settings.margin, settings.marginMode, settings.getSmartOptions())
+        spot = spotCache.get(key)
+    if spot is None:
+        spot = spotCache.put(key, computeSpot(c, m, y, k, alphaChannel, settings, white))
+    return spot, top, left
+
 def getResolutionTag(dpi: int=300) -> tuple:
     resolution = (dpi, dpi)
     resolutionUnit = 'inch'
     return resolution, resolutionUnit
 
-@njit
+@parallelKernel
+@njit(parallel=True, cache=True)
+def applyWhite(spotLayer: np.ndarray, white: np.ndarray) -> np.ndarray:
+    # Same as extractWhite but with the white pixels already found (see handleImage.splitImageToCmyk)
+    for i in prange(spotLayer.shape[0]):
+        for j in range(spotLayer.shape[1]):
+            if spotLayer[i, j] != 255 and white[i, j] != 0:
+                spotLayer[i, j] = white[i, j]
+    return spotLayer
+
+@njit(cache=True)
 def extractWhite(c: np.ndarray, m: np.ndarray, y: np.ndarray, k: np.ndarray, a: np.ndarray, spotLayer: np.ndarray) -> tuple:
     for i in range(a.shape[0]):
         for j in range(a.shape[1]):
@@ -94,15 +183,17 @@ def extractWhite(c: np.ndarray, m: np.ndarray, y: np.ndarray, k: np.ndarray, a:
     return spotLayer
 
 # Function to "fix" diffrent things in the spot layer
-def fixSpotSmart(c: np.ndarray, m: np.ndarray, y: np.ndarray, k: np.ndarray, a: np.ndarray, spotLayer: np.ndarray, usedMargin: int, options: tuple) -> np.ndarray:
+def fixSpotSmart(c: np.ndarray, m: np.ndarray, y: np.ndarray, k: np.ndarray, a: np.ndarray, spotLayer: np.ndarray, usedMargin: int, options: tuple, white: np.ndarray = None, engine: str = None) -> np.ndarray:
     if options[0]: # If copy white is enabled
-        spotLayer = extractWhite(c, m, y, k, a, spotLayer)  # Extract white pixels if copy white is enabled
+        if white is not None:
+            spotLayer = applyWhite(spotLayer, white)
+        else:
+            spotLayer = extractWhite(c, m, y, k, a, spotLayer)  # Extract white pixels if copy white is enabled
     
     if options[1]: # If fill gaps is enabled
         # Use morphological operations to fill gaps in the spot layer
         holeSize = math.floor(usedMargin/2)
-        kernel = np.ones((holeSize * 2 + 1, holeSize * 2 + 1), np.uint8)
-        spotLayer = cv2.morphologyEx(spotLayer, cv2.MORPH_CLOSE, kernel)            
+        spotLayer = morphology.closeSquare(spotLayer, holeSize, engine)
 
     return spotLayer
 
@@ -115,13 +206,23 @@ def generateRGBAimage(alphaChannel: np.ndarray, spotChannel: np.ndarray, r: np.n
     rgbaImage = np.stack([r, g, b, alphaChannel], axis=-1)  # Stack RGB channels
     return rgbaImage
 
-def generateSpotPreview(c: np.ndarray, m: np.ndarray, y: np.ndarray, k: np.ndarray, alphaChannel: np.ndarray, spotChannel: np.ndarray, spotColor=(0, 255, 255)) -> None:
+def getPreviewStep(height: int, width: int, maxEdge: int) -> int:
+    # Keep every n:th row and column so the longest side of the preview is at most maxEdge
+    if maxEdge <= 0:
+        return 1
+    return max(1, math.ceil(max(height, width) / maxEdge))
+
+def generateSpotPreview(c: np.ndarray, m: np.ndarray, y: np.ndarray, k: np.ndarray, alphaChannel: np.ndarray, spotChannel: np.ndarray, spotColor=(0, 255, 255), maxEdge: int = 0) -> np.ndarray:
+    # The preview is kept in memory, it is only encoded when it is shown or saved
+    global previewImage
+    step = getPreviewStep(alphaChannel.shape[0], alphaChannel.shape[1], maxEdge)
+    if step > 1:
+        c, m, y, k, alphaChannel, spotChannel = [layer[::step, ::step] for layer in (c, m, y, k, alphaChannel, spotChannel)]
     r,g,b = handleImage.cmykToRgbArray(c, m, y, k)  # Convert CMYK to RGB
     # Create a preview image with the spot channel
     rgbaImage = generateRGBAimage(alphaChannel, spotChannel, r, g, b, spotColor)  # Generate RGBA image
-    # Create mask for the spot channel and update RGB channels
-    image = Image.fromarray(rgbaImage.astype('uint8'), 'RGBA')
-    image.save("data/spot_preview.png")  # Save the preview image
+    previewImage = rgbaImage.astype('uint8')
+    return previewImage
 
 @jit
 def invertChannel(channel: np.ndarray) -> np.ndarray:
@@ -130,58 +231,129 @@ def invertChannel(channel: np.ndarray) -> np.ndarray:
     return invertedSpot.astype(np.uint8)
 
 def showPreview() -> None:
-    global previewImage
-    try:
-        previewImage.close()  # Try to close the previous image opbject if it exists
-    except:
-        pass
-
-    try:
-        previewImage = Image.open("data/spot_preview.png")  # Load the preview image
-        previewImage.show()
-    except FileNotFoundError:
+    if previewImage is None:
         print("Preview image not found")
+        return
+    Image.fromarray(previewImage, 'RGBA').show()
+
+def savePreview(path: str = previewPath) -> bool:
+    # Write the latest preview to disk, only done when asked for
+    if previewImage is None:
+        return False
+    Image.fromarray(previewImage, 'RGBA').save(path)
+    return True
 
 def getOutputName(inputName) -> str:
     baseName = inputName.rsplit(".", 1)[0]
     newName = f"{baseName}_spot.tif"
     return newName
 
+def startKernelThreads() -> None:
+    # Runs the smallest parallel kernel so numba's threads are started by the calling thread (the window's main thread)
+    dummyArr = np.zeros((1, 1), dtype=np.uint8)
+    applyWhite(np.copy(dummyArr), dummyArr)
+
 def cacheFunctions() -> None: # cache functions with numba
     dummyArr = np.full((200, 200), 100, dtype=np.uint8)
     extractWhite(dummyArr,dummyArr,dummyArr,dummyArr,dummyArr,dummyArr)
     invertChannel(dummyArr)
+    applyWhite(np.copy(dummyArr), dummyArr)
+    applyWhite(np.copy(dummyArr), dummyArr[1:, 1:]) # White cut to the non transparent part of the image
+    # Channels are often views into an RGBA image (strided) and read only (memory mapped or from PIL),
+    # numba compiles a separate version for each kind so warm all of them
+    dummyPixels = np.full((200, 200, 4), 100, dtype=np.uint8)
+    dummyReadOnly = np.full((200, 200, 4), 100, dtype=np.uint8)
+    dummyReadOnly.flags.writeable = False
+    for pixels in (dummyPixels, dummyReadOnly):
+        r, g, b = pixels[..., 0], pixels[..., 1], pixels[..., 2]
+        handleImage.rgbToCmykArray(r, g, b)
+        handleImage.rgbToCmykWhiteArray(r, g, b, dummyArr)
+        handleImage.getWhiteArray(r, g, b, pixels[..., 3], dummyArr)
+    handleImage.rgbToCmykArray(dummyArr, dummyArr, dummyArr)
+    handleImage.rgbToCmykWhiteArray(dummyArr, dummyArr, dummyArr, dummyArr)
+    handleImage.getWhiteArray(dummyArr, dummyArr, dummyArr, dummyArr, dummyArr)
+    morphology.cacheFunctions()
+    colorManagement.cacheFunctions()
     
 
-def getSpotLayerName() -> str:
-    return config.getSetting("spotLayerName")
+def getSpotLayerName(settings: config.SettingsSnapshot = None) -> str:
+    if settings is None:
+        settings = config.getSnapshot()
+    return settings.spotLayerName
 
 def renameToPhotoshopStandard(channelName: str) -> str:
     return channelName.replace("_", " _")
 
-def getPreviewColor():
-    prevColorName = config.getSetting("previewColor")
-    allPrevColors = config.getPreviwColors()
-    return allPrevColors.get(prevColorName, allPrevColors.get(config.getDefaultPreviewColorKey()))
-
-def generateSpotImage(inputName: str, outputName: str) -> None:
-    colorMode = config.getSetting("colorMode")
-    alphaAsSpot = config.getSetting("alphaspot")
-    generator = CMYKTiffGenerator(alphaAsSpot) # Default to cmyk
-    if (colorMode == "RGB"):
-       generator = RGBTiffGenerator(alphaAsSpot)
-    
-    generator.generateSpot(inputName, outputName)
+def getPreviewColor(settings: config.SettingsSnapshot = None):
+    if settings is None:
+        settings = config.getSnapshot()
+    return settings.getPreviewColor()
+
+def getTiffGenerator(settings: config.SettingsSnapshot) -> "TiffGenerator":
+    if (settings.colorMode == "RGB"):
+       return RGBTiffGenerator(settings.alphaspot, settings)
+    return CMYKTiffGenerator(settings.alphaspot, settings) # Default to cmyk
+
+def generateSpotImage(inputName: str, outputName: str, createPreview: bool = True, settings: config.SettingsSnapshot = None, tiled: bool = None) -> None:
+    if settings is None:
+        settings = config.getSnapshot() # Read the settings once for the whole job
+    generator = getTiffGenerator(settings)
+    generator.generateSpot(inputName, outputName, createPreview, tiled)
     
     
-def getOffset() -> tuple:
-    return (config.getSetting("spotOffsetX"), config.getSetting("spotOffsetY"))
-
-def resizeAllLayersToFitOffset(layers: list|set, valueToUse: int) -> list:
-    offsetX, offsetY = getOffset()
+def getConversionKey(settings: config.SettingsSnapshot) -> tuple:
+    # Settings that change the CMYK layers or the spot, outputs with the same key can share them
+    iccKey = (settings.getIccPath(), settings.iccIntent) if settings.colorMode == "CMYK" else None
+    return (iccKey, settings.margin, settings.marginMode, settings.copywhite, settings.fillgaps)
+
+def runConcurrently(functions: list) -> None:
+    # The first one runs on this thread (it reports the progress), the others on their own threads
+    with ThreadPoolExecutor(max_workers=max(1, len(functions) - 1), thread_name_prefix="variant") as pool:
+        futures = [pool.submit(function) for function in functions[1:]]
+        functions[0]()
+        for future in futures:
+            future.result() # Raises the error of a failed output
+
+def generateSpotVariants(inputName: str, variants: list, createPreview: bool = True, tiled: bool = None) -> None:
+    # Several outputs from one input, variants is a list of (outputName, settings) and each can have its own colour mode,
+    # alpha as spot, spot name, dpi and ICC profile. The image is read once (EPS files at the size of the first variant),
+    # variants with the same conversion and spot settings share them, and the outputs are written at the same time.
+    # The preview is made for the first variant.
+    generators = [(outputName, getTiffGenerator(settings)) for outputName, settings in variants]
+    if tiled is None:
+        tiled = handleTiles.shouldUseTiles(inputName)
+    if tiled:
+        # Large prints are streamed from the file for every output, nothing is kept in memory to share
+        runConcurrently([lambda index=index, outputName=outputName, generator=generator: generator.generateSpot(inputName, outputName, createPreview and index == 0, True) for index, (outputName, generator) in enumerate(generators)])
+        return
+
+    with instrumentation.job(inputName): # Writes nothing itself, every output is written by its own job
+        decoded = handleImage.decodeImage(inputName, generators[0][1].settings)
+        shared = dict()
+        for outputName, generator in generators:
+            key = getConversionKey(generator.settings)
+            if key not in shared:
+                shared[key] = generator.computeSpotLayers(decoded)
+    del decoded # The layers hold what they need, the rest of the decoded image can be freed
+
+    def write(index: int, outputName: str, generator: TiffGenerator) -> None:
+        with instrumentation.job(inputName, outputName):
+            generator.writeSpotFull(outputName, *shared[getConversionKey(generator.settings)], createPreview=createPreview and index == 0)
+
+    runConcurrently([lambda index=index, outputName=outputName, generator=generator: write(index, outputName, generator) for index, (outputName, generator) in enumerate(generators)])
+
+def getOffset(settings: config.SettingsSnapshot = None) -> tuple:
+    if settings is None:
+        settings = config.getSnapshot()
+    return settings.getOffset()
+
+def resizeAllLayersToFitOffset(layers: list|set, valueToUse: int, offset: tuple = None) -> list:
+    offsetX, offsetY = offset if offset is not None else getOffset()
 
     padX = int(abs(offsetX))
     padY = int(abs(offsetY))
+    if padX == 0 and padY == 0:
+        return list(layers) # Nothing to pad, avoid copying every layer
 
     padded = []
     
@@ -192,19 +364,24 @@ def resizeAllLayersToFitOffset(layers: list|set, valueToUse: int) -> list:
 
     return padded
 
-def offsetSpot(spot: np.ndarray) -> np.ndarray:
-    offsetX, offsetY = getOffset()
+def offsetSpot(spot: np.ndarray, offset: tuple = None) -> np.ndarray:
+    offsetX, offsetY = offset if offset is not None else getOffset()
     # offset = [2., 3.]
     # offset = np.array([offsetX, offsetY], dtype=np.uint8)    
     # spot += offset
+    if offsetX == 0 and offsetY == 0:
+        return spot
     newSpot = np.roll(spot, shift=(offsetY, offsetX), axis=(0, 1))
     return newSpot
     
     
 class TiffGenerator(ABC):
-    def __init__(self, alphaAsSpot):
+    def __init__(self, alphaAsSpot, settings: config.SettingsSnapshot = None):
         super().__init__()
         self.alphaAsSpot = alphaAsSpot
+        if settings is None:
+            settings = config.getSnapshot()
+        self.settings = settings
         
     @abstractmethod
     def getPhotoMetric(self) -> str:
@@ -219,50 +396,31 @@ class TiffGenerator(ABC):
         pass
     
     def getSpotChannelXML(self):
-        spotChannelXML = f"<Channel>{getSpotLayerName()}</Channel>"
+        spotChannelXML = f"<Channel>{getSpotLayerName(self.settings)}</Channel>"
         if self.alphaAsSpot:
             spotChannelXML = ""
         return spotChannelXML
     
-    def generateSpot(self, inputName: str, outputName: str) -> None:
-        margin = config.getSetting("margin")
-        marginMode = config.getSetting("marginMode")
-        smartSpot = [config.getSetting("copywhite"), config.getSetting("fillgaps")]
-        
-        c,m,y,k,alphaChannel = handleImage.splitImageToCmyk(inputName) # Split the image into CMYK channels and alpha channel
-        
-        spotChannel = np.copy(alphaChannel)  # Copy alpha channel to spot channel
-        spotSized = contractAlphaSmooth(spotChannel, pixels=margin, mode=marginMode) # Contract the alpha channel
-        
-        if True in smartSpot:
-            spotSized = fixSpotSmart(c, m, y, k, alphaChannel, spotSized, margin, smartSpot) # Function to fix the spot channel "smartly"
-     
+    def getChannelNames(self) -> list:
+        if self.alphaAsSpot:
+            return ["Alpha"]
+        return ["Alpha", renameToPhotoshopStandard(self.settings.spotLayerName)] # Add channel names for the alpha and spot channels
 
-        spotFixed = spotSized.astype(np.uint8) # Make sure it is uint8
+    def getLayerCount(self) -> int:
+        colorChannels = 4 if self.getPhotoMetric() == 'separated' else 3
+        return colorChannels + len(self.getChannelNames())
+
+    def getWriteOptions(self) -> dict:
+        # Everything besides the image data that is passed on to tifffile when writing
+        settings = self.settings
 
-        c, m, y, k, alphaChannel, spotResize = resizeAllLayersToFitOffset([c, m, y, k, alphaChannel, spotFixed], 0)
-        spotOffset = offsetSpot(spotResize)
-        
-        if self.alphaAsSpot:
-            channelNames = ["Alpha"]
-        else:
-            channelNames = ["Alpha", renameToPhotoshopStandard(getSpotLayerName())] # Add channel names for the alpha and spot channels
-        
-        spotSend = invertChannel(spotOffset)
-        alphaSend = alphaChannel
-        data = np.stack(self.generateLayerList(c, m, y, k, alphaSend, spotSend), axis=-1) # Add the layers together in the correct order
-        
-        
-        alphaPatch = np.maximum(alphaChannel, spotOffset)
-        generateSpotPreview(c, m, y, k, alphaPatch, invertChannel(spotOffset), getPreviewColor())  # Generate a preview image of the spot layer
-        
         # Create a list of channel names, including the spot channel
         ir = TiffImageResources(
             psdformat=True,
             blocks=[
                 PsdPascalStringsBlock(
                     resourceid=PsdResourceId.ALPHA_NAMES_PASCAL,
-                    values=channelNames
+                    values=self.getChannelNames()
                 ),
             ]
         )
@@ -271,7 +429,7 @@ class TiffGenerator(ABC):
 
         # Load ICC profile
         iccTag = None
-        iccPath = config.getSelectedIcc()
+        iccPath = settings.getIccPath()
         if (iccPath):
             try:
                 with open(iccPath, "rb") as f:
@@ -310,24 +468,154 @@ class TiffGenerator(ABC):
             extrasamples = [2, 0]
         
         # Get resolution tag
-        resolution, resolutionUnit = getResolutionTag(dpi=config.getSetting("dpi"))
+        resolution, resolutionUnit = getResolutionTag(dpi=settings.dpi)
         
-        # Write the TIFF image
+        return {
+            "photometric": self.getPhotoMetric(),
+            "planarconfig": 'contig',
+            "extrasamples": extrasamples,
+            "description": xmlDescription,
+            "extratags": extratags,
+            "resolution": resolution,
+            "resolutionunit": resolutionUnit
+        }
+
+    def generateSpot(self, inputName: str, outputName: str, createPreview: bool = True, tiled: bool = None) -> None:
+        with instrumentation.job(inputName, outputName):
+            if tiled is None:
+                tiled = handleTiles.shouldUseTiles(inputName)
+            if tiled:
+                self.generateSpotTiled(inputName, outputName, createPreview)
+            else:
+                self.generateSpotFull(inputName, outputName, createPreview)
+
+    def assembleStrip(self, outStart: int, rows: int, outWidth: int, layers: list, layerTop: int, spot: np.ndarray, spotTop: int, spotLeft: int, preview: handleTiles.PreviewCollector = None) -> np.ndarray:
+        # One strip of the output, the layers (from source row layerTop) and the shifted spot are placed straight into it
+        offsetX, offsetY = self.settings.getOffset()
+        padX, padY = abs(offsetX), abs(offsetY)
+        layerStart = outStart - padY
+        c, m, y, k, alphaChannel = [handleTiles.placeRows(layer, layerTop, layerStart, rows, padX, outWidth) for layer in layers]
+        spotOffset = handleTiles.placeRows(spot, spotTop, layerStart - offsetY, rows, padX + offsetX + spotLeft, outWidth)
+
+        if preview is not None:
+            preview.add(outStart, c, m, y, k, np.maximum(alphaChannel, spotOffset), spotOffset)
+
+        return np.stack(self.generateLayerList(c, m, y, k, alphaChannel, invertChannel(spotOffset)), axis=-1)
+
+    def writeStrips(self, outputName: str, strips, outHeight: int, outWidth: int, stripRows: int, compression: dict) -> None:
+        layerCount = self.getLayerCount()
+        options = self.getWriteOptions()
+        if compression:
+            # Strips are compressed on worker threads while the next ones are computed
+            strips = handleTiles.compressStrips(strips, compression)
+            options["compression"] = compression["compression"]
+            options["predictor"] = compression.get("predictor", False)
         tifffile.imwrite(
             outputName,
-            data,
-            photometric=self.getPhotoMetric(),
-            planarconfig='contig',
-            extrasamples=extrasamples,
-            description=xmlDescription,
-            extratags=extratags,
-            resolution=resolution,
-            resolutionunit=resolutionUnit
+            strips,
+            shape=(outHeight, outWidth, layerCount),
+            dtype=np.uint8,
+            rowsperstrip=stripRows,
+            bigtiff=handleTiles.needsBigTiff(outHeight * outWidth * layerCount),
+            **options
         )
+
+    def generateSpotFull(self, inputName: str, outputName: str, createPreview: bool = True) -> None:
+        layers, spot, spotTop, spotLeft = self.computeSpotLayers(handleImage.decodeImage(inputName, self.settings))
+        self.writeSpotFull(outputName, layers, spot, spotTop, spotLeft, createPreview)
+
+    def computeSpotLayers(self, decoded: handleImage.DecodedImage) -> tuple:
+        # Everything before the output is written: the c, m, y, k and alpha layers and the spot
+        settings = self.settings
+        white = None
+        if settings.copywhite:
+            c,m,y,k,alphaChannel,white = handleImage.convertImage(decoded, withWhite=True, settings=settings) # White pixels are found while converting
+        else:
+            c,m,y,k,alphaChannel = handleImage.convertImage(decoded, settings=settings) # Split the image into CMYK channels and alpha channel
+        
+        instrumentation.progress(0.3)
+
+        # Most prints are a design on a transparent canvas, only the part with the design goes through the spot stages
+        spot, spotTop, spotLeft = computeSpotRegion(c, m, y, k, alphaChannel, settings, white)
+        instrumentation.progress(0.6)
+        return [c, m, y, k, alphaChannel], spot, spotTop, spotLeft
+
+    def writeSpotFull(self, outputName: str, layers: list, spot: np.ndarray, spotTop: int, spotLeft: int, createPreview: bool = True) -> None:
+        settings = self.settings
+        offsetX, offsetY = settings.getOffset()
+        padX, padY = abs(offsetX), abs(offsetY)
+
+        # The output is written in strips, so the padding for the offset and the shift of the spot never need a full size copy
+        height, width = layers[4].shape
+        outHeight, outWidth = height + 2 * padY, width + 2 * padX
+        compression = getCompressionOptions(settings, outWidth * self.getLayerCount())
+        stripRows = compression.get("rowsperstrip", handleTiles.stripRows)
+        preview = handleTiles.PreviewCollector(getPreviewStep(outHeight, outWidth, settings.previewMaxEdge)) if createPreview else None
+
+        def generateStrips():
+            for outStart in range(0, outHeight, stripRows):
+                instrumentation.progress(0.6 + 0.35 * outStart / outHeight)
+                yield self.assembleStrip(outStart, min(stripRows, outHeight - outStart), outWidth, layers, 0, spot, spotTop, spotLeft, preview)
+
+        with instrumentation.stage("write", (outHeight, outWidth)):
+            self.writeStrips(outputName, generateStrips(), outHeight, outWidth, stripRows, compression)
+
+        if preview is not None:
+            c, m, y, k, alphaPatch, spotOffset = preview.getLayers()
+            with instrumentation.stage("generateSpotPreview", spotOffset.shape):
+                generateSpotPreview(c, m, y, k, alphaPatch, invertChannel(spotOffset), settings.getPreviewColor())
+
+    def generateSpotTiled(self, inputName: str, outputName: str, createPreview: bool = True) -> None:
+        # Same result as generateSpot but the image is read, processed and written one strip at a time,
+        # so the memory used depends on the strip size and not on the size of the print.
+        settings = self.settings
+        offsetX, offsetY = settings.getOffset()
+        padX, padY = abs(offsetX), abs(offsetY)
+        halo = getSpotHalo(settings)
+        stripRows = handleTiles.stripRows
+
+        with handleTiles.TiffStripReader(inputName, settings) as reader:
+            height, width = reader.height, reader.width
+            outHeight, outWidth = height + 2 * padY, width + 2 * padX
+            preview = handleTiles.PreviewCollector(getPreviewStep(outHeight, outWidth, settings.previewMaxEdge)) if createPreview else None
+
+            def generateStrips():
+                for outStart in range(0, outHeight, stripRows):
+                    instrumentation.progress(0.95 * outStart / outHeight)
+                    outEnd = min(outStart + stripRows, outHeight)
+                    # Rows in the source image needed for the layers and the (shifted) spot in this strip
+                    layerStart, layerEnd = outStart - padY, outEnd - padY
+                    spotStart, spotEnd = layerStart - offsetY, layerEnd - offsetY
+                    readStart = max(0, min(layerStart, spotStart) - halo)
+                    readEnd = min(height, max(layerEnd, spotEnd) + halo)
+
+                    if readStart < readEnd:
+                        white = None
+                        with instrumentation.stage("readRows", (readEnd - readStart, width)):
+                            if settings.copywhite:
+                                c, m, y, k, alphaChannel, white = reader.readRows(readStart, readEnd, withWhite=True)
+                            else:
+                                c, m, y, k, alphaChannel = reader.readRows(readStart, readEnd)
+                        spot, spotTop, spotLeft = computeSpotRegion(c, m, y, k, alphaChannel, settings, white, useCache=False)
+                    else:
+                        c = m = y = k = alphaChannel = spot = np.zeros((0, width), dtype=np.uint8)
+                        spotTop, spotLeft = 0, 0
+
+                    with instrumentation.stage("assembleStrip", (outEnd - outStart, outWidth)):
+                        strip = self.assembleStrip(outStart, outEnd - outStart, outWidth, [c, m, y, k, alphaChannel], readStart, spot, readStart + spotTop, spotLeft, preview)
+                    yield strip
+
+            with instrumentation.stage("write", (outHeight, outWidth)):
+                self.writeStrips(outputName, generateStrips(), outHeight, outWidth, stripRows, getCompressionOptions(settings, outWidth * self.getLayerCount()))
+
+        if preview is not None:
+            c, m, y, k, alphaPatch, spotOffset = preview.getLayers()
+            with instrumentation.stage("generateSpotPreview", spotOffset.shape):
+                generateSpotPreview(c, m, y, k, alphaPatch, invertChannel(spotOffset), settings.getPreviewColor())
     
 class CMYKTiffGenerator(TiffGenerator):
-    def __init__(self, alphaAsSpot):
-        super().__init__(alphaAsSpot)
+    def __init__(self, alphaAsSpot, settings: config.SettingsSnapshot = None):
+        super().__init__(alphaAsSpot, settings)
     
     def getPhotoMetric(self) -> str:
         return 'separated'
@@ -353,8 +641,8 @@ class CMYKTiffGenerator(TiffGenerator):
         """
         
 class RGBTiffGenerator(TiffGenerator):
-    def __init__(self, alphaAsSpot):
-        super().__init__(alphaAsSpot)
+    def __init__(self, alphaAsSpot, settings: config.SettingsSnapshot = None):
+        super().__init__(alphaAsSpot, settings)
     
     def getPhotoMetric(self) -> str:
         return 'rgb'
@@ -0,0 +1,414 @@
+import argparse
+import json
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import batch
+import config
+import handleEPS
+import metrics
+import morphology
+import presetRegistry
+import program
+import spotCache
+
+defaultPort = 8765
+workerMemory = 1 << 30 # Peak memory of one job, about a 64 megapixel print (larger ones are processed in strips)
+defaultMaxUpload = 2048 # MB
+chunkSize = 1 << 20 # Uploads and outputs are copied in pieces of this size, never held in memory
+uploadTypes = {"image/png": ".png", "image/tiff": ".tif", "application/postscript": ".eps", "image/x-eps": ".eps"}
+
+class RequestError(Exception):
+    # Answered with status and the message as JSON
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+def getAvailableMemory() -> int:
+    # Memory that can be used without swapping, including the page cache the kernel can drop. None when it
+    # can't be read (not on Linux)
+    try:
+        with open("/proc/meminfo", "rb") as f:
+            for line in f:
+                if line.startswith(b"MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def getMemoryWorkers() -> int:
+    # Number of jobs that fit in the available memory, None when it can't be read
+    available = getAvailableMemory()
+    if available is None:
+        return None
+    return max(1, available // workerMemory)
+
+def getServiceWorkers(workers: int) -> int:
+    # 0 uses one worker per core, but never more than fit in the available memory
+    if workers > 0:
+        return workers
+    memoryWorkers = getMemoryWorkers()
+    return min(batch.getWorkerCount(0), memoryWorkers) if memoryWorkers else batch.getWorkerCount(0)
+
+def initWorker(*args) -> None:
+    # Ctrl+C is handled by the main process, which lets the workers finish the jobs they are converting
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    batch.initWorker(*args)
+
+def renderFile(inputName: str, outputName: str, settings: config.SettingsSnapshot, previewName: str = None) -> batch.BatchResult:
+    # Runs in a worker, the preview is only made when it's asked for
+    result = batch.BatchResult(inputName, outputName)
+    start = time.perf_counter()
+    try:
+        program.generateSpotImage(inputName, outputName, createPreview=previewName is not None, settings=settings)
+        if previewName is not None and not program.savePreview(previewName):
+            result.error = "No preview was made"
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    result.seconds = time.perf_counter() - start
+    if metrics.enabled:
+        result.metrics = metrics.takeSamples()
+    return result
+
+class RenderService():
+    # Pool of warm workers shared by every request. At most workers + queueSize jobs are taken at once, requests
+    # over that are turned away right away (503) instead of waiting, so a burst can't fill the memory with uploads.
+    def __init__(self, workers: int, queueSize: int, tasksPerWorker: int = None, tempDir: str = None):
+        self.workers = workers
+        self.queueSize = queueSize
+        self.tasksPerWorker = tasksPerWorker
+        self.tempDir = tempDir
+        self.slots = threading.BoundedSemaphore(workers + queueSize)
+        self.lock = threading.Lock()
+        self.pool = None
+        self.taken = 0
+        self.served = 0
+        self.failed = 0
+        self.rejected = 0
+        self.settings = dict() # (preset, changes) -> snapshot, cleared when a preset changes
+        self.presetVersion = None
+
+    def start(self) -> None:
+        # Every worker compiles (or loads) the numba functions before the first request arrives
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=initWorker, initargs=(config.getSnapshot(), None, spotCache.enabled, morphology.defaultEngine, handleEPS.useRasterCache, metrics.enabled), max_tasks_per_child=self.tasksPerWorker)
+        wait([self.pool.submit(int) for _ in range(self.workers)])
+
+    def restart(self, brokenPool: ProcessPoolExecutor) -> None:
+        # A worker that died (killed for using too much memory) breaks the whole pool, start a new one once
+        with self.lock:
+            if self.pool is not brokenPool:
+                return
+            brokenPool.shutdown(wait=False, cancel_futures=True)
+            self.start()
+
+    def stop(self) -> None:
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+
+    def getSettings(self, presetName: str = None, changes: dict = None) -> config.SettingsSnapshot:
+        unknown = [key for key in (changes or dict()).keys() if not config.checkIfValidSetting(key)]
+        if unknown:
+            raise RequestError(400, f"Unknown settings: {', '.join(unknown)}")
+        if not all(isinstance(value, (str, int, float, bool)) for value in (changes or dict()).values()):
+            raise RequestError(400, "Setting values must be strings, numbers or booleans")
+        iccProfile = (changes or dict()).get("iccProfile")
+        if iccProfile is not None and iccProfile != config.getStandardValues()["iccProfile"] and iccProfile not in config.getIccProfiles():
+            raise RequestError(400, f"ICC profile not found in data/icc: {iccProfile}")
+        key = (presetName, tuple(sorted((changes or dict()).items())))
+        with self.lock:
+            presetRegistry.registry.update()
+            if presetRegistry.registry.version != self.presetVersion:
+                self.settings.clear()
+                self.presetVersion = presetRegistry.registry.version
+            settings = self.settings.get(key)
+        if settings is None:
+            try:
+                settings = batch.captureSettings(presetName, changes)
+            except ValueError as e:
+                raise RequestError(400, str(e))
+            with self.lock:
+                self.settings[key] = settings
+        return settings
+
+    def acquire(self) -> None:
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise RequestError(503, "All workers are busy and the queue is full, try again later")
+        with self.lock:
+            self.taken += 1
+
+    def release(self) -> None:
+        with self.lock:
+            self.taken -= 1
+        self.slots.release()
+
+    def submit(self, *args) -> tuple:
+        # Another request's restart may have just shut the pool down (RuntimeError) or it broke before anyone
+        # restarted it, then the new pool is tried once. Returns the pool and the future.
+        for _ in range(2):
+            pool = self.pool
+            try:
+                return pool, pool.submit(renderFile, *args)
+            except (RuntimeError, BrokenProcessPool):
+                self.restart(pool) # Waits for a restart that is already running
+        raise RequestError(503, "The workers are being restarted, try again later")
+
+    def render(self, inputName: str, outputName: str, settings: config.SettingsSnapshot, previewName: str = None) -> batch.BatchResult:
+        pool, future = self.submit(inputName, outputName, settings, previewName)
+        try:
+            result = future.result()
+        except BrokenProcessPool:
+            self.restart(pool)
+            result = batch.BatchResult(inputName, outputName)
+            result.error = "The worker stopped while converting (out of memory?)"
+        with self.lock:
+            if result.succeeded():
+                self.served += 1
+            else:
+                self.failed += 1
+        if metrics.enabled:
+            metrics.registry.addResult(result)
+        return result
+
+    def getStatus(self) -> dict:
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "queueSize": self.queueSize,
+                "running": min(self.taken, self.workers),
+                "queued": max(0, self.taken - self.workers),
+                "served": self.served,
+                "failed": self.failed,
+                "rejected": self.rejected
+            }
+
+    def getMetrics(self) -> str:
+        status = self.getStatus()
+        metrics.registry.setGauge("workers", status["workers"], "Worker processes converting files")
+        metrics.registry.setGauge("busy_workers", status["running"], "Requests being converted")
+        metrics.registry.setGauge("queue_depth", status["queued"], "Requests waiting for a worker")
+        metrics.registry.setCounter("rejected_requests_total", status["rejected"], "Requests answered with 503 because the queue was full")
+        return metrics.registry.render()
+
+class RenderHandler(BaseHTTPRequestHandler):
+    # GET /health, GET /presets, GET /metrics and POST /render, see the README for the parameters
+    protocol_version = "HTTP/1.1"
+    server_version = "Speedyspot"
+
+    def log_message(self, format: str, *args) -> None:
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def sendJson(self, status: int, data: dict, headers: dict = None) -> None:
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def sendFile(self, path: str, contentType: str, fileName: str, seconds: float) -> None:
+        # Streamed from disk, a print of several GB never has to fit in memory
+        self.send_response(200)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.send_header("Content-Disposition", f'attachment; filename="{fileName}"')
+        self.send_header("X-Render-Seconds", f"{seconds:.3f}")
+        self.end_headers()
+        with open(path, "rb") as f:
+            shutil.copyfileobj(f, self.wfile, chunkSize)
+
+    def do_GET(self) -> None:
+        path = urlsplit(self.path).path
+        if path == "/health":
+            self.sendJson(200, dict(status="ok", **self.server.service.getStatus()))
+        elif path == "/presets":
+            self.sendJson(200, {"presets": presetRegistry.registry.getNames()})
+        elif path == "/metrics" and metrics.enabled:
+            body = self.server.service.getMetrics().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.sendJson(404, {"error": f"Not found: {path}"})
+
+    def do_POST(self) -> None:
+        self.bodyRead = False
+        url = urlsplit(self.path)
+        if url.path != "/render":
+            self.discardBody()
+            self.sendJson(404, {"error": f"Not found: {url.path}"})
+            return
+        service = self.server.service
+        try:
+            service.acquire()
+        except RequestError as e:
+            self.discardBody()
+            self.sendJson(e.status, {"error": str(e)}, {"Retry-After": "1"})
+            return
+        workDir = tempfile.mkdtemp(prefix="speedyspot-", dir=service.tempDir)
+        try:
+            try:
+                response = self.handleRender(url.query, workDir)
+            finally:
+                service.release() # Before answering, so a client sending one request after the other is never turned away
+            self.sendFile(*response)
+        except RequestError as e:
+            self.discardBody()
+            self.sendJson(e.status, {"error": str(e)}, {"Retry-After": "1"} if e.status == 503 else None)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True # The client went away, nothing to answer
+        finally:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    def handleRender(self, query: str, workDir: str) -> tuple:
+        # The image is either the body (upload) or a file on this computer given as {"path": ...} in a JSON body.
+        # preset, settings (JSON object) and output (tiff or preview) can be in the query or the JSON body.
+        # Returns the file to answer with, its content type, name and the time the conversion took.
+        options = {name: values[-1] for name, values in parse_qs(query).items()}
+        contentType = self.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        if contentType == "application/json":
+            try:
+                body = json.loads(self.readBody(1 << 20))
+            except ValueError:
+                raise RequestError(400, "The body is not valid JSON")
+            if not isinstance(body, dict) or "path" not in body:
+                raise RequestError(400, 'The JSON body needs the "path" of the image')
+            options.update({name: value for name, value in body.items() if name != "path"})
+            inputName = os.path.abspath(str(body["path"]))
+            if not os.path.isfile(inputName):
+                raise RequestError(404, f"File not found: {inputName}")
+        else:
+            inputName = self.receiveUpload(options.get("name"), contentType, workDir)
+        if not batch.isAcceptedFile(inputName):
+            raise RequestError(400, f"Not a TIFF, PNG or EPS file: {os.path.basename(inputName)}")
+
+        changes = options.get("settings")
+        if isinstance(changes, str):
+            try:
+                changes = json.loads(changes)
+            except ValueError:
+                raise RequestError(400, "settings is not valid JSON")
+        if changes is not None and not isinstance(changes, dict):
+            raise RequestError(400, "settings must be a JSON object")
+        settings = self.server.service.getSettings(options.get("preset"), changes)
+
+        output = options.get("output", "tiff")
+        if output not in ("tiff", "preview"):
+            raise RequestError(400, "output must be tiff or preview")
+        outputName = os.path.join(workDir, os.path.basename(program.getOutputName(inputName)))
+        previewName = os.path.join(workDir, "preview.png") if output == "preview" else None
+        result = self.server.service.render(inputName, outputName, settings, previewName)
+        if not result.succeeded():
+            raise RequestError(422, result.error)
+        if previewName is not None:
+            return previewName, "image/png", os.path.basename(outputName)[:-len(".tif")] + "_preview.png", result.seconds
+        return outputName, "image/tiff", os.path.basename(outputName), result.seconds
+
+    def getBodyLength(self) -> int:
+        length = self.headers.get("Content-Length")
+        if length is None:
+            raise RequestError(411, "Content-Length is needed")
+        try:
+            return int(length)
+        except ValueError:
+            raise RequestError(400, "Content-Length is not a number")
+
+    def readBody(self, maxBytes: int) -> bytes:
+        length = self.getBodyLength()
+        if length > maxBytes:
+            raise RequestError(413, f"The body is larger than {maxBytes} bytes")
+        data = self.rfile.read(length)
+        self.bodyRead = True
+        return data
+
+    def receiveUpload(self, fileName: str, contentType: str, workDir: str) -> str:
+        # Written to the job's folder in pieces, the extension comes from the name or else the content type
+        length = self.getBodyLength()
+        if length > self.server.maxUpload:
+            raise RequestError(413, f"The upload is larger than {self.server.maxUpload // (1 << 20)} MB")
+        if fileName:
+            fileName = os.path.basename(fileName)
+        elif contentType in uploadTypes:
+            fileName = "upload" + uploadTypes[contentType]
+        else:
+            raise RequestError(400, "Give the file name with ?name= or a Content-Type of image/png, image/tiff or application/postscript")
+        inputName = os.path.join(workDir, fileName)
+        with open(inputName, "wb") as f:
+            while length > 0:
+                data = self.rfile.read(min(chunkSize, length))
+                if not data:
+                    raise RequestError(400, "The upload ended early")
+                f.write(data)
+                length -= len(data)
+        self.bodyRead = True
+        return inputName
+
+    def discardBody(self) -> None:
+        # A body that wasn't read would be taken as the next request, close the connection instead
+        if not self.bodyRead and self.headers.get("Content-Length", "0") != "0":
+            self.close_connection = True
+
+class RenderServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple, service: RenderService, maxUpload: int, quiet: bool = False):
+        super().__init__(address, RenderHandler)
+        self.service = service
+        self.maxUpload = maxUpload
+        self.quiet = quiet
+
+def parseArgs(argv: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="server", description="Convert images sent over HTTP with a pool of warm workers")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1, only this computer)")
+    parser.add_argument("--port", type=int, default=defaultPort, help=f"Port to listen on, 0 picks a free one (default: {defaultPort})")
+    parser.add_argument("-p", "--preset", default=None, help="Preset the workers start with (default: the current settings)")
+    parser.add_argument("-j", "--workers", type=int, default=0, help="Number of files to convert at the same time, 0 uses one per CPU core as far as the available memory allows (default: 0)")
+    parser.add_argument("-q", "--queue", type=int, default=None, help="Requests that can wait for a worker, more are answered with 503 (default: 2 per worker)")
+    parser.add_argument("--tasks-per-worker", type=int, default=None, help="Restart a worker after this many files to keep its memory use bounded")
+    parser.add_argument("--max-upload", type=int, default=defaultMaxUpload, help=f"Largest upload accepted in MB (default: {defaultMaxUpload})")
+    parser.add_argument("--temp", default=None, help="Folder for uploads and outputs while they are converted (default: the system's temp folder)")
+    parser.add_argument("--no-spot-cache", action="store_true", help="Always compute the spot layer, don't reuse masks of shapes converted before")
+    parser.add_argument("--no-metrics", action="store_true", help="Don't collect the metrics served at /metrics")
+    parser.add_argument("--quiet", action="store_true", help="Don't log every request")
+    return parser.parse_args(argv)
+
+def main(argv: list = None) -> int:
+    args = parseArgs(sys.argv[1:] if argv is None else argv)
+    config.setupProgram()
+    spotCache.enabled = not args.no_spot_cache
+    if not args.no_metrics:
+        metrics.enable()
+    if args.preset:
+        config.pinSettings(batch.captureSettings(args.preset))
+
+    workers = getServiceWorkers(args.workers)
+    service = RenderService(workers, args.queue if args.queue is not None else workers * 2, args.tasks_per_worker, args.temp)
+    service.start()
+    server = RenderServer((args.host, args.port), service, args.max_upload << 20, args.quiet)
+    host, port = server.server_address[:2]
+    print(f"Listening on http://{host}:{port} ({workers} workers, {service.queueSize} queued)", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping, files being converted are finished first")
+    finally:
+        server.server_close()
+        service.stop()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -78,5 +78,37 @@ class Settings(ctk.CTkFrame):
         
         ctk.CTkLabel(iccFrame, text="ICC Profile").grid(row=0, column=1, padx=10, pady=(10, 0))
         ctk.CTkOptionMenu(iccFrame, values=iccProfiles, variable=self.iccProfile).grid(row=1, column=1)
+
+        # How colours the CMYK profile can't print are moved into its range
+        ctk.CTkLabel(iccFrame, text="Rendering intent").grid(row=2, column=1, padx=10, pady=(10, 0))
+        self.iccIntent = ctk.StringVar()
+        settingsHandler.addSetting("iccIntent", self.iccIntent)
+        ctk.CTkOptionMenu(iccFrame, values=["Perceptual", "Relative colorimetric", "Saturation", "Absolute colorimetric"], variable=self.iccIntent).grid(row=3, column=1)
         iccFrame.grid(row=8, column=0, padx=10, pady=0, columnspan=2)
+
+        compressionFrame = ctk.CTkFrame(self, fg_color="transparent", width=300, height=40)
+        ctk.CTkLabel(compressionFrame, text="Compression").grid(row=0, column=0, padx=10, pady=(10, 0))
+        self.compression = ctk.StringVar()
+        settingsHandler.addSetting("compression", self.compression)
+        ctk.CTkOptionMenu(compressionFrame, values=["None", "LZW", "Deflate", "ZSTD", "PackBits"], variable=self.compression).grid(row=1, column=0, padx=10)
+        
+        self.levelFilter = self.master.register(lambda text: text.isdigit() or text == "")
+        ctk.CTkLabel(compressionFrame, text="Level (0 = default)").grid(row=0, column=1, padx=10, pady=(10, 0))
+        self.compressionLevel = ctk.StringVar()
+        settingsHandler.addSetting("compressionLevel", self.compressionLevel)
+        ctk.CTkEntry(compressionFrame, textvariable=self.compressionLevel, validate="key", validatecommand=(self.levelFilter, "%P")).grid(row=1, column=1)
+        compressionFrame.grid(row=9, column=0, padx=10, pady=0, columnspan=2)
+
+        # Size EPS files are rendered at without the import popup (batch), 0 = size stored in the file
+        epsFrame = ctk.CTkFrame(self, fg_color="transparent", width=300, height=40)
+        ctk.CTkLabel(epsFrame, text="EPS width (mm, 0 = auto)").grid(row=0, column=0, padx=10, pady=(10, 0))
+        self.epsWidth = ctk.StringVar()
+        settingsHandler.addSetting("epsWidth", self.epsWidth)
+        ctk.CTkEntry(epsFrame, textvariable=self.epsWidth, validate="key", validatecommand=(self.levelFilter, "%P")).grid(row=1, column=0, padx=10)
+
+        ctk.CTkLabel(epsFrame, text="EPS height (mm, 0 = auto)").grid(row=0, column=1, padx=10, pady=(10, 0))
+        self.epsHeight = ctk.StringVar()
+        settingsHandler.addSetting("epsHeight", self.epsHeight)
+        ctk.CTkEntry(epsFrame, textvariable=self.epsHeight, validate="key", validatecommand=(self.levelFilter, "%P")).grid(row=1, column=1)
+        epsFrame.grid(row=10, column=0, padx=10, pady=0, columnspan=2)
         
\ No newline at end of file
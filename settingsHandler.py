@@ -72,6 +72,10 @@ def addSetting(settingName: str, obj: object) -> None:
 # Use with caution: could easly create unintentional loop
 def addFunctionToCallOnUpdate(func: callable):
     functionsToCallOnUpdate.append(func)
+
+def removeFunctionToCallOnUpdate(func: callable):
+    if func in functionsToCallOnUpdate:
+        functionsToCallOnUpdate.remove(func)
     
 def __callFunctions() -> None:
     for func in functionsToCallOnUpdate:
@@ -0,0 +1,145 @@
+import atexit
+import hashlib
+import io
+import queue
+import threading
+from collections import OrderedDict
+import numpy as np
+import morphology
+from diskCache import DiskCache
+
+# Spot masks already computed, so the same shape (in another colour or printed again) skips the spot stages.
+# Kept in memory and in data/spotcache, both limited in size and the least recently used masks are removed first.
+enabled = True
+useDisk = True
+cacheFolder = "data/spotcache"
+memoryBudget = 512 * 2**20 # Bytes of masks kept in memory
+diskBudget = 2 * 2**30 # Bytes of masks kept in cacheFolder
+cacheVersion = 1 # Change when the spot stages change so old masks on disk are not used
+maxPendingWrites = 8 # Masks waiting to be written to disk, more are only kept in memory
+
+lock = threading.Lock()
+memoryCache = OrderedDict()
+memoryBytes = 0
+disk = DiskCache(cacheFolder, diskBudget, ".spot")
+stats = {"memoryHits": 0, "diskHits": 0, "misses": 0, "memoryEvictions": 0}
+pendingWrites = queue.Queue(maxsize=maxPendingWrites)
+writer = None # Thread writing masks to disk, started with the first one
+
+def getKey(alphaChannel: np.ndarray, white: np.ndarray, margin: int, marginMode: int, smartOptions: tuple) -> str:
+    # The spot only depends on the alpha channel, the margin settings and the smart options,
+    # and on the white pixels when copy white is on
+    hasher = hashlib.blake2b(digest_size=20)
+    hasher.update(repr((cacheVersion, morphology.defaultEngine == "euclidean", alphaChannel.shape, margin, marginMode, smartOptions)).encode())
+    hasher.update(np.ascontiguousarray(alphaChannel).data)
+    if white is not None:
+        hasher.update(np.ascontiguousarray(white).data)
+    return hasher.hexdigest()
+
+def get(key: str) -> np.ndarray:
+    if not enabled:
+        return None
+    with lock:
+        spot = memoryCache.get(key)
+        if spot is not None:
+            memoryCache.move_to_end(key)
+            stats["memoryHits"] += 1
+            return spot
+    spot = readDisk(key)
+    with lock:
+        if spot is None:
+            stats["misses"] += 1
+            return None
+        stats["diskHits"] += 1
+        addToMemory(key, spot)
+    return spot
+
+def put(key: str, spot: np.ndarray) -> np.ndarray:
+    # Returns the mask as it is stored (read only, it is shared by every job that uses it)
+    if not enabled:
+        return spot
+    spot.flags.writeable = False
+    with lock:
+        addToMemory(key, spot)
+    writeDisk(key, spot)
+    return spot
+
+def addToMemory(key: str, spot: np.ndarray) -> None:
+    global memoryBytes
+    if spot.nbytes > memoryBudget:
+        return
+    if key in memoryCache:
+        memoryBytes -= memoryCache.pop(key).nbytes
+    memoryCache[key] = spot
+    memoryBytes += spot.nbytes
+    while memoryBytes > memoryBudget:
+        oldKey, oldSpot = memoryCache.popitem(last=False)
+        memoryBytes -= oldSpot.nbytes
+        stats["memoryEvictions"] += 1
+
+def readDisk(key: str) -> np.ndarray:
+    if not useDisk:
+        return None
+    data = disk.read(key)
+    if data is None:
+        return None
+    try:
+        spot = np.load(io.BytesIO(data))
+    except ValueError:
+        return None
+    spot.flags.writeable = False
+    return spot
+
+def writeDisk(key: str, spot: np.ndarray) -> None:
+    # Saved on a background thread so the job doesn't wait for the disk, when it can't keep up the mask is skipped
+    global writer
+    if not useDisk:
+        return
+    with lock:
+        if writer is None:
+            writer = threading.Thread(target=writeForever, name="spotcache", daemon=True)
+            writer.start()
+            atexit.register(flushWrites)
+    try:
+        pendingWrites.put_nowait((key, spot))
+    except queue.Full:
+        pass
+
+def writeForever() -> None:
+    while True:
+        key, spot = pendingWrites.get()
+        try:
+            data = io.BytesIO()
+            np.save(data, spot)
+            disk.write(key, data.getvalue())
+        finally:
+            pendingWrites.task_done()
+
+def flushWrites() -> None:
+    # Waits for the masks still queued, also called when the program exits so no temp file is left behind
+    if writer is not None:
+        pendingWrites.join()
+
+def clear(clearDisk: bool = False) -> None:
+    global memoryBytes
+    with lock:
+        memoryCache.clear()
+        memoryBytes = 0
+    if clearDisk:
+        flushWrites()
+        disk.clear()
+
+def getStats() -> dict:
+    with lock:
+        result = dict(stats)
+        result["memoryEntries"] = len(memoryCache)
+        result["memoryBytes"] = memoryBytes
+    result["diskEvictions"] = disk.getStats()["evictions"]
+    return result
+
+def describeStats() -> str:
+    current = getStats()
+    hits = current["memoryHits"] + current["diskHits"]
+    lookups = hits + current["misses"]
+    rate = hits / lookups * 100 if lookups > 0 else 0.0
+    return f"Spot cache: {hits} of {lookups} masks reused ({rate:.0f}%), {current['diskHits']} from disk"
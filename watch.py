@@ -0,0 +1,337 @@
+import argparse
+import ctypes
+import ctypes.util
+import os
+import select
+import signal
+import struct
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import batch
+import config
+import handleEPS
+import metrics
+import morphology
+import presetRegistry
+import spotCache
+
+pollInterval = 2.0 # Seconds between scans of the folder when inotify isn't available
+settleSeconds = 2.0 # A file found by a scan is converted once its size and time haven't changed for this long
+
+# inotify events used (from sys/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+eventHeader = struct.Struct("iIII")
+
+class InotifyWatcher():
+    # Waits for files to be closed after writing (or moved in) so nothing is read while it's still being copied
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.folders = dict()
+
+    def addFolder(self, folder: str) -> None:
+        if folder in self.folders.values():
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), self.mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"Can't watch {folder}")
+        self.folders[wd] = folder
+
+    def wait(self, timeout: float) -> tuple:
+        # Returns the files written, the folders created and if events were lost (then the folder has to be scanned)
+        files, folders, overflow = [], [], False
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return files, folders, overflow
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return files, folders, overflow
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = eventHeader.unpack_from(data, offset)
+            name = data[offset + eventHeader.size:offset + eventHeader.size + length].rstrip(b"\0")
+            offset += eventHeader.size + length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+            elif wd in self.folders and name:
+                path = os.path.join(self.folders[wd], os.fsdecode(name))
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        folders.append(path)
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    files.append(path)
+        return files, folders, overflow
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+def initWorker(*args) -> None:
+    # Ctrl+C is handled by the main process, which lets the workers finish the file they are converting
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    batch.initWorker(*args)
+
+def createWatcher(usePolling: bool = False) -> InotifyWatcher:
+    # None when inotify can't be used (not on Linux or on a network share), the folder is scanned instead
+    if usePolling or not sys.platform.startswith("linux"):
+        return None
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError, TypeError):
+        return None
+
+class HotFolder():
+    # Converts every image put in folder. Files in a subfolder use the preset with the same name (or the one
+    # given in routes), files in folder itself the default preset. Results go to outputDir, the inputs are moved
+    # to doneDir or, when the conversion failed, to errorDir together with a text file with the error.
+    def __init__(self, folder: str, outputDir: str, errorDir: str, doneDir: str, routes: dict = None, defaultPreset: str = None, metricsPath: str = None):
+        self.folder = os.path.abspath(folder)
+        self.outputDir = os.path.abspath(outputDir)
+        self.errorDir = os.path.abspath(errorDir)
+        self.doneDir = os.path.abspath(doneDir)
+        self.routes = routes or dict()
+        self.defaultPreset = defaultPreset
+        self.settings = dict()
+        self.presetVersion = None
+        self.pending = dict() # Files found by a scan that may still be written, path -> (size/time, first seen)
+        self.ready = []
+        self.active = set()
+        self.handled = dict() # Files that couldn't be moved away, not converted again unless they change
+        self.metricsPath = metricsPath
+        self.metricsState = None
+
+    def isOwnFolder(self, path: str) -> bool:
+        return os.path.abspath(path) in (self.outputDir, self.errorDir, self.doneDir)
+
+    def getWatchedFolders(self) -> list:
+        folders = [self.folder]
+        for entry in sorted(os.listdir(self.folder)):
+            path = os.path.join(self.folder, entry)
+            if os.path.isdir(path) and not self.isOwnFolder(path):
+                folders.append(path)
+        return folders
+
+    def getRoute(self, path: str) -> str:
+        # Name of the subfolder the file is in, "" for files directly in the hot folder
+        folder = os.path.dirname(path)
+        if folder == self.folder:
+            return ""
+        return os.path.basename(folder)
+
+    def getSettings(self, route: str) -> config.SettingsSnapshot:
+        # Read again when any preset changed
+        presetRegistry.registry.update()
+        if presetRegistry.registry.version != self.presetVersion:
+            self.settings.clear()
+            self.presetVersion = presetRegistry.registry.version
+        if route not in self.settings:
+            presetName = self.routes.get(route, route) if route else self.defaultPreset
+            self.settings[route] = batch.captureSettings(presetName)
+        return self.settings[route]
+
+    def scan(self, folder: str = None) -> None:
+        for watched in [folder] if folder else self.getWatchedFolders():
+            try:
+                names = sorted(os.listdir(watched))
+            except OSError:
+                continue
+            for name in names:
+                path = os.path.join(watched, name)
+                if os.path.isfile(path):
+                    self.check(path)
+
+    def check(self, path: str, closed: bool = False) -> None:
+        # closed is set when inotify saw the writer close the file, otherwise wait for it to stop changing
+        if path in self.active or path in self.ready or not batch.isAcceptedFile(path):
+            return
+        if os.path.dirname(path) != self.folder and os.path.dirname(os.path.dirname(path)) != self.folder:
+            return
+        try:
+            info = os.stat(path)
+        except OSError:
+            self.pending.pop(path, None)
+            return
+        signature = (info.st_size, info.st_mtime_ns)
+        if self.handled.get(path) == signature:
+            return
+        now = time.monotonic()
+        seen = self.pending.get(path)
+        if closed or (seen is not None and seen[0] == signature and now - seen[1] >= settleSeconds):
+            self.pending.pop(path, None)
+            self.ready.append(path)
+        elif seen is None or seen[0] != signature:
+            self.pending[path] = (signature, now)
+
+    def checkPending(self) -> None:
+        for path in list(self.pending.keys()):
+            self.check(path)
+
+    def getOutputName(self, path: str) -> str:
+        return batch.getBatchOutputName(path, os.path.join(self.outputDir, self.getRoute(path)))
+
+    def moveTo(self, path: str, folder: str) -> str:
+        folder = os.path.join(folder, self.getRoute(path))
+        os.makedirs(folder, exist_ok=True)
+        target = os.path.join(folder, os.path.basename(path))
+        os.replace(path, target)
+        return target
+
+    def finish(self, result: batch.BatchResult) -> None:
+        path = result.inputName
+        self.active.discard(path)
+        if self.metricsPath:
+            metrics.registry.addResult(result)
+        try:
+            if result.succeeded():
+                self.moveTo(path, self.doneDir)
+            else:
+                target = self.moveTo(path, self.errorDir)
+                with open(target + ".txt", "w") as f:
+                    f.write(result.error + "\n")
+            self.handled.pop(path, None)
+        except OSError as e:
+            print(f"Can't move {path}: {e}")
+            try:
+                info = os.stat(path)
+                self.handled[path] = (info.st_size, info.st_mtime_ns)
+            except OSError:
+                pass
+
+    def fail(self, path: str, error: str) -> None:
+        result = batch.BatchResult(path, self.getOutputName(path))
+        result.error = error
+        batch.printResult(result)
+        self.finish(result)
+
+    def writeMetrics(self, converted: int, failed: int, running: int) -> None:
+        # Only written again when something changed, the folder is checked several times a second
+        state = (converted, failed, running, len(self.ready), len(self.pending))
+        if not self.metricsPath or state == self.metricsState:
+            return
+        self.metricsState = state
+        metrics.registry.setGauge("queue_depth", len(self.ready) + len(self.pending), "Files found that wait to be converted")
+        metrics.registry.setGauge("busy_workers", running, "Files being converted")
+        try:
+            metrics.registry.write(self.metricsPath)
+        except OSError as e:
+            print(f"Can't write the metrics to {self.metricsPath}: {e}")
+
+    def submit(self, pool: ProcessPoolExecutor, path: str):
+        try:
+            settings = self.getSettings(self.getRoute(path))
+        except Exception as e:
+            self.fail(path, f"{type(e).__name__}: {e}")
+            return None
+        outputName = self.getOutputName(path)
+        os.makedirs(os.path.dirname(outputName), exist_ok=True)
+        self.active.add(path)
+        return pool.submit(batch.convertFile, path, outputName, settings)
+
+    def run(self, workers: int = 1, tasksPerWorker: int = None, usePolling: bool = False, once: bool = False) -> int:
+        # At most two files per worker are handed to the pool, the rest waits here so new files are picked in order
+        # and the pool's queue stays short. Every worker warms up numba before the first file arrives.
+        workers = batch.getWorkerCount(workers)
+        metrics.registry.setGauge("workers", workers, "Worker processes converting files")
+        for folder in (self.outputDir, self.errorDir, self.doneDir):
+            os.makedirs(folder, exist_ok=True)
+        watcher = createWatcher(usePolling)
+        converted, failed = 0, 0
+        with ProcessPoolExecutor(max_workers=workers, initializer=initWorker, initargs=(self.getSettings(""), None, spotCache.enabled, morphology.defaultEngine, handleEPS.useRasterCache, metrics.enabled), max_tasks_per_child=tasksPerWorker) as pool:
+            wait([pool.submit(int) for _ in range(workers)])
+            if watcher is not None:
+                for folder in self.getWatchedFolders():
+                    watcher.addFolder(folder)
+            print(f"Watching {self.folder} ({'inotify' if watcher is not None else 'polling'}, {workers} workers)")
+            self.scan()
+            futures = set()
+            try:
+                while True:
+                    if watcher is not None:
+                        files, folders, overflow = watcher.wait(0.2 if futures or self.pending else pollInterval)
+                        for folder in folders:
+                            if not self.isOwnFolder(folder) and os.path.dirname(folder) == self.folder:
+                                watcher.addFolder(folder)
+                                self.scan(folder)
+                        for path in files:
+                            self.check(path, closed=True)
+                        if overflow:
+                            self.scan()
+                        self.checkPending()
+                    else:
+                        if futures:
+                            wait(futures, timeout=pollInterval, return_when=FIRST_COMPLETED)
+                        elif not once or self.pending:
+                            time.sleep(pollInterval if not self.pending else min(pollInterval, settleSeconds))
+                        self.scan()
+                    for future in [future for future in futures if future.done()]:
+                        futures.discard(future)
+                        result = future.result()
+                        batch.printResult(result)
+                        self.finish(result)
+                        if result.succeeded():
+                            converted += 1
+                        else:
+                            failed += 1
+                    while self.ready and len(futures) < workers * 2:
+                        future = self.submit(pool, self.ready.pop(0))
+                        if future is not None:
+                            futures.add(future)
+                        else:
+                            failed += 1
+                    self.writeMetrics(converted, failed, len(futures))
+                    if once and not futures and not self.ready and not self.pending:
+                        break
+            except KeyboardInterrupt:
+                print("Stopping, files being converted are finished first")
+                pool.shutdown(wait=True, cancel_futures=True)
+            finally:
+                if watcher is not None:
+                    watcher.close()
+        print(f"Converted {converted} files, {failed} failed")
+        return 0 if failed == 0 else 2
+
+def parseRoutes(routes: list) -> dict:
+    found = dict()
+    for route in routes:
+        if "=" not in route:
+            raise argparse.ArgumentTypeError(f"Route must be <subfolder>=<preset>: {route}")
+        folder, preset = route.split("=", 1)
+        found[folder] = preset
+    return found
+
+def parseArgs(argv: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="watch", description="Add a spot layer to every image put in a folder")
+    parser.add_argument("folder", help="Folder to watch, files in a subfolder use the preset with the name of the subfolder")
+    parser.add_argument("-o", "--output", default=None, help="Folder for the _spot.tif files (default: <folder>/output)")
+    parser.add_argument("-e", "--errors", default=None, help="Folder the files that failed are moved to (default: <folder>/errors)")
+    parser.add_argument("-d", "--done", default=None, help="Folder the converted files are moved to (default: <folder>/done)")
+    parser.add_argument("-p", "--preset", default=None, help="Preset for files put directly in the folder (default: the current settings)")
+    parser.add_argument("--route", action="append", default=[], help="Use another preset for a subfolder: <subfolder>=<preset>, can be given more than once")
+    parser.add_argument("-j", "--workers", type=int, default=1, help="Number of files to convert at the same time, 0 uses one per CPU core (default: 1)")
+    parser.add_argument("--tasks-per-worker", type=int, default=None, help="Restart a worker after this many files to keep its memory use bounded")
+    parser.add_argument("--poll", action="store_true", help="Scan the folder every few seconds instead of using inotify (needed for some network shares)")
+    parser.add_argument("--once", action="store_true", help="Convert the files in the folder and stop instead of waiting for new ones")
+    parser.add_argument("--metrics", default=None, help="Keep conversion metrics in this file in the Prometheus text format (for node_exporter's textfile collector)")
+    return parser.parse_args(argv)
+
+def main(argv: list = None) -> int:
+    args = parseArgs(sys.argv[1:] if argv is None else argv)
+    if not os.path.isdir(args.folder):
+        print(f"Folder not found: {args.folder}")
+        return 1
+    config.setupProgram()
+    if args.metrics:
+        metrics.enable()
+    hotFolder = HotFolder(args.folder, args.output or os.path.join(args.folder, "output"), args.errors or os.path.join(args.folder, "errors"), args.done or os.path.join(args.folder, "done"), parseRoutes(args.route), args.preset, args.metrics)
+    return hotFolder.run(args.workers, args.tasks_per_worker, args.poll, args.once)
+
+if __name__ == "__main__":
+    sys.exit(main())